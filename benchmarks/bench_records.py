@@ -0,0 +1,73 @@
+"""Time and allocations of `process_transaction` plus augmentation per 100k transactions.
+
+Usage: python -m benchmarks.bench_records [count]
+"""
+
+import sys
+import time
+import tracemalloc
+
+import yaml
+
+from cleanab.apps.actual import ActualApp, ActualAppConfig
+from cleanab.apps.firefly_iii_fidi import FireFlyIIIApp, FireFlyIIIAppConfig
+from cleanab.apps.ynab5 import NewYnabApp, NewYnabConfig
+from cleanab.cleaner import FieldCleaner
+from cleanab.models import AccountConfig
+from cleanab.models.config import Config
+from cleanab.transactions import process_transaction
+
+from .synthetic import ACCOUNT, APPS, generate_transactions
+
+
+def build_pipeline():
+    with open("config.yaml.sample") as f:
+        raw = yaml.safe_load(f)
+    raw["accounts"] = [ACCOUNT]
+    raw["apps"] = {}
+    config = Config.model_validate(raw)
+    cleaner = FieldCleaner(config.replacements, config.finalizer)
+    apps = [
+        ActualApp(ActualAppConfig(**APPS["actual"])),
+        FireFlyIIIApp(FireFlyIIIAppConfig(**APPS["firefly_iii_fidi"])),
+        NewYnabApp(NewYnabConfig(**APPS["ynab5"])),
+    ]
+    return cleaner, apps, AccountConfig(**ACCOUNT)
+
+
+def run(transactions, cleaner, apps, account):
+    augmented = []
+    for transaction in transactions:
+        record = process_transaction(transaction, cleaner)
+        if record:
+            augmented.append([app.augment_transaction(record, account) for app in apps])
+    return augmented
+
+
+def main(count=100_000):
+    import logging
+
+    from logzero import logger
+
+    logger.setLevel(logging.ERROR)
+    cleaner, apps, account = build_pipeline()
+    transactions = list(generate_transactions(count, seed=42))
+
+    start = time.perf_counter()
+    run(transactions, cleaner, apps, account)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = run(transactions, cleaner, apps, account)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    print(f"transactions:   {count}")
+    print(f"time:           {elapsed:.2f}s ({elapsed / count * 1e6:.1f}µs per transaction)")
+    print(f"retained:       {current / 2**20:.1f} MiB")
+    print(f"peak allocated: {peak / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
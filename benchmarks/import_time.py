@@ -0,0 +1,55 @@
+"""Check how long importing the CLI takes and that heavy modules stay unloaded.
+
+Usage: python -m benchmarks.import_time [--budget MS]
+
+Exits non-zero when the median import time exceeds the budget or when one of
+the modules that should only be loaded on demand is imported at start-up.
+"""
+
+import re
+import statistics
+import subprocess
+import sys
+
+import click
+
+# Modules that must not be imported just to start the CLI
+LAZY_MODULES = ["fints", "PIL", "ynab_api", "requests", "cleanab.main", "pydantic"]
+
+re_import_line = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def measure_import(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = {}
+    for line in result.stderr.splitlines():
+        if match := re_import_line.match(line):
+            imported[match.group(4)] = int(match.group(2))
+    return imported
+
+
+@click.command()
+@click.option("--module", default="cleanab.cli", show_default=True)
+@click.option("--budget", type=float, default=150, show_default=True, help="Budget in milliseconds.")
+@click.option("--repeat", type=int, default=5, show_default=True)
+def main(module, budget, repeat):
+    runs = [measure_import(module) for _ in range(repeat)]
+    median_ms = statistics.median(run[module] for run in runs) / 1000
+
+    click.echo(f"import {module}: {median_ms:.1f}ms (budget {budget:.0f}ms)")
+    failed = median_ms > budget
+    for lazy in LAZY_MODULES:
+        if lazy in runs[0]:
+            click.echo(f"  {lazy} is imported eagerly", err=True)
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Drive `Cleanab.run` against local stand-ins of the app APIs.
+
+Starts one stand-in server per app (see `benchmarks.standins`), points the
+connectors at them and runs the full pipeline with synthetic transactions
+instead of a bank. Reports throughput and latency per connector, both as
+seen by the connector (one `create_transactions` call per batch) and by the
+server (per HTTP request):
+
+    python -m benchmarks.loadtest --transactions 20000 --latency 0.05 --error-rate 0.02
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from unittest import mock
+
+import click
+
+# Keep account caches and outboxes out of the user's cache
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="cleanab-loadtest-")
+
+import logging  # noqa: E402
+
+from logzero import logger  # noqa: E402
+
+from cleanab.main import Cleanab  # noqa: E402
+from cleanab.models.config import Config  # noqa: E402
+
+from .standins import STAND_INS, Behaviour, app_configs, percentile  # noqa: E402
+from .synthetic import ACCOUNT, generate_rules, generate_transactions  # noqa: E402
+
+
+class CallStats:
+    """Duration and outcome of every `create_transactions` call of an app."""
+
+    def __init__(self):
+        self.durations = []
+        self.failures = 0
+        self.created = 0
+        self._lock = threading.Lock()
+
+    def instrument(self, app):
+        upload = app.create_transactions
+
+        def counted(transactions):
+            # Streaming apps get the batch lazily, count it as it is consumed
+            count = 0
+            for count, transaction in enumerate(transactions, 1):
+                yield transaction
+            with self._lock:
+                self.created += count
+
+        def timed(transactions):
+            started = time.perf_counter()
+            size = len(transactions) if isinstance(transactions, list) else 0
+            if not size:
+                transactions = counted(transactions)
+            try:
+                new, duplicates = upload(transactions)
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                raise
+            finally:
+                with self._lock:
+                    self.durations.append(time.perf_counter() - started)
+            with self._lock:
+                self.created += size
+            return new, duplicates
+
+        app.create_transactions = timed
+
+    def summary(self):
+        durations = sorted(self.durations)
+        # Per second spent uploading to this app, apps are uploaded to in parallel
+        busy = sum(durations)
+        return {
+            "batches": len(durations),
+            "failed_batches": self.failures,
+            "transactions": self.created,
+            "transactions_per_s": self.created / busy if busy else 0.0,
+            "p50_ms": percentile(durations, 0.5) * 1000,
+            "p95_ms": percentile(durations, 0.95) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+            "max_ms": (durations[-1] if durations else 0.0) * 1000,
+        }
+
+
+def make_config(servers, rule_count):
+    return Config.model_validate(
+        {
+            "accounts": [ACCOUNT],
+            "replacements": generate_rules(rule_count, seed=rule_count),
+            "apps": app_configs(servers),
+        }
+    )
+
+
+def run_load(servers, *, transactions, runs, rule_count):
+    raw_transactions = list(generate_transactions(transactions, seed=1))
+    config = make_config(servers, rule_count)
+    stats = {name: CallStats() for name in servers}
+    elapsed = 0.0
+    for _ in range(runs):
+        # A fresh instance per run, like separate cron invocations. full, so
+        # later runs upload again instead of skipping the unchanged account
+        cleanab = Cleanab(config=config, full=True)
+        cleanab.setup()
+        for app in cleanab.config.get_apps():
+            stats[app.name].instrument(app)
+        with mock.patch("cleanab.fints.process_fints_account", return_value=raw_transactions):
+            started = time.perf_counter()
+            cleanab.run()
+            elapsed += time.perf_counter() - started
+        cleanab.close()
+
+    report = {}
+    for app in cleanab.config.get_apps():
+        report[app.name] = {
+            "client": stats[app.name].summary(),
+            "server": servers[app.name].log.summary(),
+            # Failed batches left in the outbox for a later run
+            "queued_batches": len(cleanab.uploader.outbox(app).entries()),
+        }
+    return report, elapsed
+
+
+def print_report(report, elapsed):
+    click.echo(f"Total pipeline time {elapsed:.2f}s")
+    click.echo(
+        f"{'app':18} {'batches':>8} {'failed':>7} {'tx/s':>10} {'p50 ms':>9} {'p95 ms':>9} "
+        f"{'p99 ms':>9} {'max ms':>9} {'requests':>9} {'dupes':>7} {'queued':>7}"
+    )
+    for name, result in report.items():
+        client, server = result["client"], result["server"]
+        click.echo(
+            f"{name:18} {client['batches']:8} {client['failed_batches']:7} "
+            f"{client['transactions_per_s']:10.0f} {client['p50_ms']:9.1f} {client['p95_ms']:9.1f} "
+            f"{client['p99_ms']:9.1f} {client['max_ms']:9.1f} {server['requests']:9} "
+            f"{server['duplicates']:7} {result['queued_batches']:7}"
+        )
+        click.echo(f"{'':18} HTTP status counts: {server['statuses']}")
+
+
+@click.command()
+@click.option("--transactions", type=int, default=5000, show_default=True, help="Transactions per run.")
+@click.option("--runs", type=int, default=2, show_default=True, help="Runs with the same transactions.")
+@click.option("--rules", "rule_count", type=int, default=100, show_default=True)
+@click.option(
+    "-a",
+    "--app",
+    "apps",
+    type=click.Choice(sorted(STAND_INS)),
+    multiple=True,
+    help="Apps to load test, all by default.",
+)
+@click.option("--latency", type=float, default=0.0, show_default=True, help="Seconds added per request.")
+@click.option("--jitter", type=float, default=0.0, show_default=True, help="Random extra seconds per request.")
+@click.option("--error-rate", type=float, default=0.0, show_default=True, help="Share of requests failing.")
+@click.option("--rate-limit", type=float, help="Requests per second the stand-ins accept.")
+@click.option(
+    "--duplicate-rate",
+    type=float,
+    default=0.0,
+    show_default=True,
+    help="Share of new transactions reported as duplicates.",
+)
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Write the report as JSON to this file.")
+@click.option("-v", "--verbose", is_flag=True)
+def main(
+    transactions, runs, rule_count, apps, latency, jitter, error_rate, rate_limit, duplicate_rate, output, verbose
+):
+    logger.setLevel(logging.DEBUG if verbose else logging.CRITICAL)
+    behaviour = Behaviour(
+        latency=latency,
+        jitter=jitter,
+        error_rate=error_rate,
+        rate_limit=rate_limit,
+        duplicate_rate=duplicate_rate,
+    )
+    with ExitStack() as stack:
+        servers = {
+            name: stack.enter_context(STAND_INS[name](behaviour)) for name in (apps or sorted(STAND_INS))
+        }
+        report, elapsed = run_load(servers, transactions=transactions, runs=runs, rule_count=rule_count)
+
+    print_report(report, elapsed)
+    if output:
+        with open(output, "w") as f:
+            json.dump({"elapsed_s": elapsed, "apps": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Benchmark suite for the transaction pipeline.
+
+Runs every case a few times and writes the results as JSON, so runs from
+different commits can be compared:
+
+    python -m benchmarks.run --output before.json
+    git checkout other-branch
+    python -m benchmarks.run --output after.json --compare before.json
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+import click
+
+# Keep account caches and intermediaries of the full-run case out of the user's cache
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="cleanab-bench-")
+
+import logging  # noqa: E402
+
+from logzero import logger  # noqa: E402
+
+from cleanab import main as cleanab_main  # noqa: E402
+from cleanab.apps.base import load_app  # noqa: E402
+from cleanab.cleaner import FieldCleaner  # noqa: E402
+from cleanab.models import AccountConfig  # noqa: E402
+from cleanab.models.config import Config  # noqa: E402
+from cleanab.transactions import process_transaction  # noqa: E402
+
+from .synthetic import ACCOUNT, APPS, generate_rules, generate_transactions  # noqa: E402
+
+RULE_COUNTS = [10, 100, 1000, 5000]
+
+
+def make_config(rule_count, apps=APPS):
+    return Config.model_validate(
+        {
+            "accounts": [ACCOUNT],
+            "replacements": generate_rules(rule_count, seed=rule_count),
+            "apps": {name: dict(conf) for name, conf in apps.items()},
+        }
+    )
+
+
+def make_cleaner(config):
+    return FieldCleaner(config.replacements, config.finalizer)
+
+
+def measure(func, *, ops, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        "ops": ops,
+        "repeat": repeat,
+        "min_s": min(timings),
+        "median_s": statistics.median(timings),
+        "per_op_us": min(timings) / ops * 1e6,
+    }
+
+
+class StubUploadApp:
+    """Wraps a real app connector and replaces the upload with serialization."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+    def create_transactions(self, transactions):
+        for _ in self.app.create_intermediary(transactions):
+            pass
+        return [], []
+
+
+def iter_cases(scale):
+    transactions = list(generate_transactions(int(10_000 * scale), seed=1))
+    account = AccountConfig(**ACCOUNT)
+
+    for rule_count in RULE_COUNTS:
+        cleaner = make_cleaner(make_config(rule_count))
+        # Keep the number of rule applications per case roughly constant
+        sample = transactions[: max(50, int(len(transactions) * 10 / rule_count))]
+        fields = [{"applicant_name": t["applicant_name"], "purpose": t["purpose"]} for t in sample]
+
+        def clean(cleaner=cleaner, fields=fields):
+            for data in fields:
+                cleaner.clean(dict(data))
+
+        yield f"cleaner.clean[rules={rule_count}]", clean, len(fields)
+
+        def process(cleaner=cleaner, sample=sample):
+            for transaction in sample:
+                process_transaction(transaction, cleaner)
+
+        yield f"process_transaction[rules={rule_count}]", process, len(sample)
+
+    config = make_config(100)
+    cleaner = make_cleaner(config)
+    records = [r for r in (process_transaction(t, cleaner) for t in transactions) if r]
+    for name, app_config in config.apps.items():
+        app = load_app(name, app_config)
+
+        def augment(app=app):
+            for record in records:
+                app.augment_transaction(record, account)
+
+        yield f"{name}.augment_transaction", augment, len(records)
+
+        def augment_batch(app=app):
+            app.augment_batch(records, account)
+
+        yield f"{name}.augment_batch", augment_batch, len(records)
+
+        augmented = [app.augment_transaction(record, account) for record in records]
+
+        def intermediary(app=app, augmented=augmented):
+            for _ in app.create_intermediary(augmented):
+                pass
+
+        yield f"{name}.create_intermediary", intermediary, len(augmented)
+
+    def full_run():
+        # full: repeats share the cache directory, the unchanged fingerprint must not skip them
+        cleanab = cleanab_main.Cleanab(config=make_config(100), full=True)
+        cleanab.setup()
+        cleanab.config._parsed_apps = [StubUploadApp(app) for app in cleanab.config.get_apps()]
+        with mock.patch("cleanab.fints.process_fints_account", return_value=transactions):
+            cleanab.run()
+        cleanab.close()
+
+    yield "Cleanab.run", full_run, len(transactions)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    click.echo(f"{'case':45} {'baseline µs':>12} {'current µs':>12} {'ratio':>7}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["per_op_us"]
+        after = result["per_op_us"]
+        ratio = after / before if before else float("inf")
+        marker = " !" if ratio > 1 + threshold else ""
+        click.echo(f"{name:45} {before:12.2f} {after:12.2f} {ratio:7.2f}{marker}")
+        if marker:
+            regressions.append(name)
+    return regressions
+
+
+@click.command()
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Write results as JSON to this file.")
+@click.option(
+    "--compare",
+    "baseline_file",
+    type=click.File("r"),
+    help="Compare against the JSON results of a previous run.",
+)
+@click.option(
+    "--threshold",
+    type=float,
+    default=0.1,
+    show_default=True,
+    help="Relative slowdown per case that counts as a regression.",
+)
+@click.option("--scale", type=float, default=1.0, show_default=True, help="Scale the number of transactions.")
+@click.option("--repeat", type=int, default=3, show_default=True)
+@click.option("-k", "--filter", "name_filter", help="Only run cases containing this string.")
+def main(output, baseline_file, threshold, scale, repeat, name_filter):
+    logger.setLevel(logging.ERROR)
+
+    results = {}
+    for name, func, ops in iter_cases(scale):
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(func, ops=ops, repeat=repeat)
+        click.echo(f"{name:45} {results[name]['per_op_us']:10.2f} µs/op", err=True)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "scale": scale,
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline_file:
+        regressions = compare(results, json.load(baseline_file)["results"], threshold)
+        if regressions:
+            click.echo(f"{len(regressions)} case(s) regressed by more than {threshold:.0%}", err=True)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""Local HTTP servers imitating the upload endpoints of the supported apps.
+
+- Actual HTTP API: `POST /budgets/<sync id>/accounts/<account>/transactions/import`
+- Firefly III data importer: `POST /autoupload`
+- YNAB: `POST /v1/budgets/<budget>/transactions`
+
+Each server remembers the import ids it has seen and reports them as
+duplicates like the real app would. Latency, error rate, rate limiting and
+additional random duplicates are configurable through `Behaviour`.
+"""
+
+import json
+import math
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+
+@dataclass
+class Behaviour:
+    # Seconds added to every request, plus up to `jitter` seconds
+    latency: float = 0.0
+    jitter: float = 0.0
+    # Share of requests answered with a 500
+    error_rate: float = 0.0
+    # Requests per second before answering with a 429, None for no limit
+    rate_limit: float | None = None
+    # Share of new transactions reported as duplicates anyway
+    duplicate_rate: float = 0.0
+    seed: int = 0
+
+
+@dataclass
+class RequestLog:
+    durations: list = field(default_factory=list)
+    statuses: dict = field(default_factory=dict)
+    transactions: int = 0
+    duplicates: int = 0
+
+    def summary(self):
+        durations = sorted(self.durations)
+        return {
+            "requests": len(durations),
+            "statuses": dict(self.statuses),
+            "transactions": self.transactions,
+            "duplicates": self.duplicates,
+            "p50_ms": percentile(durations, 0.5) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+        }
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted `values`."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "StandInServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        started = time.perf_counter()
+        status, body, content_type = self.server.respond(self)
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.record(status, time.perf_counter() - started)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    name = ""
+
+    def __init__(self, behaviour: Behaviour | None = None, address=("127.0.0.1", 0)):
+        super().__init__(address, _Handler)
+        self.behaviour = behaviour or Behaviour()
+        self.log = RequestLog()
+        self.seen: set[str] = set()
+        self._random = random.Random(self.behaviour.seed)
+        self._lock = threading.Lock()
+        self._next_allowed = 0.0
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=f"standin-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def record(self, status, duration):
+        with self._lock:
+            self.log.durations.append(duration)
+            self.log.statuses[status] = self.log.statuses.get(status, 0) + 1
+
+    def _throttled(self):
+        if not self.behaviour.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_allowed:
+                return True
+            self._next_allowed = now + 1 / self.behaviour.rate_limit
+            return False
+
+    def dedupe(self, import_ids):
+        """Split import ids into new and duplicate ones, remembering the new ones."""
+        new, duplicates = [], []
+        with self._lock:
+            for import_id in import_ids:
+                if import_id in self.seen or self._random.random() < self.behaviour.duplicate_rate:
+                    duplicates.append(import_id)
+                else:
+                    new.append(import_id)
+                self.seen.add(import_id)
+            self.log.transactions += len(import_ids)
+            self.log.duplicates += len(duplicates)
+        return new, duplicates
+
+    def respond(self, request):
+        body = request.rfile.read(int(request.headers.get("Content-Length", 0)))
+        behaviour = self.behaviour
+        with self._lock:
+            delay = behaviour.latency + self._random.uniform(0, behaviour.jitter)
+            failed = self._random.random() < behaviour.error_rate
+        if delay:
+            time.sleep(delay)
+        if self._throttled():
+            return 429, json.dumps({"error": {"id": "429", "name": "too_many_requests"}}), "application/json"
+        if failed:
+            return 500, json.dumps({"error": {"id": "500", "name": "internal_server_error"}}), "application/json"
+        return self.handle_upload(request, body)
+
+    def handle_upload(self, request, body):
+        raise NotImplementedError
+
+
+class ActualStandIn(StandInServer):
+    name = "actual"
+    _path = re.compile(r"^/budgets/[^/]+/accounts/[^/]+/transactions/import$")
+
+    def handle_upload(self, request, body):
+        if not self._path.match(request.path):
+            return 404, "{}", "application/json"
+        transactions = json.loads(body)["transactions"]
+        new, duplicates = self.dedupe([t["imported_id"] for t in transactions])
+        return 200, json.dumps({"data": {"added": new, "updated": duplicates, "errors": []}}), "application/json"
+
+
+class FireflyStandIn(StandInServer):
+    name = "firefly_iii_fidi"
+
+    def handle_upload(self, request, body):
+        if not request.path.startswith("/autoupload"):
+            return 404, "", "text/plain"
+        message = BytesParser().parsebytes(
+            f"Content-Type: {request.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        parts = {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+        rows = parts["importable"].get_payload(decode=True).decode("utf-8").splitlines()[1:]
+        # The external id is the last column
+        new, duplicates = self.dedupe([row.rsplit(",", 1)[-1].strip('"') for row in rows if row])
+        report = [f"Imported {len(new)} transaction(s)."]
+        report += [f"Line {i}: duplicate of an existing transaction" for i, _ in enumerate(duplicates)]
+        return 200, "\n".join(report), "text/plain"
+
+
+class YnabStandIn(StandInServer):
+    name = "ynab5"
+    _path = re.compile(r"^/v1/budgets/[^/]+/transactions$")
+
+    def handle_upload(self, request, body):
+        if not self._path.match(request.path):
+            return 404, "{}", "application/json"
+        transactions = json.loads(body)["transactions"]
+        new, duplicates = self.dedupe([t["import_id"] for t in transactions])
+        data = {
+            "transaction_ids": [str(uuid4()) for _ in new],
+            "duplicate_import_ids": duplicates,
+            "server_knowledge": len(self.seen),
+        }
+        return 201, json.dumps({"data": data}), "application/json"
+
+
+STAND_INS = {server.name: server for server in (ActualStandIn, FireflyStandIn, YnabStandIn)}
+
+
+def app_configs(servers):
+    """App configs pointing the connectors at running stand-ins, by app name."""
+    configs = {}
+    for name, server in servers.items():
+        if name == "actual":
+            configs[name] = {
+                "actual_api_url": server.url,
+                "actual_api_key": "key",
+                "actual_sync_id": "sync",
+                "actual_account_ids": ["account"],
+            }
+        elif name == "firefly_iii_fidi":
+            configs[name] = {
+                "fidi_url": server.url,
+                "default_account_id": 1,
+                "auto_import_secret": "secret",
+                "personal_access_token": "token",
+            }
+        elif name == "ynab5":
+            configs[name] = {
+                "access_token": "token",
+                "budget_id": "3fa85f64-5717-4562-b3fc-2c963f66afa6",
+                "api_url": f"{server.url}/v1",
+            }
+    return configs
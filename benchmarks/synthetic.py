@@ -0,0 +1,174 @@
+"""Seeded generators for realistic FinTS transaction data and rule sets."""
+
+import random
+import string
+from datetime import date, timedelta
+
+from mt940.models import Amount
+
+MERCHANTS = [
+    "Amzn Mktp De*{ref}",
+    "Rewe Markt Gmbh",
+    "Edeka Center {city}",
+    "Visa Card Transact Lidl {city}",
+    "Sumup  *Cafe {city}",
+    "Itunes.Com/Bill",
+    "Paypal (Europe) S.A.R.L. Et Cie., S.C.A.",
+    "Deutsche Bahn Ag",
+    "Stadtwerke {city} Gmbh",
+]
+CITIES = ["Berlin", "Hamburg", "Muenchen", "Koeln", "Leipzig", "Bremen"]
+PURPOSES = [
+    "kaufumsatz{day}.{month}{hh}{mm}{ss} Arn{arn}",
+    "EREF+{ref} MREF+M{ref} CRED+DE98ZZZ09999999999 SVWZ+Rechnung {ref} vom {day}.{month}",
+    "Lastschrift Strom Abschlag {month}/{year}",
+    "gutschrift Erstatt {ref}",
+    "bargeldauszahlung{day}.{month}{hh}{mm}{ss}",
+]
+
+
+def generate_transactions(count, *, seed=0, today=None):
+    """Yield `count` transaction dicts shaped like `fints.retrieve_transactions` output."""
+    rng = random.Random(seed)
+    today = today or date.today()
+    for _ in range(count):
+        booked = today - timedelta(days=rng.randrange(0, 90))
+        fields = {
+            "ref": rng.randrange(10**6, 10**7),
+            "city": rng.choice(CITIES),
+            "day": f"{booked.day:02}",
+            "month": f"{booked.month:02}",
+            "year": booked.year,
+            "hh": f"{rng.randrange(24):02}",
+            "mm": f"{rng.randrange(60):02}",
+            "ss": f"{rng.randrange(60):02}",
+            "arn": rng.randrange(10**8, 10**10),
+        }
+        if rng.random() < 0.15:
+            # Credit card layout without a separate applicant name
+            applicant_name = None
+            purpose = (
+                rng.choice(MERCHANTS).format(**fields)
+                + f" EUR   {rng.randrange(1, 500)},{rng.randrange(100):02} "
+                + PURPOSES[0].format(**fields)
+            )
+        else:
+            applicant_name = rng.choice(MERCHANTS).format(**fields)
+            purpose = rng.choice(PURPOSES).format(**fields)
+
+        cents = rng.randrange(1, 50_000)
+        yield {
+            "status": "D",
+            "funds_code": None,
+            "amount": Amount(f"{cents // 100}.{cents % 100:02}", rng.choice("DDDDC"), "EUR"),
+            "id": "NMSC",
+            "customer_reference": "NONREF",
+            "bank_reference": None,
+            "extra_details": "",
+            "currency": "EUR",
+            "date": booked,
+            "entry_date": booked,
+            "transaction_code": "106",
+            "posting_text": "Kartenzahlung",
+            "prima_nota": "4711",
+            "purpose": purpose,
+            "applicant_bin": "BYLADEM1001",
+            "applicant_iban": "DE02120300000000202051",
+            "applicant_name": applicant_name,
+            "return_debit_notes": None,
+            "recipient_name": None,
+            "additional_purpose": None,
+            "gvc_applicant_iban": None,
+            "gvc_applicant_bin": None,
+            "end_to_end_reference": None,
+            "additional_position_reference": None,
+            "applicant_creditor_id": None,
+            "purpose_code": None,
+            "additional_position_date": None,
+            "deviate_applicant": None,
+            "deviate_recipient": None,
+            "FRST_ONE_OFF_RECC": None,
+            "old_SEPA_CI": None,
+            "old_SEPA_additional_position_reference": None,
+            "settlement_tag": None,
+            "debitor_identifier": None,
+            "compensation_amount": None,
+            "original_amount": None,
+        }
+
+
+ACCOUNT = {
+    "iban": "DE89370400440532013000",
+    "per_app_id": "account",
+    "fints_username": "user",
+    "fints_password": "secret",
+    "fints_blz": "12345678",
+    "fints_endpoint": "https://fints.example.com/",
+    "friendly_name": "Benchmark",
+}
+
+APPS = {
+    "actual": {
+        "actual_api_url": "http://localhost",
+        "actual_api_key": "key",
+        "actual_sync_id": "sync",
+        "actual_account_ids": ["account"],
+    },
+    "firefly_iii_fidi": {
+        "fidi_url": "http://localhost",
+        "default_account_id": 1,
+        "auto_import_secret": "secret",
+        "personal_access_token": "token",
+    },
+    "ynab5": {
+        "access_token": "token",
+        "budget_id": "3fa85f64-5717-4562-b3fc-2c963f66afa6",
+    },
+}
+
+
+def _word(rng, length):
+    return "".join(rng.choice(string.ascii_letters) for _ in range(length)).capitalize()
+
+
+def generate_rules(count, *, seed=0):
+    """Return a `replacements` config section with `count` rules split across fields.
+
+    Roughly mirrors hand-written rule sets: mostly anchored regexes for merchant
+    names, plain string removals and a few literal `string:` replacements. The
+    rules from the sample config are always included so some of them match.
+    """
+    rng = random.Random(seed)
+    base = {
+        "applicant_name": [
+            {"pattern": r"Amzn Mktp De\*.*$", "repl": "Amazon Marketplace"},
+            "Visa Card Transact ",
+            {"string": "Gmbh", "repl": "GmbH"},
+            {"pattern": r"Sumup  \*"},
+        ],
+        "purpose": [
+            {
+                "pattern": r"Kaufumsatz(\d{2})\.(\d{2})(\d{2})(\d{2})(\d{2})",
+                "repl": r"Kaufumsatz (\1.\2., \3:\4:\5) ",
+            },
+            {"pattern": r"([^\s])gutschrift", "repl": r"\1 Gutschrift"},
+            {"pattern": r"Arn\d{8,}$"},
+            {"pattern": r"Erstatt\s", "repl": "Erstattung "},
+        ],
+    }
+    rules = {field: list(entries) for field, entries in base.items()}
+    for i in range(max(0, count - sum(len(r) for r in base.values()))):
+        field = "applicant_name" if i % 2 else "purpose"
+        kind = rng.random()
+        merchant = _word(rng, rng.randrange(4, 10))
+        if kind < 0.6:
+            rule = {
+                "pattern": rf"^{merchant}\s+{_word(rng, 4)}.*$",
+                "repl": merchant,
+            }
+        elif kind < 0.8:
+            rule = f"{merchant} {_word(rng, 3)}"
+        else:
+            rule = {"string": merchant.lower(), "repl": merchant}
+        rules[field].append(rule)
+    return rules
@@ -1,4 +1,4 @@
-from . import constants
-from .cli import cli
+from .cli import main
 
-cli(auto_envvar_prefix=constants.ENV_PREFIX)
+if __name__ == "__main__":
+    main()
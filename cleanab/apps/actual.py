@@ -1,12 +1,12 @@
-import json
-from decimal import Decimal
+from collections.abc import Iterator
+from functools import cached_property
 
-import requests
 from logzero import logger
 from pydantic import HttpUrl
 
-from ..models import AccountConfig, FintsTransaction
-from .base import BaseApp, BaseAppConfig
+from ..models import AccountConfig, TransactionRecord
+from ..utils import http_session
+from .base import AppCapabilities, BaseApp, BaseAppConfig, UploadError, iter_json_array
 
 
 class ActualAppConfig(BaseAppConfig):
@@ -18,14 +18,28 @@ class ActualAppConfig(BaseAppConfig):
 
 
 class ActualApp(BaseApp):
+    name = "actual"
+    intermediary_suffix = ".json"
+    # Imports are deduplicated by imported_id; concurrent imports into one
+    # budget file conflict on the server
+    capabilities = AppCapabilities(max_batch_size=100, idempotent=True)
+
     def __init__(self, config: ActualAppConfig) -> None:
         self.config = config
 
     def __str__(self):
         return "Actual App Connection"
 
-    def create_intermediary(self, transactions: tuple) -> str:
-        return json.dumps(transactions, indent=2)
+    @cached_property
+    def _session(self):
+        return http_session(self.config.actual_api_url)
+
+    @property
+    def target(self):
+        return f"{self.config.actual_api_url}#{self.config.actual_sync_id}"
+
+    def create_intermediary(self, transactions: tuple) -> Iterator[str]:
+        return iter_json_array(transactions)
 
     def create_transactions(self, transactions: list[dict]) -> tuple[list, list]:
         """Create transactions in Actual.
@@ -66,15 +80,16 @@ class ActualApp(BaseApp):
             for i in range(0, len(transactions), 100):
                 chunk = transactions[i : i + 100]
 
-                response = requests.post(
+                response = self._session.post(
                     f"{url}/budgets/{sync_id}/accounts/{account_id}/transactions/import",
                     headers=headers,
                     json={"transactions": chunk},
                 )
 
                 if not response.ok:
-                    logger.error(f"Failed creating transactions: \n\n{response.text}")
-                    return new, duplicates
+                    raise UploadError(
+                        f"Failed creating transactions in account {account_id}: \n\n{response.text}"
+                    )
 
                 report = response.json().get('data', {})
                 logger.info(f"Received import report:\n{report}")
@@ -85,24 +100,33 @@ class ActualApp(BaseApp):
     is_written_account = False
 
     def augment_transaction(
-        self, transaction: FintsTransaction, account: AccountConfig
+        self, transaction: TransactionRecord, account: AccountConfig
     ):
-        if not self.is_written_account:
+        return self.augment_batch((transaction,), account)[0]
+
+    def augment_batch(self, transactions, account: AccountConfig):
+        if transactions and not self.is_written_account:
             logger.debug(f"Writing transactions to account {account}")
             self.is_written_account = True
-        payee_name = transaction.applicant_name
-        if len(payee_name) > 50:
-            payee_name = payee_name[:50]
-
-        return {
-            "_account_id": account.per_app_id,
-            "date": transaction.date.isoformat(),
-            "payee_name": transaction.applicant_name or "Unnamed",
-            "imported_payee": transaction.applicant_name or "Unnamed",
-            "notes": transaction.purpose,
-            "amount": int(Decimal(transaction.amount) / 10),
-            "imported_id": transaction.import_id,
-        }
+
+        account_id = account.per_app_id
+        augmented = []
+        for transaction in transactions:
+            payee_name = transaction.applicant_name or "Unnamed"
+            amount = transaction.amount
+            augmented.append(
+                {
+                    "_account_id": account_id,
+                    "date": transaction.date.isoformat(),
+                    "payee_name": payee_name,
+                    "imported_payee": payee_name,
+                    "notes": transaction.purpose,
+                    # Milliunits to cents, truncated towards zero
+                    "amount": amount // 10 if amount >= 0 else -(-amount // 10),
+                    "imported_id": transaction.import_id,
+                }
+            )
+        return augmented
 
 
 Config = ActualAppConfig
@@ -1,5 +1,7 @@
+import json
 from abc import ABC, abstractmethod
-from importlib import import_module
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
 from typing import Any
 
 from logzero import logger
@@ -7,6 +9,12 @@ from pydantic import BaseModel, GetCoreSchemaHandler, GetJsonSchemaHandler
 from pydantic.json_schema import JsonSchemaValue
 from pydantic_core import CoreSchema, core_schema
 
+from .registry import registry
+
+
+class UploadError(Exception):
+    """The app did not accept the transactions."""
+
 
 class BaseAppConfig(BaseModel):
     """Base class for app configurations. Does not define custom schema."""
@@ -43,29 +51,84 @@ class _AppConfigValidator:
         if not module_name:
             raise ValueError("App config must have a 'module' key")
         try:
-            module_path = "cleanab.apps." + module_name
-            module = import_module(module_path)
-            return module.Config(**data)
-        except ModuleNotFoundError:
-            raise ValueError(f"Unknown app: {module_name}")
+            module = registry.get_module(module_name)
+        except KeyError:
+            raise ValueError(
+                f"Unknown app: {module_name} (available: {', '.join(registry.names())})"
+            ) from None
+        return module.Config(**data)
+
+
+@dataclass(frozen=True)
+class AppCapabilities:
+    """What an app's API can handle, used to schedule uploads."""
+
+    # Most transactions per create_transactions call, None for no limit
+    max_batch_size: int | None = None
+    # Batches that may be uploaded at the same time
+    concurrency: int = 1
+    # Requests per second, None for no limit
+    rate_limit: float | None = None
+    # Requests that may be sent at once before rate_limit applies
+    burst: int = 1
+    # Uploading the same transactions again does not create duplicates
+    idempotent: bool = False
+    # create_transactions accepts any iterable and consumes it only once
+    streaming: bool = False
 
 
 class BaseApp(ABC):
+    name: str = ""
+    intermediary_suffix: str = ".txt"
+    capabilities: AppCapabilities = AppCapabilities()
+
+    @property
+    def target(self) -> str:
+        """Where transactions end up, unique per budget or ledger."""
+        return str(self)
+
     @abstractmethod
     def create_transactions(self, transactions) -> tuple[list, list]:
+        """Upload transactions, returns the new and duplicate ones.
+
+        Raises an exception, for example `UploadError`, unless the app
+        accepted all of them.
+        """
         return [], []
 
     @abstractmethod
     def augment_transaction(self, transaction, account):
         pass
 
+    def augment_batch(self, transactions, account) -> list:
+        """Turn all cleaned transactions of an account into the app's payload.
+
+        Apps override this to compute values that are the same for the whole
+        account only once. By default `augment_transaction` is called per
+        transaction.
+        """
+        return [self.augment_transaction(transaction, account) for transaction in transactions]
+
     @abstractmethod
-    def create_intermediary(self, transactions: tuple) -> str:
-        return ""
+    def create_intermediary(self, transactions: tuple) -> Iterator[str]:
+        """Lazily render the payload that would be sent to the app.
+
+        Chunks are yielded one after another so large intermediaries can be
+        streamed to a file without being built in memory first.
+        """
+        yield from ()
+
+
+def iter_json_array(items: Iterable, **kwargs) -> Iterator[str]:
+    """Render items as an indented JSON array, one element per chunk."""
+    yield "["
+    separator = "\n  "
+    for item in items:
+        yield separator + json.dumps(item, indent=2, **kwargs).replace("\n", "\n  ")
+        separator = ",\n  "
+    yield "\n]\n"
 
 
 def load_app(app_name: str, config: _AppConfigValidator) -> BaseApp:
     logger.debug(f"Loading app {app_name} with config '{config}'")
-    module_name = f"cleanab.apps.{app_name.lower()}"
-    module = import_module(module_name)
-    return module.App(config)
+    return registry.get_module(app_name).App(config)
@@ -1,15 +1,16 @@
 import csv
 import json
+from collections.abc import Iterator
 from decimal import Decimal
-from functools import partial
+from functools import cached_property
 from io import StringIO
 
-import requests
 from logzero import logger
 from pydantic import AnyHttpUrl
 
-from ..models import AccountConfig, FintsTransaction
-from .base import BaseApp, BaseAppConfig
+from ..models import AccountConfig, TransactionRecord
+from ..utils import http_session
+from .base import AppCapabilities, BaseApp, BaseAppConfig, UploadError
 
 _firefly_iii_data_importer_base_config = {
     "version": 3,
@@ -56,6 +57,12 @@ class FireFlyIIIAppConfig(BaseAppConfig):
 
 
 class FireFlyIIIApp(BaseApp):
+    name = "firefly_iii_fidi"
+    intermediary_suffix = ".csv"
+    # Duplicates are detected by the external-id column, the CSV is rendered
+    # from a single pass over the transactions
+    capabilities = AppCapabilities(idempotent=True, streaming=True)
+
     _CSV_FIELDNAMES = [
         "account-name",
         "date_transaction",
@@ -67,14 +74,17 @@ class FireFlyIIIApp(BaseApp):
 
     def __init__(self, config: FireFlyIIIAppConfig) -> None:
         self.config = config
-        self._set_up_session()
         self._generate_config_json()
 
-    def _set_up_session(self):
-        self._post = partial(
-            requests.post,
+    @cached_property
+    def _session(self):
+        return http_session(self.config.fidi_url)
+
+    def _post(self, **kwargs):
+        return self._session.post(
             f"{str(self.config.fidi_url).rstrip('/')}/autoupload",
             params={"secret": self.config.auto_import_secret},
+            **kwargs,
         )
 
     def _generate_config_json(self):
@@ -89,21 +99,27 @@ class FireFlyIIIApp(BaseApp):
     def __str__(self):
         return f"FireFly III FIDI at {self.config.fidi_url}"
 
-    def create_intermediary(self, transactions: tuple) -> str:
-        importable = StringIO()
+    def create_intermediary(self, transactions: tuple) -> Iterator[str]:
+        row = StringIO()
         writer = csv.DictWriter(
-            importable,
+            row,
             fieldnames=self._CSV_FIELDNAMES,
             quoting=csv.QUOTE_ALL,
         )
         writer.writeheader()
-        writer.writerows(transactions)
-        return importable.getvalue()
+        yield row.getvalue()
+        for transaction in transactions:
+            row.seek(0)
+            row.truncate()
+            writer.writerow(transaction)
+            yield row.getvalue()
 
     def create_transactions(self, transactions):
         response = self._post(
             files={
-                "importable": self.create_intermediary(transactions).encode("utf-8"),
+                "importable": "".join(self.create_intermediary(transactions)).encode(
+                    "utf-8"
+                ),
                 "json": self._config_json.encode("utf-8"),
             },
             headers={
@@ -112,8 +128,7 @@ class FireFlyIIIApp(BaseApp):
             },
         )
         if not response.ok:
-            logger.error(f"Failed creating transactions: \n\n{response.text}")
-            return [], []
+            raise UploadError(f"Failed creating transactions: \n\n{response.text}")
 
         report = response.text.splitlines()
         logger.info("Received import report:")
@@ -124,20 +139,23 @@ class FireFlyIIIApp(BaseApp):
         return [], []
 
     def augment_transaction(
-        self, transaction: FintsTransaction, account: AccountConfig
+        self, transaction: TransactionRecord, account: AccountConfig
     ):
-        payee_name = transaction.applicant_name
-        if len(payee_name) > 50:
-            payee_name = payee_name[:50]
-
-        return {
-            "account-name": account.friendly_name,
-            "date_transaction": transaction.date.isoformat(),
-            "opposing-name": transaction.applicant_name or "Unnamed",
-            "description": transaction.purpose,
-            "amount": str(Decimal(transaction.amount) / 1000),
-            "external-id": transaction.import_id,
-        }
+        return self.augment_batch((transaction,), account)[0]
+
+    def augment_batch(self, transactions, account: AccountConfig):
+        account_name = account.friendly_name
+        return [
+            {
+                "account-name": account_name,
+                "date_transaction": transaction.date.isoformat(),
+                "opposing-name": transaction.applicant_name or "Unnamed",
+                "description": transaction.purpose,
+                "amount": str(Decimal(transaction.amount) / 1000),
+                "external-id": transaction.import_id,
+            }
+            for transaction in transactions
+        ]
 
 
 Config = FireFlyIIIAppConfig
@@ -0,0 +1,61 @@
+"""Lookup of app connectors by name.
+
+Built-in connectors live in `cleanab.apps`. Third-party packages can add
+connectors through the `cleanab.apps` entry point group, pointing to a module
+that defines `Config` and `App` like the built-in ones:
+
+    [project.entry-points."cleanab.apps"]
+    my_app = "my_package.cleanab_app"
+
+Modules are only imported once a connector is actually used.
+"""
+
+from importlib import import_module
+from importlib.metadata import entry_points
+from threading import Lock
+from types import ModuleType
+
+ENTRY_POINT_GROUP = "cleanab.apps"
+
+BUILTIN_APPS = {
+    "actual": "cleanab.apps.actual",
+    "firefly_iii_fidi": "cleanab.apps.firefly_iii_fidi",
+    "ynab5": "cleanab.apps.ynab5",
+}
+
+
+class AppRegistry:
+    def __init__(self, builtins=BUILTIN_APPS, group=ENTRY_POINT_GROUP):
+        self._paths = dict(builtins)
+        self._group = group
+        self._discovered = False
+        self._modules: dict[str, ModuleType] = {}
+        self._lock = Lock()
+
+    def _discover(self):
+        # Reading entry point metadata is slow, only do it for unknown names
+        if self._discovered:
+            return
+        for entry_point in entry_points(group=self._group):
+            self._paths.setdefault(entry_point.name, entry_point.value)
+        self._discovered = True
+
+    def names(self) -> list[str]:
+        with self._lock:
+            self._discover()
+            return sorted(self._paths)
+
+    def get_module(self, name: str) -> ModuleType:
+        name = name.lower()
+        with self._lock:
+            if name in self._modules:
+                return self._modules[name]
+            if name not in self._paths:
+                self._discover()
+            if name not in self._paths:
+                raise KeyError(name)
+            self._modules[name] = import_module(self._paths[name])
+            return self._modules[name]
+
+
+registry = AppRegistry()
@@ -1,13 +1,12 @@
+from collections.abc import Iterator
+from functools import cached_property
 from uuid import UUID
 
-from ynab_api.api_client import ApiClient
-from ynab_api.apis import AccountsApi, TransactionsApi
-from ynab_api.configuration import Configuration
-from ynab_api.model.save_transaction import SaveTransaction
-from ynab_api.model.save_transactions_wrapper import SaveTransactionsWrapper
+from pydantic import HttpUrl
 
-from ..models import AccountConfig, FintsTransaction
-from .base import BaseApp, BaseAppConfig
+from ..models import AccountConfig, TransactionRecord
+from ..utils import http_adapter
+from .base import AppCapabilities, BaseApp, BaseAppConfig, iter_json_array
 
 API_URL = "https://api.youneedabudget.com/v1"
 
@@ -15,30 +14,56 @@ API_URL = "https://api.youneedabudget.com/v1"
 class NewYnabConfig(BaseAppConfig):
     access_token: str
     budget_id: UUID
+    api_url: HttpUrl = HttpUrl(API_URL)
 
 
 class NewYnabApp(BaseApp):
+    name = "ynab5"
+    intermediary_suffix = ".json"
+    # YNAB allows 200 requests per hour and deduplicates by import_id
+    capabilities = AppCapabilities(rate_limit=200 / 3600, burst=200, idempotent=True)
+
     def __init__(self, config) -> None:
         self._access_token = config.access_token
         self._budget_id = str(config.budget_id)
-        self._api_client = self._create_ynab_api_client(self._access_token)
+        self._api_url = str(config.api_url).rstrip("/")
 
     def __str__(self):
         return f"YNAB Budget {self._budget_id}"
 
+    @cached_property
+    def _api_client(self):
+        # The generated YNAB client is large, only load it once it's needed
+        return self._create_ynab_api_client(self._access_token)
+
     def _create_ynab_api_client(self, access_token):
+        from ynab_api.api_client import ApiClient
+        from ynab_api.configuration import Configuration
+
         ynab_conf = Configuration(
-            host=API_URL,
+            host=self._api_url,
         )
         ynab_conf.api_key["bearer"] = access_token
         ynab_conf.api_key_prefix["bearer"] = "Bearer"
-        return ApiClient(ynab_conf)
+        client = ApiClient(ynab_conf)
+        # The token goes with every request, only the connections are shared
+        client.rest_client.pool_manager = http_adapter(self._api_url).poolmanager
+        return client
+
+    def create_intermediary(self, transactions: tuple) -> Iterator[str]:
+        return iter_json_array(transactions, default=str)
 
     def create_transactions(self, transactions):
+        from ynab_api.apis import TransactionsApi
+        from ynab_api.model.save_transaction import SaveTransaction
+        from ynab_api.model.save_transactions_wrapper import SaveTransactionsWrapper
+
         api = TransactionsApi(self._api_client)
         result = api.create_transaction(
             self._budget_id,
-            SaveTransactionsWrapper(transactions=transactions),
+            SaveTransactionsWrapper(
+                transactions=[SaveTransaction(**t) for t in transactions]
+            ),
         )
         duplicates = getattr(result.data, "duplicate_import_ids", [])
         new = getattr(result.data, "transaction_ids", [])
@@ -46,6 +71,8 @@ class NewYnabApp(BaseApp):
         return new, duplicates
 
     def get_account_balance(self, account_id):
+        from ynab_api.apis import AccountsApi
+
         api = AccountsApi(self._api_client)
         account = api.get_account_by_id(
             account_id=account_id,
@@ -54,22 +81,28 @@ class NewYnabApp(BaseApp):
         return account.data.account.balance
 
     def augment_transaction(
-        self, transaction: FintsTransaction, account: AccountConfig
+        self, transaction: TransactionRecord, account: AccountConfig
     ):
-        payee_name = transaction.applicant_name
-        if len(payee_name) > 50:
-            payee_name = payee_name[:50]
-
-        return SaveTransaction(
-            date=transaction.date,
-            amount=transaction.amount,
-            payee_name=payee_name,
-            memo=transaction.purpose,
-            import_id=transaction.import_id,
-            account_id=account.per_app_id,
-            cleared="cleared" if account.default_cleared else "uncleared",
-            approved=account.default_approved,
-        )
+        return self.augment_batch((transaction,), account)[0]
+
+    def augment_batch(self, transactions, account: AccountConfig):
+        account_id = account.per_app_id
+        cleared = "cleared" if account.default_cleared else "uncleared"
+        approved = account.default_approved
+        # Plain dicts, the SaveTransaction models are only built right before upload
+        return [
+            {
+                "date": transaction.date,
+                "amount": transaction.amount,
+                "payee_name": transaction.applicant_name[:50],
+                "memo": transaction.purpose,
+                "import_id": transaction.import_id,
+                "account_id": account_id,
+                "cleared": cleared,
+                "approved": approved,
+            }
+            for transaction in transactions
+        ]
 
 
 Config = NewYnabConfig
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from logzero import logger
+
+from .main import Cleanab
+
+
+class BatchRunner:
+    """Run several configs in one process.
+
+    Configs with identical replacement rules share one compiled FieldCleaner
+    (see `get_field_cleaner`) and app connectors share HTTP connection pools
+    per host. A failing config is logged and reported, the others carry on.
+    """
+
+    def __init__(self, configs, *, concurrency=4, **options):
+        self.configs = configs
+        self.concurrency = concurrency
+        self.options = options
+
+    def run_config(self, name, config):
+        logger.info(f"Running {name}")
+        cleanab = Cleanab(config=config, **self.options)
+        try:
+            cleanab.setup()
+            cleanab.run()
+        finally:
+            cleanab.close()
+        logger.info(f"Finished {name}")
+
+    def run(self):
+        """Run all configs and return the ones that failed, by name."""
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="config") as executor:
+            futures = {name: executor.submit(self.run_config, name, config) for name, config in self.configs}
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as exc:
+                    logger.exception(f"Running {name} failed")
+                    failed[name] = exc
+
+        logger.info(f"Ran {len(self.configs)} configs, {len(failed)} failed")
+        return failed
@@ -1,10 +1,68 @@
+import copy
 import re
+import signal
+import threading
+from contextlib import contextmanager
+from hashlib import sha256
+from itertools import count
+from multiprocessing import TimeoutError as PoolTimeout
+from multiprocessing import get_context
+from threading import Lock
+from time import perf_counter
 
 from logzero import logger
 
 from . import utils
 from .constants import FIELDS_TO_CLEAN_UP
+from .mapping import PayeeMapping
 from .models.cleaner import ReplacementDefinition
+from .rulecheck import lint_pattern
+
+
+class RuleTimeout(Exception):
+    """A replacement rule ran longer than the time budget."""
+
+
+# Compiled rules of the sandbox process
+_sandbox_cleaners: dict[ReplacementDefinition, object] = {}
+
+
+def _apply_rule(rule, value):
+    if rule not in _sandbox_cleaners:
+        _sandbox_cleaners[rule] = rule.get_cleaner()
+    return _sandbox_cleaners[rule](value)
+
+
+class RuleSandbox:
+    """Run rules in a separate process, which is killed when one exceeds its budget.
+
+    Outside the main thread no watchdog can interrupt a rule, rules that may
+    backtrack without bound run here instead.
+    """
+
+    def __init__(self):
+        self._pool = None
+        self._lock = Lock()
+
+    def apply(self, rule, value, timeout):
+        while True:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = get_context("forkserver").Pool(1)
+                pool = self._pool
+            try:
+                return pool.apply_async(_apply_rule, (rule, value)).get(timeout)
+            except PoolTimeout:
+                with self._lock:
+                    if self._pool is not pool:
+                        # Killed for another rule while this one waited, try again
+                        continue
+                    self._pool = None
+                pool.terminate()
+                raise RuleTimeout from None
+
+
+_sandbox = RuleSandbox()
 
 
 class FieldCleaner:
@@ -12,16 +70,56 @@ class FieldCleaner:
     finalizers = None
     fields = FIELDS_TO_CLEAN_UP
 
-    def __init__(self, replacements, finalizing):
+    def __init__(self, replacements, finalizing, *, time_budget=None, mappings=None, tokenize_purpose=False):
         self.cleaners = {}
         self.finalizers = {}
+        # The definitions behind self.cleaners and self.finalizers
+        self.rules = {}
+        self.finalizer_definitions = {}
+        # Seconds a single rule may take on a single value, None for no limit
+        self.time_budget = time_budget
+        # Clean only the remittance information of SEPA purposes, see prepare_fields
+        self.tokenize_purpose = tokenize_purpose
+        # (field, index) of rules rulecheck flags as backtracking without bound
+        self.risky = set()
+        self._reset_run()
 
+        mappings = mappings or {}
         for field, contents in replacements:
             logger.info(f"Compiling replacements for {field}")
-            self.cleaners[field] = self.compile_cleaners(contents)
+            self.rules[field] = self.flatten_entries(contents)
+            if field in mappings:
+                # A mapping is a rule like the others, it just runs first
+                self.rules[field].insert(0, mappings[field])
+            self.cleaners[field] = [
+                self.compile_single_cleaner(entry) for entry in self.rules[field]
+            ]
+            for index, entry in enumerate(self.rules[field]):
+                if self.lint_rule(field, entry):
+                    self.risky.add((field, index))
 
         for field, contents in finalizing:
             self.finalizers[field] = self.compile_finalizer(contents)
+            self.finalizer_definitions[field] = contents
+
+    def _reset_run(self):
+        # Rules disabled in this run, see for_run
+        self.disabled = []
+        self._disabled_rules = set()
+        self._disable_lock = Lock()
+        self._call_ids = count()
+        self._watchdog_thread = None
+        self._watchdog_seen = None
+
+    def for_run(self):
+        """A cleaner sharing the compiled rules, for a single run.
+
+        Compiled cleaners are cached per process and shared by configs, runs
+        disable rules in their own copy only.
+        """
+        run = copy.copy(self)
+        run._reset_run()
+        return run
 
     @staticmethod
     def compile_finalizer(config):
@@ -36,6 +134,19 @@ class FieldCleaner:
 
         return finalizer
 
+    @staticmethod
+    def lint_rule(field, entry):
+        """Warn about a rule that may backtrack for very long, returns whether it does."""
+        if not isinstance(entry, ReplacementDefinition) or not entry.regex:
+            return False
+        problems = lint_pattern(entry.pattern, re.IGNORECASE if entry.case_insensitive else 0)
+        if problems:
+            logger.warning(
+                f"Replacement {entry.pattern!r} for {field} may take very long on some inputs: "
+                + "; ".join(problems)
+            )
+        return bool(problems)
+
     @staticmethod
     def compile_single_cleaner(entry):
         if isinstance(entry, str):
@@ -44,17 +155,36 @@ class FieldCleaner:
         if isinstance(entry, ReplacementDefinition):
             return entry.get_cleaner()
 
+        if isinstance(entry, PayeeMapping):
+            return entry
+
         raise ValueError(f"Invalid replacement definition: {entry!r}")
 
     @staticmethod
-    def compile_cleaners(entries):
-        cleaners = []
+    def flatten_entries(entries):
+        flattened = []
         for entry in entries:
             if isinstance(entry, list):
-                cleaners += FieldCleaner.compile_cleaners(entry)
+                flattened += FieldCleaner.flatten_entries(entry)
             else:
-                cleaners.append(FieldCleaner.compile_single_cleaner(entry))
-        return cleaners
+                flattened.append(entry)
+        return flattened
+
+    @staticmethod
+    def compile_cleaners(entries):
+        return [
+            FieldCleaner.compile_single_cleaner(entry)
+            for entry in FieldCleaner.flatten_entries(entries)
+        ]
+
+    @staticmethod
+    def rule_key(entry):
+        """Stable identifier of a replacement definition, equal for equal rules."""
+        if isinstance(entry, ReplacementDefinition):
+            return "r:" + entry.model_dump_json()
+        if isinstance(entry, PayeeMapping):
+            return "m:" + entry.digest
+        return "s:" + entry
 
     def iter_valid_data_fields(self, data):
         for field in self.fields:
@@ -69,15 +199,90 @@ class FieldCleaner:
 
     def clean_field(self, field, cleaned):
         transformations = {}
-        for cleaner in self.cleaners.get(field, [])if self.cleaners else []:
+        # Rules can only be interrupted by the watchdog in its own thread,
+        # elsewhere they are timed and disabled after the fact
+        timed = self.time_budget and self._watchdog_thread != threading.get_ident()
+        # Outside the main thread no watchdog can stop them at all, rules that
+        # may backtrack without bound run in the sandbox there
+        unguarded = timed and threading.current_thread() is not threading.main_thread()
+        # Lets the watchdog tell a rule running long from two runs of it
+        _call_id = next(self._call_ids)
+        for index, cleaner in enumerate(self.cleaners.get(field, []) if self.cleaners else []):
             before_cleaning = cleaned
-            cleaned, local_transformations = cleaner(cleaned)
-            if before_cleaning != cleaned:
-                logger.debug(f"Cleaned '{before_cleaning}' => '{cleaned}'")
-            transformations.update(local_transformations)
+            if (field, index) in self._disabled_rules:
+                continue
+            try:
+                if unguarded and (field, index) in self.risky:
+                    cleaned, local_transformations = _sandbox.apply(self.rules[field][index], cleaned, self.time_budget)
+                elif timed:
+                    started = perf_counter()
+                    cleaned, local_transformations = cleaner(cleaned)
+                    if (elapsed := perf_counter() - started) > self.time_budget:
+                        self.disable_rule(field, index, before_cleaning, f"took {elapsed:.2f}s")
+                else:
+                    cleaned, local_transformations = cleaner(cleaned)
+                if before_cleaning != cleaned:
+                    logger.debug(f"Cleaned '{before_cleaning}' => '{cleaned}'")
+                transformations.update(local_transformations)
+            except RuleTimeout:
+                cleaned = before_cleaning
+                self.disable_rule(field, index, before_cleaning, f"was stopped after {self.time_budget}s")
 
         return cleaned, transformations
 
+    def disable_rule(self, field, index, value, reason):
+        """Skip a rule for the rest of this run."""
+        with self._disable_lock:
+            if (field, index) in self._disabled_rules:
+                return
+            self._disabled_rules.add((field, index))
+            rule = self.rules[field][index]
+            self.disabled.append((field, rule))
+        pattern = rule.pattern if isinstance(rule, ReplacementDefinition) else str(rule)
+        logger.error(
+            f"Disabled replacement {pattern!r} for {field} for this run, it {reason} on {value[:100]!r}"
+        )
+
+    def _on_alarm(self, signum, frame):
+        while frame is not None and frame.f_code is not FieldCleaner.clean_field.__code__:
+            frame = frame.f_back
+        if frame is None:
+            self._watchdog_seen = None
+            return
+        seen = (frame.f_locals.get("_call_id"), frame.f_locals.get("index"))
+        if seen == self._watchdog_seen:
+            # Still the same rule on the same value as one period ago
+            self._watchdog_seen = None
+            raise RuleTimeout
+        self._watchdog_seen = seen
+
+    @contextmanager
+    def watchdog(self):
+        """Interrupt rules exceeding the time budget while cleaning in this block.
+
+        Uses SIGALRM, so it only takes effect in the main thread. A rule is
+        stopped after running between one and two times the budget.
+        """
+        if (
+            not self.time_budget
+            or self._watchdog_thread is not None
+            or threading.current_thread() is not threading.main_thread()
+            or not hasattr(signal, "setitimer")
+        ):
+            yield
+            return
+
+        previous_handler = signal.signal(signal.SIGALRM, self._on_alarm)
+        self._watchdog_seen = None
+        self._watchdog_thread = threading.get_ident()
+        signal.setitimer(signal.ITIMER_REAL, self.time_budget, self.time_budget)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+            self._watchdog_thread = None
+
     def clean(self, data):
         transformations = {}
         try:
@@ -96,3 +301,35 @@ class FieldCleaner:
             raise ValueError(f"Exception for pattern {exc.pattern}") from exc
 
         return data
+
+
+_compiled_cleaners: dict[str, FieldCleaner] = {}
+_compiled_cleaners_lock = Lock()
+
+
+def get_field_cleaner(
+    replacements, finalizing, time_budget=None, mappings=None, tokenize_purpose=False
+) -> FieldCleaner:
+    """Return a FieldCleaner, reusing an existing one for identical rule sets."""
+    mapping_digests = repr(sorted((field, mapping.digest) for field, mapping in (mappings or {}).items()))
+    key = sha256(
+        (
+            replacements.model_dump_json()
+            + finalizing.model_dump_json()
+            + repr(time_budget)
+            + mapping_digests
+            + repr(tokenize_purpose)
+        ).encode("utf-8")
+    ).hexdigest()
+    with _compiled_cleaners_lock:
+        if key not in _compiled_cleaners:
+            _compiled_cleaners[key] = FieldCleaner(
+                replacements,
+                finalizing,
+                time_budget=time_budget,
+                mappings=mappings,
+                tokenize_purpose=tokenize_purpose,
+            )
+        else:
+            logger.debug("Reusing compiled replacements")
+        return _compiled_cleaners[key]
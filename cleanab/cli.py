@@ -1,25 +1,55 @@
 import logging
+from pathlib import Path
 
 import click
 import logzero
-import yaml
 
-from .models.config import Config
+from . import constants
+from .profiling import Profiler, Stopwatch
 
 logzero.__name__ = "fints"
 logzero.setup_logger(level=logging.ERROR)
 
-from cleanab.main import Cleanab  # noqa: F401, E402
 
+def load_configs(ctx):
+    """Parse the config files given with -c, once and only when a command needs them.
 
-class ConfigFile(click.File):
-    def convert(self, value, param, ctx):
-        value = super().convert(value, param, ctx)
-        value = yaml.safe_load(value)
-        return Config.model_validate(value)
+    Loading them in the option itself would make --help of every command fail
+    without a config file.
+    """
+    if "cleanab.configs" in ctx.meta:
+        return ctx.meta["cleanab.configs"]
 
+    # Imported here so --help does not have to load pydantic and the models
+    from .models.config import load_config
 
-@click.command()
+    configs = []
+    for path in ctx.find_root().params["configs"]:
+        stopwatch = Stopwatch()
+        try:
+            with click.open_file(path) as f:
+                content = f.read()
+        except OSError as exc:
+            raise click.FileError(path, hint=exc.strerror) from None
+        # Read from stdin, relative paths stay relative to the working directory
+        base_dir = None if path == "-" else Path(path).parent
+        configs.append(load_config(content, base_dir))
+        ctx.meta.setdefault("cleanab.config_load", []).append(stopwatch.elapsed())
+    ctx.meta["cleanab.configs"] = configs
+    return configs
+
+
+def selected_accounts(ctx, config):
+    """Accounts of `config` matching the --account and --bank filters."""
+    from .models import select_accounts
+
+    accounts = select_accounts(config.accounts, ctx.obj["account_filters"], ctx.obj["bank_filters"])
+    if not accounts:
+        raise click.ClickException("No account matches the --account and --bank filters")
+    return accounts
+
+
+@click.group(invoke_without_command=True)
 @click.option(
     "-n",
     "--dry-run",
@@ -51,23 +81,364 @@ class ConfigFile(click.File):
         " --verbose)"
     ),
 )
+@click.option(
+    "-i",
+    "--intermediary",
+    type=click.Choice(["file", "stdout"]),
+    default=None,
+    help=(
+        "In dry-run mode, render the payload each app would receive. 'file' writes"
+        " one file per app to the cache directory, 'stdout' prints it."
+    ),
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help=(
+        "Clean transactions in this many worker processes. Useful for large"
+        " backfills, the output order stays the same."
+    ),
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help=(
+        "Download the transactions of every account, even if its balance did not change"
+        " or its refresh interval has not passed."
+    ),
+)
+@click.option(
+    "--account",
+    "account_filters",
+    multiple=True,
+    help=(
+        "Only work on the account with this IBAN, name or app id. Can be given multiple"
+        " times."
+    ),
+)
+@click.option(
+    "--bank",
+    "bank_filters",
+    multiple=True,
+    help=(
+        "Only work on accounts at the bank with this BLZ or FinTS server host. Can be"
+        " given multiple times."
+    ),
+)
 @click.option(
     "-v",
     "--verbose",
     is_flag=True,
     help="Show replacements made to the received data",
 )
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Print wall and CPU time per stage and the peak memory usage after the run.",
+)
+@click.option(
+    "--profile-dump",
+    type=click.Path(file_okay=False, writable=True),
+    default=None,
+    help=(
+        "Write a JSON timing report and a cProfile .pstats dump of the run to this"
+        " directory. (implies --profile)"
+    ),
+)
 @click.option(
     "-c",
     "--config",
-    "config",
-    type=ConfigFile("r"),
-    default="./config.yaml",
+    "configs",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    multiple=True,
+    default=["./config.yaml"],
     show_default=True,
-    help="Custom location of the config file.",
+    help=(
+        "Custom location of the config file. Can be given multiple times to run"
+        " several configs in one process."
+    ),
     metavar="configfile",
 )
-def cli(**kwargs):
-    c = Cleanab(**kwargs)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="With multiple configs, how many of them are run at the same time.",
+)
+@click.pass_context
+def cli(ctx, profile, profile_dump, configs, concurrency, **kwargs):
+    """Fetch transactions, clean them up and add them to your budgeting apps.
+
+    Without a command, all accounts are synced once.
+    """
+    ctx.obj = kwargs
+    if ctx.invoked_subcommand is not None:
+        return
+
+    config_paths = configs
+    configs = load_configs(ctx)
+    profiler = Profiler(cprofile=bool(profile_dump))
+    for config_load in ctx.meta.get("cleanab.config_load", []):
+        profiler.record("config load", *config_load)
+
+    profiler.start()
+    try:
+        if len(configs) > 1:
+            from .batch import BatchRunner
+
+            failed = BatchRunner(
+                list(zip(config_paths, configs)),
+                concurrency=concurrency,
+                profiler=profiler,
+                **kwargs,
+            ).run()
+            if failed:
+                ctx.exit(1)
+        else:
+            from .locks import LockTimeout
+            from .main import Cleanab
+
+            c = Cleanab(config=configs[0], profiler=profiler, **kwargs)
+            c.setup()
+            try:
+                c.run()
+            except LockTimeout as exc:
+                raise click.ClickException(str(exc))
+            finally:
+                c.close()
+    finally:
+        profiler.stop()
+
+    if profile or profile_dump:
+        click.echo(profiler.summary(), err=True)
+    if profile_dump:
+        for filename in profiler.write_dumps(profile_dump):
+            click.echo(f"Wrote {filename}", err=True)
+
+
+@cli.command()
+@click.option(
+    "--interval",
+    type=click.IntRange(min=1),
+    default=3600,
+    show_default=True,
+    help="Seconds between syncs of an account.",
+)
+@click.option(
+    "--jitter",
+    type=click.IntRange(min=0),
+    default=300,
+    show_default=True,
+    help="Up to this many seconds are randomly added to each interval.",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help=(
+        "Control socket accepting 'sync [ACCOUNT]', 'reload', 'status' and 'stop'."
+        " Defaults to cleanab.sock in the cache directory."
+    ),
+)
+@click.pass_context
+def serve(ctx, interval, jitter, socket_path):
+    """Run as a daemon and keep syncing accounts on a schedule."""
+    from .daemon import DEFAULT_SOCKET, Daemon
+
+    config_paths = ctx.parent.params["configs"]
+    if len(config_paths) != 1 or config_paths[0] == "-":
+        raise click.UsageError("serve needs exactly one config file it can reload")
+
+    Daemon(
+        config_paths[0],
+        interval=interval,
+        jitter=jitter,
+        socket_path=socket_path or DEFAULT_SOCKET,
+        **ctx.obj,
+    ).serve_forever()
+
+
+@cli.command()
+@click.option(
+    "--limit",
+    type=click.IntRange(min=0),
+    default=50,
+    show_default=True,
+    help="Show at most this many changes per account. 0 shows all.",
+)
+@click.pass_context
+def reclean(ctx, limit):
+    """Re-clean cached transactions after editing the replacement rules.
+
+    Uses the raw transactions cached by the last run (see --test) and only
+    recomputes transactions affected by added, removed or changed rules, then
+    shows how their cleaned values changed.
+    """
+    from .cleaner import get_field_cleaner
+    from .mapping import load_mappings
+    from .reclean import Recleaner, read_state, write_state
+
+    if len(ctx.parent.params["configs"]) != 1:
+        raise click.UsageError("reclean works on exactly one config file")
+    config = load_configs(ctx)[0]
+
+    stopwatch = Stopwatch()
+    recleaner = Recleaner(
+        get_field_cleaner(
+            config.replacements,
+            config.finalizer,
+            mappings=load_mappings(config.mappings),
+            tokenize_purpose=config.cleanab.tokenize_purpose,
+        )
+    )
+    for account in selected_accounts(ctx, config):
+        if not account.has_account_cache:
+            click.echo(f"{account}: no cached transactions, run with --test first", err=True)
+            continue
+
+        state = read_state(account)
+        state, changes, recomputed = recleaner.reclean(account.read_account_cache(), state)
+        write_state(account, state)
+
+        click.secho(
+            f"{account}: {len(state['entries'])} transactions, {recomputed} re-cleaned, {len(changes)} changed",
+            bold=True,
+        )
+        for change in changes[: limit or None]:
+            entry = change.entry
+            for field, before, after in zip(("applicant_name", "purpose"), change.before, change.after):
+                if before == after:
+                    continue
+                click.echo(f"  {entry.date} {entry.amount / 1000:>10.2f} {field:>14}: ", nl=False)
+                click.secho(before, fg="red", nl=False)
+                click.echo(" -> ", nl=False)
+                click.secho(after, fg="green")
+        if limit and len(changes) > limit:
+            click.echo(f"  … and {len(changes) - limit} more")
+
+    click.echo(f"Done in {stopwatch.elapsed()[0]:.2f}s", err=True)
+
+
+@cli.command("import")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Parse this many statement files at the same time.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Clean and upload this many transactions of an account at a time.",
+)
+@click.pass_context
+def import_statements(ctx, paths, jobs, batch_size):
+    """Import MT940 or CAMT.053 statement files instead of fetching from the bank.
+
+    PATHS are files or directories of files. Transactions are assigned to the
+    configured accounts by the IBAN (or BLZ and account number) in the
+    statements, then cleaned and uploaded like fetched ones.
+    """
+    from .main import Cleanab
+    from .statements import iter_statements
+
+    if len(ctx.parent.params["configs"]) != 1:
+        raise click.UsageError("import works on exactly one config file")
+
+    stopwatch = Stopwatch()
+    c = Cleanab(config=load_configs(ctx)[0], **ctx.obj)
     c.setup()
-    c.run()
+    try:
+        c.import_statements(iter_statements(paths, jobs=jobs), batch_size=batch_size)
+    finally:
+        c.close()
+    click.echo(f"Done in {stopwatch.elapsed()[0]:.2f}s", err=True)
+
+
+@cli.command("suggest-rules")
+@click.option(
+    "-f",
+    "--field",
+    "fields",
+    type=click.Choice(constants.FIELDS_TO_CLEAN_UP),
+    multiple=True,
+    default=["applicant_name"],
+    show_default=True,
+    help="Fields to suggest rules for, can be given multiple times.",
+)
+@click.option(
+    "--threshold",
+    type=click.FloatRange(0, 1),
+    default=0.6,
+    show_default=True,
+    help="How similar values must be to end up in one rule, by the 3-grams they share.",
+)
+@click.option(
+    "--limit",
+    type=click.IntRange(min=0),
+    default=20,
+    show_default=True,
+    help="Show at most this many rules. 0 shows all.",
+)
+@click.pass_context
+def suggest_rules(ctx, fields, threshold, limit):
+    """Suggest replacement rules from cached transactions.
+
+    Clusters similar values left over by the current rules in the raw
+    transactions cached by --test runs, and prints a rule per cluster, the
+    ones cleaning the most transactions first. Needs numpy
+    (pip install cleanab[suggest]).
+    """
+    import yaml
+
+    from .cleaner import get_field_cleaner
+    from .mapping import load_mappings
+
+    try:
+        from .suggest import suggest_rules
+    except ImportError as exc:
+        if exc.name != "numpy":
+            raise
+        raise click.ClickException("suggest-rules needs numpy, install cleanab[suggest]") from None
+
+    if len(ctx.parent.params["configs"]) != 1:
+        raise click.UsageError("suggest-rules works on exactly one config file")
+    config = load_configs(ctx)[0]
+
+    raw_transactions = []
+    for account in selected_accounts(ctx, config):
+        if account.has_account_cache:
+            raw_transactions += account.read_account_cache()
+        else:
+            click.echo(f"{account}: no cached transactions, run with --test first", err=True)
+
+    stopwatch = Stopwatch()
+    cleaner = get_field_cleaner(
+        config.replacements,
+        config.finalizer,
+        mappings=load_mappings(config.mappings),
+        tokenize_purpose=config.cleanab.tokenize_purpose,
+    )
+    suggestions = suggest_rules(raw_transactions, cleaner, fields, threshold=threshold)
+    for suggestion in suggestions[: limit or None]:
+        click.echo(f"# {suggestion.field}: {suggestion.transactions} transactions, e.g. {suggestion.values[:3]}")
+        rule = suggestion.rule.model_dump(include={"pattern", "repl"})
+        click.echo(yaml.safe_dump([rule], allow_unicode=True, sort_keys=False), nl=False)
+    if limit and len(suggestions) > limit:
+        click.echo(f"# … and {len(suggestions) - limit} more")
+
+    click.echo(f"Suggested {len(suggestions)} rules in {stopwatch.elapsed()[0]:.2f}s", err=True)
+
+
+def main():
+    cli(auto_envvar_prefix=constants.ENV_PREFIX)
@@ -0,0 +1,227 @@
+import heapq
+import os
+import queue
+import random
+import signal
+import socketserver
+import threading
+import time
+from pathlib import Path
+
+from logzero import logger
+
+from .main import Cleanab
+from .models.config import load_config
+from .state import load_state
+from .utils import CACHE_HOME
+
+DEFAULT_SOCKET = CACHE_HOME / "cleanab.sock"
+CONFIG_POLL_INTERVAL = 5
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    """Line based control protocol: `sync [ACCOUNT]`, `reload`, `status`, `stop`."""
+
+    def handle(self):
+        line = self.rfile.readline().decode("utf-8").strip()
+        if not line:
+            return
+        command, _, argument = line.partition(" ")
+        reply = self.server.daemon.handle_command(command.lower(), argument.strip())
+        self.wfile.write(f"{reply}\n".encode("utf-8"))
+
+
+class _ControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        super().__init__(str(path), _ControlHandler)
+
+
+class Daemon:
+    """Keep a Cleanab instance warm and sync its accounts on a schedule.
+
+    The compiled cleaner, the app connections and the FinTS clients (cached
+    per login in `cleanab.fints`) are reused between syncs. The config file is
+    reloaded when it changes on disk. Failed uploads are retried from the
+    outbox as soon as their backoff expired.
+    """
+
+    def __init__(self, config_path, *, interval, jitter, socket_path=DEFAULT_SOCKET, **options):
+        self.config_path = Path(config_path)
+        self.interval = interval
+        self.jitter = jitter
+        self.socket_path = Path(socket_path) if socket_path else None
+        self.options = options
+
+        self.cleanab: Cleanab | None = None
+        self._config_mtime = None
+        self._schedule: list[tuple[float, int, str]] = []
+        self._sequence = iter(range(2**63))
+        self._accounts = {}
+        self._commands = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def account_key(account):
+        return f"{account.iban}:{account.per_app_id}"
+
+    def interval_of(self, account):
+        return account.refresh_interval or self.interval
+
+    def _next_run(self, now, account):
+        return now + self.interval_of(account) + random.uniform(0, self.jitter)
+
+    def schedule(self, key, when):
+        # The counter keeps heap entries comparable if two accounts are due at once
+        heapq.heappush(self._schedule, (when, next(self._sequence), key))
+
+    def load(self):
+        config = load_config(self.config_path.read_text(), self.config_path.parent)
+        cleanab = Cleanab(config=config, **self.options)
+        cleanab.setup()
+
+        with self._lock:
+            if self.cleanab:
+                self.cleanab.close()
+            self.cleanab = cleanab
+            self._config_mtime = self.config_path.stat().st_mtime_ns
+
+            previous = {key: when for when, _, key in self._schedule}
+            self._accounts = {self.account_key(a): a for a in cleanab.accounts}
+            self._schedule = []
+            now = time.time()
+            for key, account in self._accounts.items():
+                if key not in previous:
+                    # Spread the initial syncs a bit so not all banks are hit at once,
+                    # and leave accounts synced recently by an earlier process alone
+                    last_sync = load_state(account).checked_at
+                    previous[key] = max(now + random.uniform(0, self.jitter), last_sync + self.interval_of(account))
+                self.schedule(key, previous[key])
+        logger.info(f"Loaded {self.config_path} with {len(self._accounts)} accounts")
+
+    def reload_if_changed(self):
+        try:
+            mtime = self.config_path.stat().st_mtime_ns
+        except OSError as exc:
+            logger.error(f"Cannot access {self.config_path}: {exc}")
+            return
+        if mtime == self._config_mtime:
+            return
+        logger.info(f"{self.config_path} changed, reloading")
+        try:
+            self.load()
+        except Exception:
+            # Keep running with the previous config until the file is fixed
+            logger.exception("Reloading the config failed")
+            self._config_mtime = mtime
+
+    def handle_command(self, command, argument):
+        if command == "sync":
+            self._commands.put(("sync", argument or None))
+            return "queued"
+        if command == "reload":
+            self._commands.put(("reload", None))
+            return "queued"
+        if command == "status":
+            with self._lock:
+                now = time.time()
+                return "\n".join(
+                    f"{self._accounts[key]}: next sync in {max(0, when - now):.0f}s"
+                    for when, _, key in sorted(self._schedule)
+                )
+        if command == "stop":
+            self.stop()
+            return "stopping"
+        return f"unknown command {command!r}"
+
+    def due_accounts(self, now, forced=()):
+        due = set(forced)
+        while self._schedule and self._schedule[0][0] <= now:
+            due.add(heapq.heappop(self._schedule)[2])
+        if not due:
+            return []
+        # Forced accounts also have a regular entry that needs to be replaced
+        self._schedule = [entry for entry in self._schedule if entry[2] not in due]
+        heapq.heapify(self._schedule)
+        for key in due:
+            self.schedule(key, self._next_run(now, self._accounts[key]))
+        return [account for key, account in self._accounts.items() if key in due]
+
+    def match_accounts(self, selector):
+        if not selector:
+            return list(self._accounts)
+        return [key for key, account in self._accounts.items() if account.matches(selector)]
+
+    def sync(self, accounts):
+        logger.info(f"Syncing {len(accounts)} account(s)")
+        try:
+            # Accounts are scheduled by their refresh interval here already
+            self.cleanab.run(accounts=accounts, due_only=False)
+        except Exception:
+            logger.exception("Sync failed")
+
+    def retry_uploads(self):
+        # Only touches the apps whose backoff has expired
+        try:
+            self.cleanab.drain_outboxes()
+        except Exception:
+            logger.exception("Retrying uploads failed")
+
+    def _wait_for_command(self):
+        timeout = CONFIG_POLL_INTERVAL
+        if self._schedule:
+            timeout = min(timeout, max(0.0, self._schedule[0][0] - time.time()))
+        try:
+            return self._commands.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def serve_forever(self):
+        self.load()
+        server = self._start_control_server()
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        try:
+            while not self._stopped.is_set():
+                forced = []
+                command = self._wait_for_command()
+                if command and command[0] == "sync":
+                    forced = self.match_accounts(command[1])
+                    if not forced:
+                        logger.warning(f"No account matches {command[1]!r}")
+                elif command and command[0] == "reload":
+                    self._config_mtime = None
+
+                self.reload_if_changed()
+                with self._lock:
+                    accounts = self.due_accounts(time.time(), forced)
+                if accounts:
+                    self.sync(accounts)
+                self.retry_uploads()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info("Shutting down")
+            if server:
+                server.shutdown()
+                server.server_close()
+                self.socket_path.unlink(missing_ok=True)
+            if self.cleanab:
+                self.cleanab.close()
+
+    def stop(self):
+        self._stopped.set()
+        self._commands.put(("stop", None))
+
+    def _start_control_server(self):
+        if not self.socket_path:
+            return None
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        self.socket_path.unlink(missing_ok=True)
+        server = _ControlServer(self.socket_path, self)
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=server.serve_forever, name="control", daemon=True).start()
+        logger.info(f"Listening for commands on {self.socket_path}")
+        return server
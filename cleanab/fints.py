@@ -1,34 +1,53 @@
 from __future__ import annotations
 
-import time
-from functools import lru_cache
-from io import BytesIO
-from multiprocessing import Lock
+from datetime import date
+from threading import Lock, RLock
 
 from fints.client import FinTS3PinTanClient, FinTSClientError, NeedTANResponse
-from fints.hhd.flicker import terminal_flicker_unix
 from logzero import logger
-from PIL import Image
 
+from . import locks
 from .models.enums import AccountType
+from .tan import TanBroker, TanChallenge, TerminalChannel
 
-lock = Lock()
+# A FinTS dialog is not thread-safe: one lock per login, different logins
+# can talk to their banks at the same time
+_login_locks: dict[tuple, RLock] = {}
+_clients: dict[tuple, tuple] = {}
+_registry_lock = Lock()
+_default_broker = None
 
 
-def bootstrap_fints(fints: FinTS3PinTanClient):
+def default_tan_broker() -> TanBroker:
+    global _default_broker
+    with _registry_lock:
+        if _default_broker is None:
+            _default_broker = TanBroker(TerminalChannel())
+        return _default_broker
+
+
+def login_lock(key) -> RLock:
+    with _registry_lock:
+        return _login_locks.setdefault(key, RLock())
+
+
+def _source(fints: FinTS3PinTanClient):
+    return f"{fints.user_id}@{fints.bank_identifier.bank_code}"
+
+
+def bootstrap_fints(fints: FinTS3PinTanClient, tan_broker: TanBroker):
     # Fetch available TAN mechanisms by the bank, if we don't know it already.
     # If the client was created with cached data, the function is already set.
     if not fints.get_current_tan_mechanism():
         fints.fetch_tan_mechanisms()
         mechanisms = list(fints.get_tan_mechanisms().items())
         if len(mechanisms) > 1:
-            logger.info("Multiple tan mechanisms available. Which one do you prefer?")
-            for i, m in enumerate(mechanisms):
-                logger.info(
-                    i, f"Function {m[1].security_function}: {m[1].name}"
-                )
-            choice = input("Choice: ").strip()
-            fints.set_tan_mechanism(mechanisms[int(choice)][0])
+            choice = tan_broker.choose(
+                _source(fints),
+                "Multiple tan mechanisms available. Which one do you prefer?",
+                [f"Function {m[1].security_function}: {m[1].name}" for m in mechanisms],
+            )
+            fints.set_tan_mechanism(mechanisms[choice][0])
 
     if fints.is_tan_media_required() and not fints.selected_tan_medium:
         logger.info(
@@ -41,44 +60,38 @@ def bootstrap_fints(fints: FinTS3PinTanClient):
         elif len(tan_media[1]) == 1:
             fints.set_tan_medium(tan_media[1][0])
         else:
-            logger.info("Multiple tan media available. Which one do you prefer?")
-            for i, tan_medium in enumerate(tan_media[1]):
-                logger.info(
-                    i,
+            choice = tan_broker.choose(
+                _source(fints),
+                "Multiple tan media available. Which one do you prefer?",
+                [
                     f"Medium {tan_medium.tan_medium_name}: Phone no. {tan_medium.mobile_number_masked}, "
-                    f"Last used {tan_medium.last_use}",
-                )
-            choice = input("Choice: ").strip()
-            fints.set_tan_medium(tan_media[1][int(choice)])
+                    f"Last used {tan_medium.last_use}"
+                    for tan_medium in tan_media[1]
+                ],
+            )
+            fints.set_tan_medium(tan_media[1][choice])
 
 
 def handle_tan_response(
-    fints: FinTS3PinTanClient, tan_response: NeedTANResponse
+    fints: FinTS3PinTanClient, tan_response: NeedTANResponse, tan_broker: TanBroker
 ) -> list:
     logger.info(f"TAN needed: {tan_response.challenge}")
 
-    if tan_response.challenge_hhduc:
-        logger.info("Please use your TAN generator to generate a TAN.")
-        try:
-            terminal_flicker_unix(tan_response.challenge_hhduc)
-        except KeyboardInterrupt:
-            pass
-    elif tan_response.challenge_matrix:
-        logger.info("Please use your bank's app to scan the QR code.")
-        image_bytes = BytesIO(tan_response.challenge_matrix[1])
-        Image.open(image_bytes).show()
-        # Sleep a bit to give whatever application PIL uses to display the image time to start
-        time.sleep(5)
-    else:
-        logger.info(tan_response.challenge_html)
-
-    tan: str = input("Please enter the TAN: ")
+    # Waits for the answer, other logins carry on meanwhile
+    tan = tan_broker.request(
+        TanChallenge(
+            _source(fints),
+            tan_response.challenge_html or tan_response.challenge or "Please enter the TAN",
+            hhduc=tan_response.challenge_hhduc,
+            matrix=tan_response.challenge_matrix,
+        )
+    )
 
     try:
         response = fints.send_tan(tan_response, tan)
         if isinstance(response, NeedTANResponse):
             logger.error("TAN was not accepted, please try again.")
-            return handle_tan_response(fints, response)
+            return handle_tan_response(fints, response, tan_broker)
         else:
             logger.info("TAN accepted, proceeding with the request.")
             return response
@@ -88,29 +101,47 @@ def handle_tan_response(
 
 
 def retrieve_transactions(
-    sepa_account, fints: FinTS3PinTanClient, *, start_date, end_date
+    sepa_account, fints: FinTS3PinTanClient, tan_broker: TanBroker, *, start_date, end_date
 ):
     with fints:
-        bootstrap_fints(fints)
+        bootstrap_fints(fints, tan_broker)
         result = fints.get_transactions(
             sepa_account, start_date=start_date, end_date=end_date
         )
         if isinstance(result, NeedTANResponse):
-            result = handle_tan_response(fints, result)
+            result = handle_tan_response(fints, result, tan_broker)
     return [t.data for t in result]
 
 
-def retrieve_holdings(sepa_account, fints: FinTS3PinTanClient):
-    with lock:
-        bootstrap_fints(fints)
+def retrieve_holdings(sepa_account, fints: FinTS3PinTanClient, tan_broker: TanBroker):
+    with fints:
+        bootstrap_fints(fints, tan_broker)
         holdings = fints.get_holdings(sepa_account)
         if isinstance(holdings, NeedTANResponse):
-            holdings = handle_tan_response(fints, holdings)
+            holdings = handle_tan_response(fints, holdings, tan_broker)
     return [{"total_value": h.total_value} for h in holdings]
 
 
-@lru_cache(maxsize=8)
-def get_fints_client(blz, username, password, endpoint, product_id):
+def retrieve_balance(sepa_account, fints: FinTS3PinTanClient, tan_broker: TanBroker) -> tuple[str, date | None]:
+    """Booked balance as e.g. "1234.56 EUR" and the date the bank reports it for."""
+    with fints:
+        bootstrap_fints(fints, tan_broker)
+        balance = fints.get_balance(sepa_account)
+        if isinstance(balance, NeedTANResponse):
+            balance = handle_tan_response(fints, balance, tan_broker)
+    return f"{balance.amount.amount} {balance.amount.currency}", getattr(balance, "date", None)
+
+
+def get_fints_client(blz, username, password, endpoint, product_id, tan_broker: TanBroker):
+    """Return the client and SEPA accounts of a login, set up once per process."""
+    key = (blz, username, password, endpoint, product_id)
+    with login_lock(key):
+        if key not in _clients:
+            _clients[key] = _create_fints_client(*key, tan_broker)
+        return _clients[key]
+
+
+def _create_fints_client(blz, username, password, endpoint, product_id, tan_broker: TanBroker):
     logger.info(
         "Retrieving SEPA accounts for %s from %s (product id=%s)",
         username,
@@ -124,42 +155,74 @@ def get_fints_client(blz, username, password, endpoint, product_id):
         server=endpoint,
         product_id=product_id,
     )
-    with lock:
-        with fints:
-            # Bootstrap the client to set up TAN mechanisms
-            bootstrap_fints(fints)
+    with fints:
+        # Bootstrap the client to set up TAN mechanisms
+        bootstrap_fints(fints, tan_broker)
 
-            # Handle potential TAN requirement for dialog initialization
-            while isinstance(fints.init_tan_response, NeedTANResponse):
-                handle_tan_response(fints, fints.init_tan_response)
+        # Handle potential TAN requirement for dialog initialization
+        while isinstance(fints.init_tan_response, NeedTANResponse):
+            handle_tan_response(fints, fints.init_tan_response, tan_broker)
 
-            # Get SEPA accounts and handle potential TAN requirement
-            sepa_accounts = fints.get_sepa_accounts()
-            while isinstance(sepa_accounts, NeedTANResponse):
-                sepa_accounts = handle_tan_response(fints, sepa_accounts)
+        # Get SEPA accounts and handle potential TAN requirement
+        sepa_accounts = fints.get_sepa_accounts()
+        while isinstance(sepa_accounts, NeedTANResponse):
+            sepa_accounts = handle_tan_response(fints, sepa_accounts, tan_broker)
 
     return fints, sepa_accounts
 
 
-def process_fints_account(account, earliest, latest, product_id) -> list:
-    fints, sepa_accounts = get_fints_client(
+def _login(account, product_id):
+    return (
         account.fints_blz,
         account.fints_username,
         account.fints_password,
         account.fints_endpoint,
         product_id,
     )
+
+
+def _find_sepa_account(account, sepa_accounts):
     accounts = [acc for acc in sepa_accounts if acc.iban == account.iban]
     if not accounts:
         logger.error(f"Account for IBAN {account.iban} not found")
-        return []
-    sepa_account = accounts[0]
+        return None
+    return accounts[0]
 
-    if account.account_type == AccountType.HOLDING:
-        transactions = retrieve_holdings(sepa_account, fints)
-    else:
-        transactions = retrieve_transactions(
-            sepa_account, fints, start_date=earliest, end_date=latest
-        )
+
+def _login_file_lock(account):
+    return locks.login_lock(account.fints_blz, account.fints_username, account.fints_endpoint)
+
+
+def probe_fints_balance(
+    account, product_id, tan_broker: TanBroker | None = None, lock_timeout=None
+) -> tuple[str, date | None] | None:
+    """Current booked balance of the account and its date, much cheaper than downloading the statement."""
+    tan_broker = tan_broker or default_tan_broker()
+    key = _login(account, product_id)
+    with login_lock(key), _login_file_lock(account).hold(lock_timeout):
+        fints, sepa_accounts = get_fints_client(*key, tan_broker)
+        if (sepa_account := _find_sepa_account(account, sepa_accounts)) is None:
+            return None
+        return retrieve_balance(sepa_account, fints, tan_broker)
+
+
+def process_fints_account(
+    account, earliest, latest, product_id, tan_broker: TanBroker | None = None, lock_timeout=None
+) -> list:
+    tan_broker = tan_broker or default_tan_broker()
+    key = _login(account, product_id)
+    # Accounts of the same login wait for each other, including their TANs,
+    # also across processes
+    with login_lock(key), _login_file_lock(account).hold(lock_timeout):
+        fints, sepa_accounts = get_fints_client(*key, tan_broker)
+        if (sepa_account := _find_sepa_account(account, sepa_accounts)) is None:
+            return []
+
+        if account.account_type == AccountType.HOLDING:
+            transactions = retrieve_holdings(sepa_account, fints, tan_broker)
+        else:
+            transactions = retrieve_transactions(
+                sepa_account, fints, tan_broker, start_date=earliest, end_date=latest
+            )
 
     return transactions
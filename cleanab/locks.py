@@ -0,0 +1,119 @@
+"""Locks shared by all cleanab processes using the same cache directory.
+
+Lock files live in `locks/` in the cache directory and are held with
+`flock`, so a crashed process never leaves a stale lock behind. There are
+four kinds:
+
+- a run lock per set of accounts, so an overlapping run of the same config
+  either waits for the earlier one or leaves the outboxes to it
+- a lock per account, held from fetching until its state is saved
+- a lock per bank login, a FinTS dialog must not be used by two processes
+- a lock per outbox, drained by one process at a time
+"""
+
+import fcntl
+import os
+import time
+from hashlib import sha256
+
+from logzero import logger
+
+from .utils import CACHE_HOME
+
+LOCK_DIR = CACHE_HOME / "locks"
+# Longest pause between two attempts to take a lock
+MAX_POLL_INTERVAL = 1.0
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class FileLock:
+    def __init__(self, name, description=None):
+        self.path = LOCK_DIR / f"{name}.lock"
+        self.description = description or name
+        self._fd = None
+
+    def __str__(self):
+        return f"lock of {self.description}"
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def holder(self):
+        """PID of the process that last took the lock."""
+        try:
+            return self.path.read_text().strip() or None
+        except OSError:
+            return None
+
+    def acquire(self, timeout=None) -> bool:
+        """Take the lock, waiting up to `timeout` seconds (forever for None, not at all for 0)."""
+        LOCK_DIR.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = 0.05
+        logged = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    os.close(fd)
+                    return False
+                if not logged:
+                    logger.info(f"Waiting for the {self}, held by process {self.holder()}")
+                    logged = True
+                time.sleep(interval if remaining is None else min(interval, remaining))
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        # Lock files are never removed, another process may be waiting on this one
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def hold(self, timeout=None):
+        """Take the lock or raise `LockTimeout`, for use in a with statement."""
+        if not self.acquire(timeout):
+            raise LockTimeout(f"Gave up waiting for the {self}, held by process {self.holder()}")
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _name(kind, *parts):
+    return f"{kind}-" + sha256("\0".join(map(str, parts)).encode("utf-8")).hexdigest()[:16]
+
+
+def run_lock(accounts) -> FileLock:
+    keys = sorted(f"{account.iban}:{account.per_app_id}" for account in accounts)
+    return FileLock(_name("run", *keys), "this run's accounts")
+
+
+def account_lock(account) -> FileLock:
+    return FileLock(_name("account", account.iban, account.per_app_id), str(account))
+
+
+def login_lock(blz, username, endpoint) -> FileLock:
+    # Hashed, lock files should not reveal who banks where
+    return FileLock(_name("login", blz, username, endpoint), f"login {username}@{blz}")
+
+
+def outbox_lock(directory) -> FileLock:
+    return FileLock(_name("outbox", directory), f"outbox {directory.name}")
@@ -1,29 +1,70 @@
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import date, timedelta
-from itertools import chain
 
 from logzero import logger
 
 from cleanab.models.config import Config
 
-from .cleaner import FieldCleaner
-from .fints import process_fints_account
+from .cleaner import get_field_cleaner
 from .holdings import process_holdings
-from .models import AccountConfig
+from .locks import FileLock, LockTimeout, account_lock, run_lock
+from .mapping import load_mappings
+from .metrics import RunMetrics
+from .models import AccountConfig, select_accounts
 from .models.enums import AccountType
+from .profiling import Profiler, Stopwatch
+from .state import AccountState, config_fingerprint, fingerprint, load_state, save_state
+from .tan import create_broker
 from .transactions import process_transaction
+from .upload import UploadScheduler
+from .utils import CACHE_HOME
 
-TODAY = date.today()
+OUTCOMES = ("synced", "unchanged", "deferred", "skipped", "failed")
 
 
 class Cleanab:
     def __init__(
-        self, *, config: Config, dry_run=False, test=False, verbose=False, save=False
+        self,
+        *,
+        config: Config,
+        dry_run=False,
+        test=False,
+        verbose=False,
+        save=False,
+        intermediary=None,
+        workers=1,
+        full=False,
+        account_filters=(),
+        bank_filters=(),
+        profiler: Profiler | None = None,
     ):
         self.config = config
         self.dry_run = dry_run
         self.test = test
         self.verbose = verbose
         self.save = save
+        self.intermediary = intermediary
+        self.workers = workers
+        self.full = full
+        self.account_filters = account_filters
+        self.bank_filters = bank_filters
+        # Whether the current run skips accounts whose refresh interval has not passed
+        self.due_only = True
+        self.cleaning_pool = None
+        self.profiler = profiler or Profiler()
+        self.uploader = UploadScheduler(self.profiler)
+        self.metrics = RunMetrics()
+        self.tan_broker = None
+        # New state per account, saved once its transactions are queued for upload
+        self._states: dict[AccountConfig, AccountState] = {}
+        # How each account of the current run ended: synced, unchanged, failed, …
+        self.outcomes: dict[AccountConfig, str] = {}
+        # Held from fetching an account until its state is saved
+        self._account_locks: dict[AccountConfig, FileLock] = {}
 
         if self.test:
             self.dry_run = True
@@ -33,42 +74,203 @@ class Cleanab:
         self.config.load_apps()
 
     def setup(self):
-        self.setup_app_connections()
+        with self.profiler.stage("app setup"):
+            self.setup_app_connections()
         for app in self.config.apps.keys():
             logger.info(f"Loaded App {app}")
-        self.accounts = self.config.accounts
+        self.accounts = select_accounts(self.config.accounts, self.account_filters, self.bank_filters)
+        self.config_fingerprint = config_fingerprint(self.config)
+        self.tan_broker = create_broker(self.config.cleanab.tan)
         logger.debug("Creating field cleaner instance")
-        self.cleaner = FieldCleaner(
-            self.config.replacements,
-            self.config.finalizer,
-        )
+        with self.profiler.stage("cleaner setup"):
+            mappings = load_mappings(self.config.mappings)
+            # Shared with other configs using the same rules, see start_cleaning_run
+            self.compiled_cleaner = get_field_cleaner(
+                self.config.replacements,
+                self.config.finalizer,
+                self.config.cleanab.rule_time_budget,
+                mappings,
+                self.config.cleanab.tokenize_purpose,
+            )
+            if self.workers > 1:
+                from .parallel import CleaningPool
+
+                logger.debug(f"Starting {self.workers} cleaning workers")
+                self.cleaning_pool = CleaningPool(
+                    self.config.replacements,
+                    self.config.finalizer,
+                    workers=self.workers,
+                    time_budget=self.config.cleanab.rule_time_budget,
+                    mappings=mappings,
+                    tokenize_purpose=self.config.cleanab.tokenize_purpose,
+                )
+        self.start_cleaning_run()
+
+    def start_cleaning_run(self):
+        # Rules that ran out of time are skipped until the end of the run only
+        self.cleaner = self.compiled_cleaner.for_run()
+        if self.cleaning_pool:
+            self.cleaning_pool.start_run()
 
+    def update_timespan(self):
+        # Evaluated per run, a long-running process must not get stuck on one day
+        self.today = date.today()
         self.earliest = max(
             [
-                TODAY - timedelta(days=self.config.timespan.maximum_days),
+                self.today - timedelta(days=self.config.timespan.maximum_days),
                 self.config.timespan.earliest_date,
             ]
         )
         logger.info(f"Checking back until {self.earliest}")
 
+    def close(self):
+        if self.cleaning_pool:
+            self.cleaning_pool.close()
+            self.cleaning_pool = None
+        if self.tan_broker:
+            self.tan_broker.close()
+
     def _get_fints_transactions(self, account):
         if self.test and account.has_account_cache:
             raw_transactions = account.read_account_cache()
         else:
+            # The FinTS client is only loaded when we actually talk to a bank
+            from .fints import process_fints_account
+
             raw_transactions = process_fints_account(
                 account,
                 earliest=self.earliest,
-                latest=TODAY,
+                latest=self.today,
                 product_id=self.config.cleanab.fints_product_id,
+                tan_broker=self.tan_broker,
+                lock_timeout=self.config.cleanab.locks.timeout,
             )
             account.write_account_cache(raw_transactions)
         return raw_transactions
 
+    def balance_unchanged(self, account, state: AccountState) -> bool:
+        """Whether the bank reports the balance of the last sync, which is recent enough to trust.
+
+        A balance dated after the watermark may include bookings the last
+        download did not cover, even if the amount is the same.
+        """
+        config = self.config.cleanab.balance_probe
+        if not config or self.full or self.test or account.account_type == AccountType.HOLDING:
+            return False
+
+        from .fints import probe_fints_balance
+
+        try:
+            with self.profiler.stage("probe", account):
+                probed = probe_fints_balance(
+                    account,
+                    product_id=self.config.cleanab.fints_product_id,
+                    tan_broker=self.tan_broker,
+                    lock_timeout=self.config.cleanab.locks.timeout,
+                )
+        except Exception as exc:
+            logger.warning(f"Probing the balance of {account} failed, fetching transactions: {exc}")
+            return False
+
+        if probed is None:
+            return False
+        balance, balance_date = probed
+        recent = time.time() - state.synced_at < config.max_age_hours * 3600
+        covered = state.watermark is not None and (
+            balance_date is None or balance_date.isoformat() <= state.watermark
+        )
+        unchanged = balance == state.balance and recent and covered
+        state.balance = balance
+        return unchanged
+
+    def lock_account(self, account) -> bool:
+        """Take the account's lock, False if it is skipped because another process has it."""
+        config = self.config.cleanab.locks
+        lock = account_lock(account)
+        if config.mode == "skip":
+            if not lock.acquire(0):
+                return False
+        else:
+            lock.hold(config.timeout)
+        self._account_locks[account] = lock
+        return True
+
+    def release_account(self, account):
+        if lock := self._account_locks.pop(account, None):
+            lock.release()
+
+    @contextmanager
+    def hold_run_lock(self, accounts):
+        """Yield whether no other process is running these accounts.
+
+        In wait mode an earlier run is waited for, in skip mode this run goes
+        ahead and only skips the accounts the other one is busy with.
+        """
+        config = self.config.cleanab.locks
+        lock = run_lock(accounts)
+        if config.mode == "skip":
+            exclusive = lock.acquire(0)
+            if not exclusive:
+                logger.info(f"Another cleanab process holds the {lock}, skipping the accounts it is busy with")
+        else:
+            exclusive = lock.hold(config.timeout).locked
+        try:
+            yield exclusive
+        finally:
+            lock.release()
+
+    def due_in(self, account, state: AccountState) -> float:
+        """Seconds until the account's refresh interval has passed since its last sync, 0 if it is due."""
+        if not account.refresh_interval or not self.due_only or self.full or self.dry_run:
+            return 0
+        return max(0.0, state.checked_at + account.refresh_interval - time.time())
+
     def processor(self, account):
         logger.info(f"Processing {account}")
 
+        stage = "lock"
         try:
-            raw_transactions = self._get_fints_transactions(account)
+            if not self.lock_account(account):
+                logger.info(f"{account} is being processed by another cleanab process, skipping")
+                self.outcomes[account] = "skipped"
+                return []
+
+            stage = "probe"
+            # Read once the account is locked, so it is what the last process saved
+            state = load_state(account)
+            if due_in := self.due_in(account, state):
+                logger.info(f"{account} is not due for another {due_in / 60:.0f} minutes, skipping")
+                self.outcomes[account] = "deferred"
+                return []
+
+            if self.balance_unchanged(account, state):
+                logger.info(f"Balance of {account} unchanged since the last sync, skipping")
+                state.checked_at = time.time()
+                self._states[account] = state
+                self.outcomes[account] = "unchanged"
+                return []
+
+            stage = "fetch"
+            with self.profiler.stage("fetch", account) as timing:
+                raw_transactions = self._get_fints_transactions(account)
+            self.metrics.fetch_duration.observe(timing.wall, bank=account.fints_blz)
+            self.metrics.transactions.set(len(raw_transactions), account=account.iban)
+
+            state.synced_at = state.checked_at = time.time()
+            # The download covers everything booked up to today
+            dates = [t["date"] for t in raw_transactions if t.get("date")]
+            state.watermark = max([self.today, *dates]).isoformat()
+
+            previous_fingerprint = state.fingerprint
+            state.fingerprint = fingerprint(account, raw_transactions, self.config_fingerprint)
+            # Dry runs show everything, there is no upload to save
+            if state.fingerprint == previous_fingerprint and not (self.full or self.dry_run):
+                logger.info(f"Transactions of {account} unchanged since the last sync, skipping")
+                self._states[account] = state
+                self.outcomes[account] = "unchanged"
+                return []
+
+            stage = "process"
 
             if account.account_type == AccountType.HOLDING:
                 # TODO: What to do here?
@@ -94,52 +296,219 @@ class Cleanab:
             if self.save:
                 account.write_cleaned_account_cache(processed_transactions)
 
+            self._states[account] = state
+            self.outcomes[account] = "synced"
+
             return processed_transactions
+        except LockTimeout as exc:
+            logger.error(f"Processing {account} failed: {exc}")
+            self.metrics.errors.inc(stage=stage)
+            self.outcomes[account] = "failed"
+
+            return []
         except Exception:
             logger.exception("Processing %s failed", account)
+            self.metrics.errors.inc(stage=stage)
+            self.outcomes[account] = "failed"
 
             return []
 
-    def run(self):
-        processed_transactions = list(
-            zip(
-                *chain.from_iterable(
-                    self.processor(account) for account in self.accounts
-                )
-            )
-        )
+    def run(self, accounts=None, *, due_only=True):
+        """Sync `accounts`, all configured ones by default.
+
+        Callers scheduling accounts themselves pass `due_only=False` to have
+        them synced regardless of their refresh interval.
+        """
+        stopwatch = Stopwatch()
+        self.outcomes = {}
+        self.due_only = due_only
+        try:
+            self.start_cleaning_run()
+            self.update_timespan()
+            accounts = self.accounts if accounts is None else accounts
+            with self.hold_run_lock(accounts) as exclusive:
+                # Otherwise the process holding the run lock drains them
+                if exclusive and not self.dry_run:
+                    self.drain_outboxes()
+                self._run(accounts)
+        finally:
+            for account in list(self._account_locks):
+                self.release_account(account)
+            if self.outcomes:
+                summary = Counter(self.outcomes.values())
+                logger.info("Accounts: " + ", ".join(f"{summary[outcome]} {outcome}" for outcome in OUTCOMES))
+                for outcome in OUTCOMES:
+                    self.metrics.accounts.set(summary[outcome], outcome=outcome)
+            self.metrics.finish_run(stopwatch.elapsed()[0])
+            if metrics_config := self.config.cleanab.metrics:
+                self.metrics.export(metrics_config)
+
+    def iter_processed(self, accounts):
+        """Yield (account, transactions) as accounts finish processing.
+
+        Up to `cleanab.concurrency` accounts are fetched at the same time, so
+        an account waiting for its TAN does not hold up the others.
+        """
+        concurrency = self.config.cleanab.concurrency
+        if concurrency == 1 or len(accounts) <= 1:
+            for account in accounts:
+                yield account, self.processor(account)
+            return
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="account") as executor:
+            futures = {executor.submit(self.processor, account): account for account in accounts}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
 
-        if not processed_transactions:
+    def _run(self, accounts):
+        found = False
+        # Dry runs write a single intermediary per app with all accounts
+        collected = []
+        for account, processed_transactions in self.iter_processed(accounts):
+            if processed_transactions:
+                found = True
+                if self.dry_run:
+                    collected += processed_transactions
+                else:
+                    self.upload_transactions(processed_transactions)
+            if not self.dry_run and (state := self._states.pop(account, None)):
+                save_state(account, state)
+            self.release_account(account)
+
+        if not found:
             logger.warning("No transactions found")
             return
 
-        for i, app_connection in enumerate(self.config.get_apps()):
-            transactions = processed_transactions[i]
+        if self.dry_run:
+            logger.info("Dry-run, not creating transactions")
+            if self.intermediary:
+                for app_connection, transactions in zip(self.config.get_apps(), zip(*collected)):
+                    with self.profiler.stage("intermediary", app_connection):
+                        self.write_intermediary(app_connection, transactions)
+
+    def upload_transactions(self, processed_transactions):
+        """Upload the transactions of an account, one entry per transaction holding each app's version."""
+        uploads = []
+        for app_connection, transactions in zip(self.config.get_apps(), zip(*processed_transactions)):
+            logger.info(f"Creating transactions in {app_connection}")
+            uploads.append((app_connection, transactions))
+        self.upload(uploads)
+
+    def import_statements(self, statements, *, batch_size=1000):
+        """Clean and upload (account identification, transaction) pairs read from statement files.
+
+        Transactions are processed in batches per account, so a large
+        backfill is never held in memory as a whole.
+        """
+        from .statements import find_account
+
+        self.start_cleaning_run()
+        self.update_timespan()
+        accounts = {}
+        batches: dict[AccountConfig, list] = {}
+        skipped = Counter()
+        for identification, data in statements:
+            if identification not in accounts:
+                accounts[identification] = find_account(self.accounts, identification)
+            if (account := accounts[identification]) is None:
+                skipped[identification] += 1
+                continue
+            batch = batches.setdefault(account, [])
+            batch.append(data)
+            if len(batch) >= batch_size:
+                self.import_batch(account, batches.pop(account))
+
+        for account, batch in batches.items():
+            self.import_batch(account, batch)
+        for identification, count in skipped.items():
+            logger.warning(f"Skipped {count} transactions of {identification}, no account configured for it")
+
+    def import_batch(self, account, raw_transactions):
+        logger.info(f"Importing {len(raw_transactions)} transactions into {account}")
+        with account_lock(account).hold(self.config.cleanab.locks.timeout):
+            # A batch is only part of what the bank reports, reconciling against
+            # it would take the transactions of other batches for replaced ones
+            processed_transactions = self.process_account_transactions(raw_transactions, account, reconcile=False)
             if self.dry_run:
-                logger.info("Dry-run, not creating transactions")
-                if intermediary := app_connection.create_intermediary(transactions):
-                    logger.debug(
-                        f"{app_connection}: Intermediary:\n\n{intermediary}\n\n"
-                    )
+                logger.info(f"Dry-run, not creating {len(processed_transactions)} transactions")
                 return
+            self.upload_transactions(processed_transactions)
 
-            logger.info(f"Creating transactions in {app_connection}")
-            new, duplicates = app_connection.create_transactions(transactions)
+    def drain_outboxes(self):
+        """Retry batches that earlier runs failed to upload."""
+        if apps := self.uploader.pending(self.config.get_apps()):
+            logger.info(f"Retrying queued transactions for {', '.join(map(str, apps))}")
+            self.upload([(app_connection, ()) for app_connection in apps])
+
+    def upload(self, uploads):
+        for app_connection, result, exc in self.uploader.upload(uploads):
+            if exc is not None:
+                logger.error(
+                    "Creating transactions in %s failed", app_connection, exc_info=exc
+                )
+                self.metrics.errors.inc(stage="upload", app=app_connection.name)
+                continue
 
+            new, duplicates = result
             logger.info(f"Created {new} new transactions")
             logger.info(f"Saw {duplicates} duplicates")
+            self.metrics.created.inc(len(new), app=app_connection.name, state="new")
+            self.metrics.created.inc(len(duplicates), app=app_connection.name, state="duplicate")
 
-    def process_account_transactions(self, transactions: list, account: AccountConfig):
-        apps = self.config.get_apps()
-        for transaction in transactions:
-            if not transaction:
-                continue
+    def write_intermediary(self, app_connection, transactions):
+        chunks = app_connection.create_intermediary(transactions)
+        if self.intermediary == "stdout":
+            sys.stdout.writelines(chunks)
+            sys.stdout.flush()
+            return
 
-            processed_transaction = process_transaction(transaction, self.cleaner)
-            if not processed_transaction:
-                continue
+        CACHE_HOME.mkdir(parents=True, exist_ok=True)
+        filename = CACHE_HOME / (
+            f"{app_connection.name}_intermediary{app_connection.intermediary_suffix}"
+        )
+        with open(filename, "w") as f:
+            f.writelines(chunks)
+        logger.info(f"{app_connection}: Wrote intermediary to {filename}")
+
+    def clean_transactions(self, transactions: list):
+        if self.cleaning_pool:
+            yield from self.cleaning_pool.process(transactions)
+            return
+
+        with self.cleaner.watchdog():
+            for transaction in transactions:
+                if not transaction:
+                    continue
+                yield process_transaction(transaction, self.cleaner)
+
+    def reconcile_transactions(self, transactions: list, account: AccountConfig):
+        from .reconcile import load_index, save_index
+
+        config = self.config.cleanab.reconcile
+        index = load_index(account, window_days=config.window_days)
+        index.reconcile(transactions, earliest=self.earliest, reuse=config.mode == "reuse")
+        if self.dry_run:
+            return
+        index.update(transactions, retention_days=config.retention_days, today=self.today)
+        save_index(account, index)
+
+    def process_account_transactions(self, transactions: list, account: AccountConfig, *, reconcile=True):
+        with self.profiler.stage("clean", account) as timing:
+            processed_transactions = [
+                processed_transaction
+                for processed_transaction in self.clean_transactions(transactions)
+                if processed_transaction
+            ]
+        self.metrics.clean_duration.inc(timing.wall)
+
+        if reconcile and self.config.cleanab.reconcile:
+            with self.profiler.stage("reconcile", account):
+                self.reconcile_transactions(processed_transactions, account)
 
-            agumented_transaction = [
-                app.augment_transaction(processed_transaction, account) for app in apps
+        with self.profiler.stage("augment", account):
+            augmented_per_app = [
+                app.augment_batch(processed_transactions, account)
+                for app in self.config.get_apps()
             ]
-            yield agumented_transaction
+        # One entry per transaction, holding the augmented version for each app
+        return [list(augmented) for augmented in zip(*augmented_per_app)]
@@ -0,0 +1,128 @@
+"""Replace whole values through a lookup table, ahead of the replacement rules.
+
+Most payee rules map one exact merchant string to a name. Kept in a mapping
+file, they cost a single dict lookup per value instead of one regex pass per
+rule. Values are compared normalized: case-folded, whitespace collapsed.
+
+A mapping file is either a CSV with the columns `pattern`, `repl` and an
+optional `prefix`, or YAML holding a `pattern: repl` dict or a list of
+`{pattern, repl, prefix}` entries. Entries with `prefix` set match every
+value starting with `pattern`, the longest matching prefix wins. Exact
+entries take precedence over prefixes.
+"""
+
+import csv
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+
+import yaml
+from logzero import logger
+
+_TRUE = {"1", "true", "yes", "y", "x"}
+
+_loaded: dict[tuple, "PayeeMapping"] = {}
+_loaded_lock = Lock()
+
+
+def normalize(value):
+    return " ".join(value.casefold().split())
+
+
+def file_digest(path):
+    return sha256(Path(path).read_bytes()).hexdigest()
+
+
+class PayeeMapping:
+    def __init__(self, exact=(), prefixes=(), *, source="", digest=""):
+        self.source = source
+        self.digest = digest
+        self.exact = {}
+        # A character trie needs a dict per character, tens of MB for tens of
+        # thousands of prefixes. Instead prefixes are hashed like exact
+        # entries and a value is looked up once per distinct prefix length.
+        self.prefixes = {}
+        self.prefix_lengths = []
+        for pattern, repl in exact:
+            self.exact[normalize(pattern)] = repl
+        for pattern, repl in prefixes:
+            self.add_prefix(pattern, repl)
+
+    def __str__(self):
+        return f"mapping {self.source}"
+
+    def __len__(self):
+        return len(self.exact) + len(self.prefixes)
+
+    def add_prefix(self, pattern, repl):
+        pattern = normalize(pattern)
+        self.prefixes[pattern] = repl
+        if len(pattern) not in self.prefix_lengths:
+            # Longest first, the longest matching prefix wins
+            self.prefix_lengths = sorted({*self.prefix_lengths, len(pattern)}, reverse=True)
+
+    def lookup(self, value):
+        """Replacement for `value`, None if no entry matches."""
+        key = normalize(value)
+        if (repl := self.exact.get(key)) is not None:
+            return repl
+        for length in self.prefix_lengths:
+            if length <= len(key) and (repl := self.prefixes.get(key[:length])) is not None:
+                return repl
+        return None
+
+    def __call__(self, value):
+        repl = self.lookup(value)
+        return (value if repl is None else repl), {}
+
+    @staticmethod
+    def _entries_from_yaml(path):
+        with open(path) as f:
+            content = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+        if isinstance(content, dict):
+            return [(str(pattern), str(repl), False) for pattern, repl in content.items()]
+        if isinstance(content, list):
+            return [(str(e["pattern"]), str(e.get("repl", "")), bool(e.get("prefix"))) for e in content]
+        raise ValueError(f"{path}: expected a dict or a list of entries")
+
+    @staticmethod
+    def _entries_from_csv(path):
+        with open(path, newline="") as f:
+            return [
+                (row["pattern"], row.get("repl") or "", (row.get("prefix") or "").strip().lower() in _TRUE)
+                for row in csv.DictReader(f)
+            ]
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        if path.suffix.lower() in (".yaml", ".yml"):
+            entries = cls._entries_from_yaml(path)
+        else:
+            entries = cls._entries_from_csv(path)
+        mapping = cls(
+            [(pattern, repl) for pattern, repl, prefix in entries if not prefix],
+            [(pattern, repl) for pattern, repl, prefix in entries if prefix],
+            source=path.name,
+            digest=file_digest(path),
+        )
+        logger.info(f"Loaded {len(mapping)} mappings from {path}")
+        return mapping
+
+
+def load_mappings(mapping_fields) -> dict[str, PayeeMapping]:
+    """Load the mapping files of a `MappingFields` config, by field.
+
+    Files are loaded once per process and again when they changed.
+    """
+    mappings = {}
+    for field, path in mapping_fields:
+        if path is None:
+            continue
+        stat = Path(path).stat()
+        key = (str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size)
+        with _loaded_lock:
+            if key not in _loaded:
+                _loaded[key] = PayeeMapping.load(path)
+            mappings[field] = _loaded[key]
+    return mappings
@@ -0,0 +1,225 @@
+import os
+import time
+from collections import defaultdict
+from pathlib import Path
+from threading import Lock
+
+from logzero import logger
+
+# Node-exporter's textfile collector only reads the classic text format
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+FETCH_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def wants_openmetrics(accept):
+    """Whether an Accept header asks for OpenMetrics rather than the classic text format."""
+    return any(
+        part.split(";", 1)[0].strip() == "application/openmetrics-text" for part in (accept or "").split(",")
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricFamily:
+    type = "unknown"
+    suffix = ""
+
+    def __init__(self, name, documentation, unit=""):
+        self.name = name
+        self.documentation = documentation
+        self.unit = unit
+        self._samples = {}
+        # Accounts are processed in threads
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def header(self, openmetrics):
+        if not openmetrics:
+            # The classic format names the family like its samples, and has no units
+            name = self.name + self.suffix
+            return [f"# HELP {name} {_escape(self.documentation)}", f"# TYPE {name} {self.type}"]
+        lines = [f"# TYPE {self.name} {self.type}"]
+        if self.unit:
+            lines.append(f"# UNIT {self.name} {self.unit}")
+        lines.append(f"# HELP {self.name} {_escape(self.documentation)}")
+        return lines
+
+    def render(self, openmetrics=True):
+        return self.header(openmetrics) + [
+            f"{self.name}{self.suffix}{_format_labels(labels)} {_format_value(value)}"
+            for labels, value in self._samples.items()
+        ]
+
+
+class Counter(MetricFamily):
+    type = "counter"
+    suffix = "_total"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+
+class Gauge(MetricFamily):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._samples[self._key(labels)] = value
+
+
+class Histogram(MetricFamily):
+    type = "histogram"
+
+    def __init__(self, name, documentation, unit="", buckets=FETCH_BUCKETS):
+        super().__init__(name, documentation, unit)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._samples = defaultdict(lambda: [[0] * len(self.buckets), 0.0, 0])
+
+    def observe(self, value, **labels):
+        with self._lock:
+            counts, _, _ = sample = self._samples[self._key(labels)]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def render(self, openmetrics=True):
+        lines = self.header(openmetrics)
+        for labels, (counts, total, count) in self._samples.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                bucket_labels = labels + (("le", _format_value(float(bound))),)
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {bucket_count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class RunMetrics:
+    """Metrics collected over the runs of this process, rendered as OpenMetrics or classic Prometheus text."""
+
+    def __init__(self):
+        self.fetch_duration = Histogram(
+            "cleanab_fetch_duration_seconds",
+            "Time spent retrieving transactions from the bank.",
+            unit="seconds",
+        )
+        self.clean_duration = Counter(
+            "cleanab_clean_duration_seconds",
+            "Time spent cleaning transactions.",
+            unit="seconds",
+        )
+        self.transactions = Gauge(
+            "cleanab_account_transactions",
+            "Transactions retrieved for an account in the last run.",
+        )
+        self.accounts = Gauge(
+            "cleanab_accounts",
+            "Accounts of the last run, by outcome: synced, unchanged or failed.",
+        )
+        self.created = Counter(
+            "cleanab_app_transactions",
+            "Transactions sent to an app, by the state reported back by the app.",
+        )
+        self.errors = Counter(
+            "cleanab_errors",
+            "Errors by stage of the run.",
+        )
+        self.last_run = Gauge(
+            "cleanab_last_run_timestamp_seconds",
+            "Time the last run finished.",
+            unit="seconds",
+        )
+        self.run_duration = Gauge(
+            "cleanab_last_run_duration_seconds",
+            "Duration of the last run.",
+            unit="seconds",
+        )
+
+    def families(self):
+        return [
+            self.fetch_duration,
+            self.clean_duration,
+            self.transactions,
+            self.accounts,
+            self.created,
+            self.errors,
+            self.last_run,
+            self.run_duration,
+        ]
+
+    def render(self, openmetrics=True):
+        lines = []
+        for family in self.families():
+            lines += family.render(openmetrics)
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def finish_run(self, duration):
+        self.last_run.set(time.time())
+        self.run_duration.set(duration)
+
+    def export(self, config):
+        """Write the metrics to the configured textfile and/or push endpoint."""
+        if config.textfile:
+            write_textfile(config.textfile, self.render(openmetrics=False))
+        if config.push_url:
+            push(str(config.push_url), self)
+
+
+def write_textfile(path, text):
+    # Write to a temporary file and rename, so collectors never read a partial file
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(temporary, "w") as f:
+        f.write(text)
+    os.replace(temporary, path)
+    logger.debug(f"Wrote metrics to {path}")
+
+
+def _put(url, metrics, openmetrics):
+    import requests
+
+    return requests.put(
+        url,
+        data=metrics.render(openmetrics).encode("utf-8"),
+        headers={"Content-Type": OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE},
+        timeout=10,
+    )
+
+
+def push(url, metrics):
+    import requests
+
+    try:
+        response = _put(url, metrics, openmetrics=True)
+        if response.status_code == 415 and not wants_openmetrics(response.headers.get("Accept")):
+            # The endpoint does not take OpenMetrics, e.g. a Pushgateway
+            logger.debug(f"{url} does not accept OpenMetrics, pushing the classic text format")
+            response = _put(url, metrics, openmetrics=False)
+    except requests.RequestException as exc:
+        logger.error(f"Failed pushing metrics to {url}: {exc}")
+        return
+    if not response.ok:
+        logger.error(f"Failed pushing metrics to {url}: {response.status_code} {response.text}")
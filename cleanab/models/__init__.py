@@ -1,2 +1,2 @@
-from .account_config import AccountConfig  # noqa: F401
-from .transaction import FintsTransaction  # noqa: F401
+from .account_config import AccountConfig, select_accounts  # noqa: F401
+from .transaction import FintsTransaction, TransactionRecord  # noqa: F401
@@ -1,10 +1,12 @@
 import json
 import pickle
+from hashlib import sha256
 from typing import Annotated
 
-from pydantic import BaseModel, HttpUrl, StringConstraints, field_validator
+from logzero import logger
+from pydantic import BaseModel, Field, HttpUrl, StringConstraints, field_validator
 
-from ..utils import CACHE_HOME
+from ..utils import CACHE_HOME, atomic_write
 from ..validators import is_iban
 from .enums import AccountType
 
@@ -27,6 +29,9 @@ class AccountConfig(BaseModel):
     default_cleared: bool = False
     default_approved: bool = False
 
+    # Seconds between syncs of this account, None syncs it on every run
+    refresh_interval: Annotated[float, Field(gt=0)] | None = None
+
     def __hash__(self):
         return hash(self.iban + self.per_app_id)
 
@@ -39,6 +44,21 @@ class AccountConfig(BaseModel):
             base += f" '{self.friendly_name}'"
         return base + f" (…{self.iban[-4:]})"
 
+    def matches(self, selector):
+        """Whether `selector` is the IBAN, name or app id of this account, ignoring case."""
+        selector = selector.lower()
+        return selector in (self.iban.lower(), self.friendly_name.lower(), self.per_app_id.lower())
+
+    def matches_bank(self, selector):
+        """Whether `selector` is the BLZ or the FinTS server host of this account."""
+        return selector.lower() in (self.fints_blz, (self.fints_endpoint.host or "").lower())
+
+    @property
+    def storage_name(self):
+        """File name stem for data kept per account, unique per IBAN and app id."""
+        app_id = sha256(self.per_app_id.encode("utf-8")).hexdigest()[:12]
+        return f"{self.iban}-{app_id}"
+
     @property
     def _account_cache_filename(self):
         return CACHE_HOME / f"{self.iban}.pickle"
@@ -59,15 +79,27 @@ class AccountConfig(BaseModel):
         return v
 
     def write_account_cache(self, transactions):
-        CACHE_HOME.mkdir(parents=True, exist_ok=True)
-        with open(self._account_cache_filename, "wb") as f:
+        with atomic_write(self._account_cache_filename, "wb") as f:
             pickle.dump(transactions, f)
 
     def write_cleaned_account_cache(self, transactions):
-        CACHE_HOME.mkdir(parents=True, exist_ok=True)
-        with open(self._cleaned_account_cache_filename, "w") as f:
-            json.dump(transactions, f)
+        with atomic_write(self._cleaned_account_cache_filename) as f:
+            json.dump(transactions, f, default=str)
 
     def read_account_cache(self):
         with open(self._account_cache_filename, "rb") as f:
             return pickle.load(f)
+
+
+def select_accounts(accounts, account_filters=(), bank_filters=()):
+    """The accounts matching all of the --account and --bank filters given."""
+    for filters, matches in ((account_filters, "matches"), (bank_filters, "matches_bank")):
+        if not filters:
+            continue
+        for selector in filters:
+            if not any(getattr(account, matches)(selector) for account in accounts):
+                logger.warning(f"No account matches {selector!r}")
+        accounts = [
+            account for account in accounts if any(getattr(account, matches)(selector) for selector in filters)
+        ]
+    return accounts
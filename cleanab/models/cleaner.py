@@ -1,6 +1,6 @@
 from enum import Enum
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, model_validator
 
 from .. import utils
 
@@ -24,6 +24,16 @@ class ReplacementDefinition(BaseModel):
 
     model_config = ConfigDict(frozen=True, extra="forbid")
 
+    @model_validator(mode="before")
+    @classmethod
+    def literal_string(cls, values):
+        # `string: ...` is shorthand for a non-regex pattern
+        if isinstance(values, dict) and "string" in values:
+            values = dict(values)
+            values["pattern"] = values.pop("string")
+            values.setdefault("regex", False)
+        return values
+
     def get_cleaner(self):
         return utils.regex_sub_instance(self)
 
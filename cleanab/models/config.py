@@ -1,13 +1,20 @@
+import json
+import os
+import pickle
 from datetime import date
-from typing import Annotated
+from hashlib import sha256
+from pathlib import Path
+from typing import Annotated, Literal
 
+import yaml
 from logzero import logger
-from pydantic import BaseModel, ConfigDict, Field, model_validator
+from pydantic import BaseModel, ConfigDict, Field, HttpUrl, model_validator
 from pydantic.main import create_model
 
 from cleanab.apps.base import BaseApp, _AppConfigValidator, load_app
 
 from ..constants import FIELDS_TO_CLEAN_UP
+from ..utils import CACHE_HOME, atomic_write
 from .account_config import AccountConfig
 from .cleaner import FinalizerDefinition, ReplacementDefinition
 
@@ -17,11 +24,57 @@ class TimespanConfig(BaseModel):
     maximum_days: Annotated[int, Field(ge=1)] = 30
 
 
+class MetricsConfig(BaseModel):
+    textfile: Path | None = None
+    push_url: HttpUrl | None = None
+
+
+class ReconcileConfig(BaseModel):
+    window_days: Annotated[int, Field(ge=0)] = 3
+    # "flag" only warns, "reuse" keeps the import id of the replaced transaction. The
+    # apps then drop the new one, a second payment of the same amount would be lost
+    mode: Literal["reuse", "flag"] = "flag"
+    retention_days: Annotated[int, Field(ge=1)] = 60
+
+
+class BalanceProbeConfig(BaseModel):
+    # Download the transactions anyway when the last download is older than this
+    max_age_hours: Annotated[float, Field(gt=0)] = 24
+
+
+class TanConfig(BaseModel):
+    # Where TAN challenges are answered, see cleanab.tan
+    channel: Literal["terminal", "socket", "file"] = "terminal"
+    # Seconds to wait for an answer on the socket or in the directory before
+    # giving up on the account, terminal prompts wait for their answer
+    timeout: Annotated[float, Field(gt=0)] = 300
+    socket: Path | None = None
+    directory: Path | None = None
+
+
+class LockConfig(BaseModel):
+    # What to do about accounts another cleanab process is working on:
+    # wait for it to finish, or leave them to it
+    mode: Literal["wait", "skip"] = "wait"
+    # Seconds to wait for a lock before giving up on the run or account
+    timeout: Annotated[float, Field(gt=0)] = 900
+
+
 class CleanabConfig(BaseModel):
+    # Accounts fetched and processed at the same time
     concurrency: Annotated[int, Field(gt=0)] = 1
     minimum_holdings_delta: Annotated[float, Field(ge=0)] = 1
     debug: bool = False
     fints_product_id: str | None = None
+    metrics: MetricsConfig | None = None
+    reconcile: ReconcileConfig | None = None
+    balance_probe: BalanceProbeConfig | None = None
+    # Seconds a replacement rule may take on a single value before it is skipped for the rest of the run
+    rule_time_budget: Annotated[float, Field(gt=0)] | None = None
+    # Clean only the remittance information (SVWZ+) of SEPA purposes, not their EREF+, MREF+, … tags
+    tokenize_purpose: bool = False
+    tan: TanConfig = TanConfig()
+    locks: LockConfig = LockConfig()
 
 
 NestedReplacementEntry = list[ReplacementDefinition | str]
@@ -35,6 +88,13 @@ ReplacementFields: type[BaseModel] = create_model(
 )
 
 
+# A mapping file per field, see cleanab.mapping
+MappingFields: type[BaseModel] = create_model(
+    "MappingFields",
+    **{field: (Path | None, None) for field in FIELDS_TO_CLEAN_UP},  # type: ignore
+)
+
+
 FinalizerFields = create_model(
     "FinalizerFields",
     **{
@@ -48,9 +108,10 @@ class Config(BaseModel):
     cleanab: CleanabConfig = CleanabConfig()
     timespan: TimespanConfig = TimespanConfig()
     accounts: Annotated[list[AccountConfig], Field(min_length=1)]
-    replacements: BaseModel = ReplacementFields()
-    pre_replacements: BaseModel = ReplacementFields()
-    finalizer: BaseModel = FinalizerFields()
+    replacements: ReplacementFields = ReplacementFields()  # type: ignore[valid-type]
+    pre_replacements: ReplacementFields = ReplacementFields()  # type: ignore[valid-type]
+    mappings: MappingFields = MappingFields()  # type: ignore[valid-type]
+    finalizer: FinalizerFields = FinalizerFields()  # type: ignore[valid-type]
     apps: dict[str, _AppConfigValidator] = {}
     _parsed_apps: list[BaseApp] = []
     model_config: ConfigDict = ConfigDict(extra="allow")
@@ -73,3 +134,77 @@ class Config(BaseModel):
 
     def get_apps(self) -> list[BaseApp]:
         return self._parsed_apps
+
+
+CONFIG_CACHE_DIR = CACHE_HOME / "config"
+# Validated rule sections kept, for running several configs in turn
+MAX_CACHED_CONFIGS = 8
+# The sections that take long to validate. They hold no credentials, unlike
+# accounts and apps, so only they are cached
+CACHED_SECTIONS = ("replacements", "pre_replacements", "finalizer", "mappings")
+
+
+def _config_cache_key(raw: dict) -> str:
+    """Hash of the cached sections of a config and the code that validates them."""
+    sections = {section: raw.get(section) for section in CACHED_SECTIONS}
+    digest = sha256(json.dumps(sections, sort_keys=True, default=str).encode("utf-8"))
+    package = Path(__file__).parent.parent
+    for module in sorted([*package.glob("models/*.py"), package / "utils.py"]):
+        digest.update(f"{module.name}:{module.stat().st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def _prune_config_cache(keep):
+    entries = sorted(CONFIG_CACHE_DIR.glob("*"), key=lambda path: path.stat().st_mtime, reverse=True)
+    kept = 0
+    for path in entries:
+        # Anything else, like whole configs cached by earlier versions, goes
+        if path.name.startswith("rules-") and path.suffix == ".pickle" and (path == keep or kept < MAX_CACHED_CONFIGS):
+            kept += 1
+            continue
+        path.unlink(missing_ok=True)
+
+
+def _resolve_mapping_paths(raw: dict, base_dir: Path):
+    """Make relative mapping file paths relative to `base_dir` instead of the working directory."""
+    mappings = raw.get("mappings")
+    if not isinstance(mappings, dict):
+        return
+    for field, path in mappings.items():
+        if isinstance(path, str) and not Path(path).is_absolute():
+            mappings[field] = str(base_dir / path)
+
+
+def load_config(content: str, base_dir: Path | None = None) -> Config:
+    """Parse and validate a YAML config, reusing the validated rules of an unchanged one.
+
+    `base_dir` is the directory of the config file, relative paths in it are
+    resolved against it.
+    """
+    raw = yaml.load(content, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
+    if base_dir is not None:
+        _resolve_mapping_paths(raw, base_dir)
+    cache_file = CONFIG_CACHE_DIR / f"rules-{_config_cache_key(raw)}.pickle"
+    cached = None
+    try:
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+        logger.debug(f"Using cached rules {cache_file.name}")
+    except FileNotFoundError:
+        pass
+    except Exception as exc:
+        logger.debug(f"Ignoring unreadable config cache {cache_file.name}: {exc}")
+
+    if cached:
+        # Validated models are taken as they are
+        raw = {**raw, **cached}
+        os.utime(cache_file)
+    config = Config.model_validate(raw)
+    if cached:
+        return config
+
+    CONFIG_CACHE_DIR.mkdir(parents=True, exist_ok=True, mode=0o700)
+    with atomic_write(cache_file, "wb") as f:
+        pickle.dump({section: getattr(config, section) for section in CACHED_SECTIONS}, f)
+    _prune_config_cache(keep=cache_file)
+    return config
@@ -1,3 +1,4 @@
+from dataclasses import dataclass
 from datetime import date
 
 from pydantic import BaseModel, field_validator
@@ -14,3 +15,18 @@ class FintsTransaction(BaseModel):
     @classmethod
     def set_purpose_empty(cls, purpose):
         return purpose or ""
+
+
+@dataclass(slots=True)
+class TransactionRecord:
+    """Lightweight, unvalidated transaction used inside the processing pipeline.
+
+    Inputs are already checked by `process_transaction`, so this skips pydantic
+    entirely. Apps turn it into their own payload in `augment_batch`.
+    """
+
+    date: date
+    amount: int
+    applicant_name: str
+    purpose: str = ""
+    import_id: str = ""
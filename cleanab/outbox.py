@@ -0,0 +1,195 @@
+"""On-disk queue of batches waiting to be uploaded to an app.
+
+Augmented batches are written to the outbox before they are uploaded and
+removed once the app accepted them. Batches that failed stay and are retried
+by the next run, with an exponential backoff per app. After
+`FAILURE_THRESHOLD` failures in a row the circuit opens: until the backoff
+expired nothing is sent to the app, after that a single batch probes whether
+it is back before the rest is drained.
+
+Several processes may share an outbox. A batch is `flock`ed by whoever is
+sending it, from the process putting it until it is acknowledged, so a
+process draining the outbox leaves it alone.
+
+Only apps declaring themselves idempotent get batches sent again. For the
+others a batch is renamed to `.unconfirmed` while it is sent and stays that
+way if sending fails, it may have been accepted in part.
+
+A batch file is a header followed by one pickle per transaction, so apps
+that stream can read it lazily.
+"""
+
+import fcntl
+import json
+import os
+import pickle
+import time
+from hashlib import sha256
+from itertools import count
+from threading import Lock
+
+from logzero import logger
+
+from .utils import CACHE_HOME
+
+OUTBOX_DIR = CACHE_HOME / "outbox"
+BACKOFF_BASE = 60
+BACKOFF_MAX = 6 * 60 * 60
+FAILURE_THRESHOLD = 5
+# Batches of apps that are not idempotent, while and after they failed to be sent
+UNCONFIRMED_SUFFIX = ".unconfirmed"
+_FORMAT = ("cleanab-outbox", 2)
+
+_sequence = count()
+
+
+class Outbox:
+    def __init__(self, app, directory=None):
+        self.app = app
+        target = sha256(app.target.encode("utf-8")).hexdigest()[:16]
+        self.directory = directory or OUTBOX_DIR / f"{app.name}-{target}"
+        self._state_file = self.directory / "state.json"
+        self._lock = Lock()
+        # Locked file descriptors of the batches this process is sending, by file name stem
+        self._claims: dict = {}
+        self.failures = 0
+        self.next_attempt = 0.0
+        self._read_state()
+
+    def _read_state(self):
+        try:
+            with open(self._state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logger.warning(f"Ignoring unreadable outbox state {self._state_file}: {exc}")
+            return
+        self.failures = state.get("failures", 0)
+        self.next_attempt = state.get("next_attempt", 0.0)
+
+    def _write_state(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temporary = self._state_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary, "w") as f:
+            json.dump({"failures": self.failures, "next_attempt": self.next_attempt}, f)
+        os.replace(temporary, self._state_file)
+
+    @property
+    def is_open(self):
+        return self.failures >= FAILURE_THRESHOLD
+
+    def put(self, transactions):
+        """Queue a batch, claimed by this process until it is acknowledged or released."""
+        self.directory.mkdir(parents=True, exist_ok=True, mode=0o700)
+        name = f"{time.time_ns():020d}-{os.getpid()}-{next(_sequence):06d}.pickle"
+        filename = self.directory / name
+        temporary = filename.with_suffix(".tmp")
+        # Batches hold account ids and payees, keep them private
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # Locked before it shows up under its name, no one else can claim it
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        with os.fdopen(os.dup(fd), "wb") as f:
+            pickle.dump(_FORMAT, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for transaction in transactions:
+                pickle.dump(transaction, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, filename)
+        self._claims[filename.stem] = fd
+        return filename
+
+    def claim(self, entry) -> bool:
+        """Lock a queued batch for sending, False if someone else has it or it is gone."""
+        try:
+            fd = os.open(entry, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Acknowledged between opening and locking it
+            current = os.stat(entry).st_ino == os.fstat(fd).st_ino
+        except (BlockingIOError, FileNotFoundError):
+            current = False
+        if not current:
+            os.close(fd)
+            return False
+        self._claims[entry.stem] = fd
+        return True
+
+    def release(self, entry):
+        if (fd := self._claims.pop(entry.stem, None)) is not None:
+            os.close(fd)
+
+    def hold_back(self, entry):
+        """Take a claimed batch out of the queue before sending it to an app that is not idempotent."""
+        unconfirmed = entry.with_suffix(UNCONFIRMED_SUFFIX)
+        os.replace(entry, unconfirmed)
+        return unconfirmed
+
+    def entries(self):
+        """Pending batches, oldest first."""
+        if not self.directory.exists():
+            return []
+        return sorted(self.directory.glob("*.pickle"))
+
+    def ready(self, now=None, entries=None):
+        """Batches (of `entries`, all by default) that may be sent now, respecting backoff and the circuit breaker."""
+        now = time.time() if now is None else now
+        entries = self.entries() if entries is None else entries
+        if not entries:
+            return []
+        if now < self.next_attempt:
+            logger.info(
+                f"{self.app}: {len(entries)} batch(es) waiting, next attempt in {self.next_attempt - now:.0f}s"
+            )
+            return []
+        if self.is_open:
+            logger.info(f"{self.app}: Circuit open, probing with a single batch")
+            return entries[:1]
+        return entries
+
+    @staticmethod
+    def iter_load(entry):
+        """The transactions of a batch, read one at a time."""
+        with open(entry, "rb") as f:
+            header = pickle.load(f)
+            if header != _FORMAT:
+                # A single list, written by an earlier version
+                yield from header
+                return
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    @classmethod
+    def load(cls, entry):
+        return list(cls.iter_load(entry))
+
+    def ack(self, entry):
+        # Removed before its claim is released, or a waiting process might send it again
+        entry.unlink(missing_ok=True)
+        self.release(entry)
+
+    def succeeded(self):
+        with self._lock:
+            if not self.failures and not self.next_attempt:
+                return
+            if self.is_open:
+                logger.info(f"{self.app}: Circuit closed")
+            self.failures = 0
+            self.next_attempt = 0.0
+            self._write_state()
+
+    def failed(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.failures += 1
+            delay = min(BACKOFF_BASE * 2 ** (self.failures - 1), BACKOFF_MAX)
+            self.next_attempt = now + delay
+            self._write_state()
+            if self.failures == FAILURE_THRESHOLD:
+                logger.warning(f"{self.app}: {self.failures} failures in a row, opening circuit")
+            logger.warning(
+                f"{self.app}: {len(self.entries())} batch(es) kept in {self.directory}, retrying in {delay}s"
+            )
@@ -0,0 +1,115 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from multiprocessing import get_context
+
+from logzero import logger
+
+from .cleaner import FieldCleaner
+from .transactions import process_transaction
+
+# Worker-local state, set up once per process by `_init_worker`
+_compiled_cleaner: FieldCleaner | None = None
+# The cleaner of the current run, see CleaningPool.start_run
+_cleaner: FieldCleaner | None = None
+_run = None
+_log_records: list[logging.LogRecord] = []
+
+
+class _BufferingHandler(logging.Handler):
+    """Hold on to log records so the parent process can emit them in order."""
+
+    def emit(self, record):
+        # Render the message now, args and tracebacks might not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        _log_records.append(record)
+
+
+def _init_worker(replacements, finalizing, time_budget, mappings, tokenize_purpose, log_level):
+    global _compiled_cleaner
+    logger.handlers = [_BufferingHandler()]
+    logger.setLevel(log_level)
+    _compiled_cleaner = FieldCleaner(
+        replacements, finalizing, time_budget=time_budget, mappings=mappings, tokenize_purpose=tokenize_purpose
+    )
+
+
+def _process_chunk(run, transactions):
+    global _cleaner, _run
+    if run != _run:
+        _cleaner, _run = _compiled_cleaner.for_run(), run
+    _log_records.clear()
+    with _cleaner.watchdog():
+        processed = [process_transaction(transaction, _cleaner) for transaction in transactions]
+    return processed, list(_log_records)
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class CleaningPool:
+    """Run `process_transaction` on a pool of worker processes.
+
+    Each worker compiles its own `FieldCleaner` once on start-up instead of
+    receiving it with every task. Results and the log output produced while
+    cleaning are handed back in input order, so the output matches a
+    single-process run.
+
+    Workers are started from a fork server. Forking the main process itself
+    is not safe, upload and account threads may hold locks at that moment.
+    """
+
+    def __init__(
+        self,
+        replacements,
+        finalizing,
+        *,
+        workers,
+        chunk_size=500,
+        time_budget=None,
+        mappings=None,
+        tokenize_purpose=False,
+    ):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._run = 0
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("forkserver"),
+            initializer=_init_worker,
+            # Plain lists instead of the config models, they pickle cheaply
+            initargs=(
+                [(field, list(contents)) for field, contents in replacements],
+                [(field, contents) for field, contents in finalizing],
+                time_budget,
+                mappings,
+                tokenize_purpose,
+                logger.getEffectiveLevel(),
+            ),
+        )
+
+    def start_run(self):
+        """Re-enable the rules workers disabled in the previous run."""
+        self._run += 1
+
+    def process(self, transactions):
+        transactions = [t for t in transactions if t]
+        chunk_size = max(1, min(self.chunk_size, len(transactions) // self.workers))
+        results = self._executor.map(partial(_process_chunk, self._run), _chunked(transactions, chunk_size))
+        for processed, log_records in results:
+            for record in log_records:
+                # `handle` skips the level check of the logger
+                if logger.isEnabledFor(record.levelno):
+                    logger.handle(record)
+            yield from processed
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
@@ -0,0 +1,118 @@
+import cProfile
+import json
+import sys
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter, process_time
+
+try:
+    import resource
+except ImportError:  # pragma: no cover, not available on Windows
+    resource = None
+
+
+@dataclass
+class StageTiming:
+    stage: str
+    label: str | None
+    wall: float = 0.0
+    cpu: float = 0.0
+    failed: bool = False
+
+
+class Stopwatch:
+    def __init__(self):
+        self.wall = perf_counter()
+        self.cpu = process_time()
+
+    def elapsed(self):
+        return perf_counter() - self.wall, process_time() - self.cpu
+
+
+def peak_memory():
+    """Peak resident set size of this process in bytes, if known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Profiler:
+    """Collect wall and CPU time of the stages of a run.
+
+    Recording stage timings is cheap and always on. The optional cProfile
+    profile is only collected between `start` and `stop` when requested.
+    """
+
+    def __init__(self, *, cprofile=False):
+        self.timings: list[StageTiming] = []
+        self._profile = cProfile.Profile() if cprofile else None
+        self._started = None
+
+    def start(self):
+        self._started = datetime.now()
+        if self._profile:
+            self._profile.enable()
+
+    def stop(self):
+        if self._profile:
+            self._profile.disable()
+
+    def record(self, stage, wall, cpu, label=None):
+        self.timings.append(StageTiming(stage, None if label is None else str(label), wall, cpu))
+
+    @contextmanager
+    def stage(self, stage, label=None):
+        """Time the block, the timing is yielded and filled in once it exits."""
+        timing = StageTiming(stage, None if label is None else str(label))
+        stopwatch = Stopwatch()
+        try:
+            yield timing
+        except BaseException:
+            timing.failed = True
+            raise
+        finally:
+            timing.wall, timing.cpu = stopwatch.elapsed()
+            self.timings.append(timing)
+
+    def aggregate(self):
+        totals = defaultdict(lambda: [0, 0.0, 0.0])
+        for timing in self.timings:
+            entry = totals[(timing.stage, timing.label)]
+            entry[0] += 1
+            entry[1] += timing.wall
+            entry[2] += timing.cpu
+        return totals
+
+    def summary(self):
+        lines = [f"{'stage':<14} {'label':<40} {'count':>5} {'wall [s]':>9} {'cpu [s]':>9}"]
+        for (stage, label), (count, wall, cpu) in self.aggregate().items():
+            label = (label or "")[:40]
+            lines.append(f"{stage:<14} {label:<40} {count:>5} {wall:>9.3f} {cpu:>9.3f}")
+        if (peak := peak_memory()) is not None:
+            lines.append(f"Peak memory: {peak / 2**20:.1f} MiB")
+        return "\n".join(lines)
+
+    def report(self):
+        return {
+            "started": self._started.isoformat() if self._started else None,
+            "peak_memory_bytes": peak_memory(),
+            "timings": [asdict(timing) for timing in self.timings],
+        }
+
+    def write_dumps(self, directory):
+        """Write the JSON timing report and the cProfile stats, if any, to `directory`."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        stem = directory / f"cleanab-{(self._started or datetime.now()):%Y%m%d-%H%M%S}"
+        written = [stem.with_suffix(".json")]
+        with open(written[0], "w") as f:
+            json.dump(self.report(), f, indent=2)
+        if self._profile:
+            written.append(stem.with_suffix(".pstats"))
+            self._profile.dump_stats(written[-1])
+        return written
@@ -0,0 +1,205 @@
+"""Re-clean cached transactions incrementally after the replacement rules changed.
+
+For every transaction the cleaned output is stored together with a sparse
+trace of the rules that changed a value. After a config edit, the old and new
+rule lists are aligned and only rules that were added or changed are run. Once
+a transaction is affected, it is cleaned again from the first difference on,
+while all other transactions reuse their previous results.
+"""
+
+import os
+import pickle
+from bisect import bisect_left
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+
+from logzero import logger
+
+from .cleaner import FieldCleaner
+from .transactions import finalize_fields, prepare_fields, transaction_import_id
+from .utils import CACHE_HOME
+
+STATE_DIR = CACHE_HOME / "reclean"
+STATE_VERSION = 1
+
+
+@dataclass(slots=True)
+class CleanedEntry:
+    date: object
+    amount: int
+    # Input of the cleaner, after splitting credit card purposes
+    original: dict
+    # Per field: (rule index, value after the rule, transformations) for every
+    # rule that changed something, in rule order
+    traces: dict
+    output: tuple
+
+
+@dataclass
+class Change:
+    entry: CleanedEntry
+    before: tuple
+    after: tuple
+
+
+class Recleaner:
+    def __init__(self, cleaner: FieldCleaner):
+        self.cleaner = cleaner
+        self.keys = {
+            field: [cleaner.rule_key(rule) for rule in rules]
+            for field, rules in cleaner.rules.items()
+        }
+        self.finalizer_keys = {
+            field: repr(definition) for field, definition in cleaner.finalizer_definitions.items()
+        }
+
+    def _replay_field(self, field, value, old_trace, opcodes):
+        """Clean a single value, reusing `old_trace` until the outcome may differ.
+
+        Returns the cleaned value, the new trace and whether any of the
+        changed rules had an effect on this value.
+        """
+        cleaners = self.cleaner.cleaners.get(field, [])
+        old_indices = [step[0] for step in old_trace]
+        trace = []
+        affected = False
+
+        for tag, i1, i2, j1, j2 in opcodes:
+            if not affected:
+                if tag == "equal":
+                    # Same rules, same input: take the old results
+                    for step in old_trace[bisect_left(old_indices, i1) : bisect_left(old_indices, i2)]:
+                        value = step[1]
+                        trace.append((step[0] - i1 + j1, step[1], step[2]))
+                    continue
+                if tag != "insert" and bisect_left(old_indices, i1) != bisect_left(old_indices, i2):
+                    # A rule that changed this value is gone
+                    affected = True
+
+            for index in range(j1, j2):
+                cleaned, transformations = cleaners[index](value)
+                if cleaned != value or transformations:
+                    trace.append((index, cleaned, transformations))
+                    affected = True
+                value = cleaned
+
+        return value, trace, affected
+
+    def clean(self, original, old_traces=None, opcodes=None, old_output=None):
+        """Clean fields like `FieldCleaner.clean`, returning output, traces and affectedness.
+
+        If `old_output` is given and no changed rule affected the transaction,
+        it is returned as is instead of finalizing the fields again.
+        """
+        data = dict(original)
+        traces = {}
+        transformations = {}
+        affected = old_traces is None
+        for field, value in self.cleaner.iter_valid_data_fields(original):
+            if old_traces is None:
+                field_opcodes = [("insert", 0, 0, 0, len(self.keys.get(field, [])))]
+                old_trace = []
+            else:
+                field_opcodes = opcodes[field]
+                old_trace = old_traces.get(field, [])
+            data[field], traces[field], field_affected = self._replay_field(field, value, old_trace, field_opcodes)
+            affected = affected or field_affected
+            for step in traces[field]:
+                transformations.update(step[2])
+
+        if old_output is not None and not affected:
+            return old_output, traces, affected
+
+        data.update(transformations)
+        for field, value in self.cleaner.iter_valid_data_fields(data):
+            if field in self.cleaner.finalizers:
+                data[field] = self.cleaner.finalizers[field](value)
+
+        return finalize_fields(data), traces, affected
+
+    def opcodes(self, old_keys):
+        return {
+            field: SequenceMatcher(None, old_keys.get(field, []), keys, autojunk=False).get_opcodes()
+            for field, keys in self.keys.items()
+        }
+
+    def reclean(self, raw_transactions, state=None):
+        """Clean `raw_transactions` incrementally against a previous state.
+
+        Returns the new state, the changed entries and the number of
+        transactions that had to be cleaned again.
+        """
+        if state and state.get("version") != STATE_VERSION:
+            state = None
+        old_entries = state["entries"] if state else {}
+        opcodes = self.opcodes(state["rules"]) if state else None
+        # Rules unchanged for all fields: previous entries can be taken over as is
+        unchanged_rules = bool(state) and all(
+            [op[0] for op in field_opcodes] in ([], ["equal"]) for field_opcodes in opcodes.values()
+        )
+        # Finalizers have no trace, a change to them means finalizing everything again
+        reuse_output = bool(state) and state.get("finalizers") == self.finalizer_keys
+
+        entries = {}
+        changes = []
+        recomputed = 0
+        for data in raw_transactions:
+            if not data:
+                continue
+            entry_date = data.get("entry_date") or data["date"]
+            amount = round(data["amount"].amount * 1000)
+            import_id = transaction_import_id(data, entry_date, amount)
+            original = prepare_fields(data, self.cleaner.fields, tokenize_purpose=self.cleaner.tokenize_purpose)
+
+            old = old_entries.get(import_id)
+            if old is not None and old.original == original:
+                if unchanged_rules and reuse_output:
+                    entries[import_id] = old
+                    continue
+                output, traces, affected = self.clean(
+                    original,
+                    old.traces,
+                    opcodes,
+                    old.output if reuse_output else None,
+                )
+            else:
+                output, traces, affected = self.clean(original)
+            recomputed += affected
+
+            entry = CleanedEntry(entry_date, amount, original, traces, output)
+            entries[import_id] = entry
+            if old is not None and old.output != output:
+                changes.append(Change(entry, old.output, output))
+
+        new_state = {
+            "version": STATE_VERSION,
+            "rules": self.keys,
+            "finalizers": self.finalizer_keys,
+            "entries": entries,
+        }
+        return new_state, changes, recomputed
+
+
+def state_filename(account):
+    # Per IBAN and app id, several configs or apps may sync the same IBAN
+    return STATE_DIR / f"{account.storage_name}.pickle"
+
+
+def read_state(account):
+    try:
+        with open(state_filename(account), "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        logger.warning(f"Ignoring unreadable reclean state for {account}: {exc}")
+        return None
+
+
+def write_state(account, state):
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    filename = state_filename(account)
+    temporary = filename.with_suffix(f".{os.getpid()}.tmp")
+    with open(temporary, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, filename)
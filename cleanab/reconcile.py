@@ -0,0 +1,147 @@
+"""Match transactions that banks report again in a changed form.
+
+Banks often list a pending transaction first and the booked version later,
+with a different purpose or entry date. Both get different import ids, so the
+apps would see two transactions. The index remembers recent transactions per
+account by amount and date. A new transaction matches an indexed one if both
+have the same amount, their dates lie within a small window, and the indexed
+transaction is no longer reported by the bank.
+"""
+
+import json
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+from logzero import logger
+
+from .utils import CACHE_HOME, atomic_write
+
+INDEX_DIR = CACHE_HOME / "reconcile"
+
+
+@dataclass(slots=True)
+class IndexEntry:
+    date: date
+    amount: int
+    import_id: str
+    applicant_name: str
+    purpose: str
+
+
+class ReconciliationIndex:
+    def __init__(self, entries=(), *, window_days=3):
+        self.window_days = window_days
+        self._by_id: dict[str, IndexEntry] = {}
+        self._by_amount_and_day: dict[tuple[int, int], list[IndexEntry]] = {}
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, import_id):
+        return import_id in self._by_id
+
+    def add(self, entry: IndexEntry):
+        self.remove(entry.import_id)
+        self._by_id[entry.import_id] = entry
+        self._by_amount_and_day.setdefault((entry.amount, entry.date.toordinal()), []).append(entry)
+
+    def remove(self, import_id):
+        if (entry := self._by_id.pop(import_id, None)) is None:
+            return
+        bucket = self._by_amount_and_day[(entry.amount, entry.date.toordinal())]
+        bucket.remove(entry)
+        if not bucket:
+            del self._by_amount_and_day[(entry.amount, entry.date.toordinal())]
+
+    def candidates(self, amount, day: date):
+        """Indexed transactions with this amount within the date window, closest first.
+
+        A constant number of dict lookups, independent of the index size.
+        """
+        ordinal = day.toordinal()
+        for offset in sorted(range(-self.window_days, self.window_days + 1), key=abs):
+            yield from self._by_amount_and_day.get((amount, ordinal + offset), ())
+
+    def reconcile(self, records, *, earliest, reuse=True):
+        """Match new `records` against the index, returns (record, previous import id) pairs.
+
+        `records` must be everything the bank reports from `earliest` on, an
+        indexed transaction missing from them counts as replaced. With
+        `reuse`, matched records take over the import id of the transaction
+        they replace, so the apps treat them as duplicates.
+        """
+        reported = {record.import_id for record in records}
+        claimed = set()
+        matches = []
+        for record in records:
+            if record.import_id in self._by_id:
+                continue
+            for candidate in self.candidates(record.amount, record.date):
+                if (
+                    candidate.import_id in reported
+                    or candidate.import_id in claimed
+                    # Left the fetched time span, not replaced
+                    or candidate.date < earliest
+                ):
+                    continue
+                claimed.add(candidate.import_id)
+                matches.append((record, candidate.import_id))
+                break
+
+        for record, previous_id in matches:
+            if reuse:
+                logger.info(
+                    f"Reconciled {record.applicant_name!r} ({record.date}, {record.amount / 1000:.2f}) "
+                    f"with previously imported {previous_id}"
+                )
+                record.import_id = previous_id
+            else:
+                logger.warning(
+                    f"{record.applicant_name!r} ({record.date}, {record.amount / 1000:.2f}) "
+                    f"probably replaces previously imported {previous_id}"
+                )
+        return matches
+
+    def update(self, records, *, retention_days, today):
+        for record in records:
+            self.add(
+                IndexEntry(record.date, record.amount, record.import_id, record.applicant_name, record.purpose)
+            )
+        cutoff = today - timedelta(days=retention_days)
+        for entry in [entry for entry in self._by_id.values() if entry.date < cutoff]:
+            self.remove(entry.import_id)
+
+    def to_json(self):
+        return [
+            [entry.date.isoformat(), entry.amount, entry.import_id, entry.applicant_name, entry.purpose]
+            for entry in self._by_id.values()
+        ]
+
+    @classmethod
+    def from_json(cls, rows, **kwargs):
+        return cls(
+            (IndexEntry(date.fromisoformat(row[0]), *row[1:]) for row in rows),
+            **kwargs,
+        )
+
+
+def index_filename(account):
+    return INDEX_DIR / f"{account.storage_name}.json"
+
+
+def load_index(account, *, window_days):
+    try:
+        with open(index_filename(account)) as f:
+            return ReconciliationIndex.from_json(json.load(f), window_days=window_days)
+    except FileNotFoundError:
+        return ReconciliationIndex(window_days=window_days)
+    except (OSError, ValueError) as exc:
+        logger.warning(f"Ignoring unreadable reconciliation index for {account}: {exc}")
+        return ReconciliationIndex(window_days=window_days)
+
+
+def save_index(account, index):
+    with atomic_write(index_filename(account)) as f:
+        json.dump(index.to_json(), f)
@@ -0,0 +1,211 @@
+"""Find regular expressions that are prone to catastrophic backtracking.
+
+The check works on the parse tree of a pattern and looks for the two classic
+shapes behind exponential run times:
+
+- an unbounded repeat that contains another unbounded repeat, without
+  something in between that tells the iterations apart, like `(\\w+\\s?)+`
+- an unbounded repeat of alternatives that can start with the same
+  character, like `(ab|a.)+`
+
+Character sets are approximated on Latin-1 and Latin Extended-A, which
+covers what German banks send. Possessive repeats and atomic groups never
+backtrack and are skipped.
+"""
+
+import re
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+ALPHABET = frozenset(map(chr, range(0x17F + 1)))
+
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: r"\d",
+    sre_constants.CATEGORY_NOT_DIGIT: r"\D",
+    sre_constants.CATEGORY_SPACE: r"\s",
+    sre_constants.CATEGORY_NOT_SPACE: r"\S",
+    sre_constants.CATEGORY_WORD: r"\w",
+    sre_constants.CATEGORY_NOT_WORD: r"\W",
+}
+_CATEGORY_CHARS = {
+    category: frozenset(c for c in ALPHABET if re.fullmatch(expression, c))
+    for category, expression in _CATEGORIES.items()
+}
+
+_UNBOUNDED_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+_REPEATS = (*_UNBOUNDED_REPEATS, getattr(sre_constants, "POSSESSIVE_REPEAT", None))
+_ATOMIC_GROUP = getattr(sre_constants, "ATOMIC_GROUP", None)
+
+
+def _in_chars(items):
+    chars = set()
+    negate = False
+    for op, value in items:
+        if op is sre_constants.NEGATE:
+            negate = True
+        elif op is sre_constants.LITERAL:
+            chars.add(chr(value))
+        elif op is sre_constants.RANGE:
+            chars.update(map(chr, range(value[0], min(value[1], 0x17F) + 1)))
+        elif op is sre_constants.CATEGORY:
+            chars |= _CATEGORY_CHARS.get(value, ALPHABET)
+        else:
+            chars |= ALPHABET
+    return ALPHABET - chars if negate else chars
+
+
+class _Analysis:
+    def __init__(self, ignore_case):
+        self.ignore_case = ignore_case
+        self.problems = []
+
+    def _fold(self, chars):
+        if not self.ignore_case:
+            return frozenset(chars)
+        return frozenset(chars) | frozenset(c.swapcase() for c in chars)
+
+    def chars(self, op, value):
+        """Characters a single-character node can match, None for other nodes."""
+        if op is sre_constants.LITERAL:
+            return self._fold({chr(value)})
+        if op is sre_constants.NOT_LITERAL:
+            return ALPHABET - self._fold({chr(value)})
+        if op is sre_constants.ANY:
+            return ALPHABET
+        if op is sre_constants.IN:
+            return self._fold(_in_chars(value))
+        return None
+
+    def first(self, sequence):
+        """Characters a sequence can start with, and whether it can match empty."""
+        result = set()
+        for op, value in sequence:
+            chars, nullable = self.first_node(op, value)
+            result |= chars
+            if not nullable:
+                return result, False
+        return result, True
+
+    def first_node(self, op, value):
+        if (chars := self.chars(op, value)) is not None:
+            return chars, False
+        if op is sre_constants.SUBPATTERN:
+            return self.first(value[-1])
+        if op is _ATOMIC_GROUP:
+            return self.first(value)
+        if op in _REPEATS:
+            chars, nullable = self.first(value[2])
+            return chars, nullable or value[0] == 0
+        if op is sre_constants.BRANCH:
+            result, nullable = set(), False
+            for branch in value[1]:
+                chars, branch_nullable = self.first(branch)
+                result |= chars
+                nullable = nullable or branch_nullable
+            return result, nullable
+        if op is sre_constants.GROUPREF_EXISTS:
+            yes, yes_nullable = self.first(value[1])
+            no, no_nullable = self.first(value[2]) if value[2] else (set(), True)
+            return yes | no, yes_nullable or no_nullable
+        if op is sre_constants.GROUPREF:
+            return set(ALPHABET), True
+        # Anchors and lookarounds consume nothing
+        return set(), True
+
+    def all_chars(self, sequence):
+        result = set()
+        for op, value in sequence:
+            if (chars := self.chars(op, value)) is not None:
+                result |= chars
+            else:
+                for child in self.children(op, value):
+                    result |= self.all_chars(child)
+        return result
+
+    @staticmethod
+    def children(op, value):
+        if op is sre_constants.SUBPATTERN:
+            return [value[-1]]
+        if op is _ATOMIC_GROUP:
+            return [value]
+        if op in _REPEATS:
+            return [value[2]]
+        if op is sre_constants.BRANCH:
+            return value[1]
+        if op is sre_constants.GROUPREF_EXISTS:
+            return [value[1], value[2]] if value[2] else [value[1]]
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return [value[1]]
+        return []
+
+    def inner_repeats(self, sequence):
+        """Unbounded, backtracking repeats in a sequence, at any depth."""
+        for op, value in sequence:
+            if op is _ATOMIC_GROUP or op is getattr(sre_constants, "POSSESSIVE_REPEAT", None):
+                continue
+            if op in _UNBOUNDED_REPEATS and value[1] == sre_constants.MAXREPEAT:
+                yield value[2]
+            for child in self.children(op, value):
+                yield from self.inner_repeats(child)
+
+    def flatten(self, sequence):
+        """Inline groups, `(a(b))` and `ab` are the same sequence of elements."""
+        flat = []
+        for op, value in sequence:
+            if op is sre_constants.SUBPATTERN:
+                flat += self.flatten(value[-1])
+            else:
+                flat.append((op, value))
+        return flat
+
+    def check_repeat(self, body):
+        body = self.flatten(body)
+        # Elements of one iteration that always match something
+        mandatory = [
+            (index, self.all_chars([node]))
+            for index, node in enumerate(body)
+            if not self.first_node(*node)[1]
+        ]
+        for index, node in enumerate(body):
+            for inner in self.inner_repeats([node]):
+                inner_chars = self.all_chars(inner)
+                separated = any(
+                    other != index and not (chars & inner_chars) for other, chars in mandatory
+                )
+                if not separated:
+                    self.problems.append(
+                        "an unbounded repeat contains another unbounded repeat that can match the same text"
+                    )
+                    return
+
+        for op, value in body:
+            if op is not sre_constants.BRANCH:
+                continue
+            seen = set()
+            for branch in value[1]:
+                chars, _ = self.first(branch)
+                if chars & seen:
+                    self.problems.append("alternatives inside an unbounded repeat can match the same text")
+                    return
+                seen |= chars
+
+    def walk(self, sequence):
+        for op, value in sequence:
+            if op in _UNBOUNDED_REPEATS and value[1] == sre_constants.MAXREPEAT:
+                self.check_repeat(value[2])
+            for child in self.children(op, value):
+                self.walk(child)
+
+
+def lint_pattern(pattern, flags=0):
+    """Return descriptions of the backtracking problems found in `pattern`."""
+    parsed = sre_parse.parse(pattern, flags)
+    ignore_case = bool((flags | parsed.state.flags) & re.IGNORECASE)
+    analysis = _Analysis(ignore_case)
+    analysis.walk(parsed)
+    return list(dict.fromkeys(analysis.problems))
@@ -0,0 +1,78 @@
+"""What the last successful sync of an account saw, kept between runs."""
+
+import json
+from dataclasses import asdict, dataclass, fields
+from hashlib import sha256
+
+from logzero import logger
+
+from .mapping import file_digest
+from .utils import CACHE_HOME, atomic_write
+
+STATE_DIR = CACHE_HOME / "state"
+
+
+@dataclass
+class AccountState:
+    # Booked balance reported by the bank, e.g. "1234.56 EUR"
+    balance: str | None = None
+    # Unix time of the last sync that downloaded the transactions
+    synced_at: float = 0.0
+    # Unix time of the last sync, also counting ones that only probed the balance
+    checked_at: float = 0.0
+    # Newest booking date the last download covered, as ISO date. A probed
+    # balance dated after it may contain bookings not downloaded yet
+    watermark: str | None = None
+    # Of the raw transactions, rules and app config of the last sync, see `fingerprint`
+    fingerprint: str | None = None
+
+    def to_json(self):
+        return asdict(self)
+
+    @classmethod
+    def from_json(cls, data):
+        known = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in known})
+
+
+def config_fingerprint(config) -> str:
+    """Hash of everything in the config that changes what is uploaded for the same raw transactions."""
+    digest = sha256()
+    for model in (config.pre_replacements, config.replacements, config.finalizer, config.cleanab.reconcile):
+        digest.update(model.model_dump_json().encode("utf-8") if model else b"null")
+    if config.cleanab.tokenize_purpose:
+        digest.update(b"tokenize_purpose")
+    for field, path in config.mappings:
+        digest.update(f"{field}:{file_digest(path) if path else None}".encode("utf-8"))
+    for name, app_config in sorted(config.apps.items()):
+        digest.update(f"{name}:{app_config.model_dump_json()}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def fingerprint(account, raw_transactions, config_fingerprint) -> str:
+    """Hash of an account's raw transactions, its settings and the config fingerprint."""
+    digest = sha256(config_fingerprint.encode("utf-8"))
+    # How often the account is synced does not change what is uploaded
+    digest.update(account.model_dump_json(exclude={"refresh_interval"}).encode("utf-8"))
+    digest.update(json.dumps(raw_transactions, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def state_filename(account):
+    return STATE_DIR / f"{account.storage_name}.json"
+
+
+def load_state(account) -> AccountState:
+    try:
+        with open(state_filename(account)) as f:
+            return AccountState.from_json(json.load(f))
+    except FileNotFoundError:
+        return AccountState()
+    except (OSError, ValueError, TypeError) as exc:
+        logger.warning(f"Ignoring unreadable state for {account}: {exc}")
+        return AccountState()
+
+
+def save_state(account, state: AccountState):
+    with atomic_write(state_filename(account)) as f:
+        json.dump(state.to_json(), f)
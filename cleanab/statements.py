@@ -0,0 +1,204 @@
+"""Read transactions from MT940 and CAMT.053 statement files.
+
+Files are read as a stream, one MT940 statement or one CAMT entry at a
+time, so memory use does not grow with the file size. Every transaction is
+yielded as the same dict `retrieve_transactions` returns for FinTS,
+together with the account it belongs to: an IBAN, or for MT940 files
+possibly "BLZ/account number".
+
+With several files and `jobs` > 1, files are parsed in worker processes.
+Each worker spools its transactions to a temporary file, which is then read
+back one transaction at a time.
+"""
+
+import datetime
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from pathlib import Path
+
+from logzero import logger
+
+MT940_ENCODING = "iso-8859-1"
+CAMT_SUFFIXES = (".xml", ".camt")
+
+
+def _strip_namespaces(element):
+    for child in element.iter():
+        if isinstance(child.tag, str) and "}" in child.tag:
+            child.tag = child.tag.split("}", 1)[1]
+
+
+def iter_mt940_messages(path):
+    """The statements of an MT940 file, one string each."""
+    lines = []
+    with open(path, encoding=MT940_ENCODING, newline="") as f:
+        for line in f:
+            if line.startswith(":20:") and any(existing.strip() for existing in lines):
+                yield "".join(lines)
+                lines = []
+            lines.append(line)
+    if any(line.strip() for line in lines):
+        yield "".join(lines)
+
+
+def iter_mt940(path):
+    """Yield (account, transaction dict) for each transaction of an MT940 file."""
+    import mt940
+
+    for message in iter_mt940_messages(path):
+        # Like fints.utils.mt940_to_array, per statement
+        message = message.replace("@@", "\r\n").replace("-0000", "+0000")
+        transactions = mt940.models.Transactions()
+        parsed = transactions.parse(message)
+        account = transactions.data.get("account_identification")
+        for transaction in parsed:
+            yield account, transaction.data
+
+
+def _camt_date(element, path):
+    text = element.findtext(f"{path}/Dt") or element.findtext(f"{path}/DtTm")
+    return datetime.date.fromisoformat(text[:10]) if text else None
+
+
+def _camt_entry(entry, currency):
+    """The transaction dict of a CAMT entry, with the keys fints gives a FinTS transaction."""
+    from fints.models import Amount
+
+    _strip_namespaces(entry)
+    amount = entry.find("Amt")
+    currency = amount.get("Ccy", currency) if amount is not None else currency
+    value = Decimal(amount.text.strip()) if amount is not None else Decimal(0)
+    status = "C" if entry.findtext("CdtDbtInd") == "CRDT" else "D"
+    details = entry.find("NtryDtls/TxDtls")
+    if details is None:
+        details = entry
+
+    # The other party: the debtor of a credit, the creditor of a debit
+    side = "Dbtr" if status == "C" else "Cdtr"
+    # Before camt.053.001.08, parties have no Pty level
+    name = details.findtext(f"RltdPties/{side}/Pty/Nm") or details.findtext(f"RltdPties/{side}/Nm")
+    # Like fints, several lines of remittance information are joined as they are
+    purpose = "".join(line.text or "" for line in details.iterfind("RmtInf/Ustrd")) or None
+    entry_date = _camt_date(entry, "BookgDt")
+    return {
+        "status": status,
+        "amount": Amount(-value if status == "D" else value, currency),
+        "currency": currency,
+        "date": _camt_date(entry, "ValDt") or entry_date,
+        "entry_date": entry_date,
+        "guessed_entry_date": entry_date,
+        "applicant_name": name,
+        "applicant_iban": details.findtext(f"RltdPties/{side}Acct/Id/IBAN"),
+        "purpose": purpose,
+        "end_to_end_reference": details.findtext("Refs/EndToEndId"),
+        "bank_reference": entry.findtext("AcctSvcrRef"),
+    }
+
+
+def iter_camt053(path):
+    """Yield (account, transaction dict) for each booked entry of a CAMT.053 file."""
+    from lxml import etree
+
+    account = currency = None
+    for _, element in etree.iterparse(str(path), events=("end",), tag=("{*}Acct", "{*}Ntry")):
+        parent = element.getparent()
+        if etree.QName(element).localname == "Acct":
+            if parent is not None and etree.QName(parent).localname in ("Stmt", "Rpt"):
+                account = element.findtext("{*}Id/{*}IBAN") or element.findtext("{*}Id/{*}Othr/{*}Id")
+                currency = element.findtext("{*}Ccy")
+            continue
+
+        status = element.findtext("{*}Sts/{*}Cd") or element.findtext("{*}Sts")
+        if status != "PDNG":
+            yield account, _camt_entry(element, currency)
+        # Drop the entries already read, keeps the tree from growing
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def is_camt(path):
+    path = Path(path)
+    if path.suffix.lower() in CAMT_SUFFIXES:
+        return True
+    with open(path, "rb") as f:
+        return f.read(64).lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<")
+
+
+def iter_statement_file(path):
+    logger.debug(f"Reading {path}")
+    if is_camt(path):
+        yield from iter_camt053(path)
+    else:
+        yield from iter_mt940(path)
+
+
+def statement_files(paths):
+    """The files given, with directories replaced by the files in them."""
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(p for p in path.rglob("*") if p.is_file() and not p.name.startswith("."))
+        else:
+            yield path
+
+
+def _spool(path, directory):
+    fd, spool = tempfile.mkstemp(suffix=".pickle", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        for item in iter_statement_file(path):
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return spool
+
+
+def _read_spool(spool):
+    with open(spool, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+    os.unlink(spool)
+
+
+def iter_statements(paths, *, jobs=1):
+    """Yield (account, transaction dict) for all transactions in `paths`, file by file."""
+    files = list(statement_files(paths))
+    if jobs <= 1 or len(files) <= 1:
+        for path in files:
+            yield from iter_statement_file(path)
+        return
+
+    directory = tempfile.mkdtemp(prefix="cleanab-import-")
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending = []
+            files = iter(files)
+            while True:
+                # Keep a few files ahead, not all spools of a large backfill at once
+                while len(pending) < 2 * jobs and (path := next(files, None)) is not None:
+                    pending.append(executor.submit(_spool, path, directory))
+                if not pending:
+                    break
+                yield from _read_spool(pending.pop(0).result())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def find_account(accounts, identification):
+    """The configured account a statement's account identification refers to."""
+    if not identification:
+        return None
+    identification = identification.replace(" ", "").upper()
+    for account in accounts:
+        iban = account.iban.replace(" ", "").upper()
+        if identification == iban:
+            return account
+        bank_code, _, number = identification.partition("/")
+        # German IBANs hold the BLZ and the zero-padded account number
+        if number and iban.startswith("DE") and iban[4:12] == bank_code and iban[12:].lstrip("0") == number.lstrip("0"):
+            return account
+    return None
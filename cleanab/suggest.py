@@ -0,0 +1,178 @@
+"""Suggest replacement rules by clustering similar values of cached transactions.
+
+Values are compared by the character 3-grams they share. Every distinct
+value gets a MinHash signature, computed for all values at once with numpy,
+and locality-sensitive hashing over bands of the signatures finds the
+values that are likely similar without comparing every pair. Candidates
+whose estimated similarity reaches the threshold end up in one cluster, and
+each cluster becomes a rule replacing its values with their common prefix.
+
+Values are clustered as the current rules leave them, so the suggestions go
+after the existing replacements of their field. Needs numpy, see the
+`suggest` extra.
+"""
+
+import re
+from collections import Counter
+from dataclasses import dataclass
+from os.path import commonprefix
+
+import numpy as np
+
+from .models.cleaner import ReplacementDefinition
+from .transactions import prepare_fields
+
+NGRAM = 3
+PERMUTATIONS = 64
+BANDS = 16
+# Values whose 3-grams are hashed and permuted at once, bounds the memory used
+CHUNK_SIZE = 2000
+# Shorter common prefixes are not specific enough to replace a value with
+MIN_PREFIX = 4
+
+
+@dataclass
+class Suggestion:
+    field: str
+    rule: ReplacementDefinition
+    # Transactions the rule changes
+    transactions: int
+    # Distinct values of the cluster, most frequent first
+    values: list[str]
+
+
+def normalize(value):
+    """Digits and case ignored, padded so the first and last character get their own 3-grams."""
+    return " " + re.sub(r"\d", "0", " ".join(value.casefold().split())) + " "
+
+
+def shingles(values):
+    """The 3-grams of the UTF-8 encoded `values` as integers, and how many each value has."""
+    encoded = [normalize(value).encode("utf-8") for value in values]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+    grams = data[:-2] << np.uint64(16) | data[1:-1] << np.uint64(8) | data[2:]
+    # Drop the 3-grams spanning two values
+    ends = np.cumsum(lengths)[:-1]
+    keep = np.ones(len(grams), dtype=bool)
+    keep[ends - 2] = keep[ends - 1] = False
+    return grams[keep], lengths - (NGRAM - 1)
+
+
+def signatures(values, permutations=PERMUTATIONS, seed=1):
+    """MinHash signatures of `values`, one row per value."""
+    rng = np.random.default_rng(seed)
+    # Multiply-shift hashing, one random odd multiplier per permutation
+    a = rng.integers(0, 1 << 63, size=permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 1 << 63, size=permutations, dtype=np.uint64)
+    result = np.empty((len(values), permutations), dtype=np.uint32)
+    # Values of similar length together, they are padded to the longest of their chunk
+    by_length = np.argsort([len(value) for value in values], kind="stable")
+    for start in range(0, len(values), CHUNK_SIZE):
+        rows = by_length[start : start + CHUNK_SIZE]
+        grams, counts = shingles([values[row] for row in rows])
+        # Far fewer distinct 3-grams than 3-grams, hash each only once
+        distinct, index = np.unique(grams, return_inverse=True)
+        hashed = ((distinct[:, None] * a + b) >> np.uint64(32)).astype(np.uint32)
+        # An extra row that never is the minimum, for the padding
+        hashed = np.vstack([hashed, np.full((1, permutations), np.iinfo(np.uint32).max, dtype=np.uint32)])
+        padded = np.full((len(rows), counts.max()), len(distinct))
+        padded[np.arange(counts.max()) < counts[:, None]] = index
+        result[rows] = hashed[padded].min(axis=1)
+    return result
+
+
+def cluster(signature_matrix, threshold, bands=BANDS):
+    """Group rows with an estimated Jaccard similarity of at least `threshold`.
+
+    Returns a cluster label per row.
+    """
+    count, permutations = signature_matrix.shape
+    rows = permutations // bands
+    # Combines the rows of a band into a single key
+    band_hash = np.random.default_rng(0).integers(1, 1 << 63, size=rows, dtype=np.uint64)
+    sources, targets = [], []
+
+    for band in range(bands):
+        keys = signature_matrix[:, band * rows : (band + 1) * rows].astype(np.uint64)
+        bucket = (keys * band_hash).sum(axis=1)
+        order = np.argsort(bucket, kind="stable")
+        sorted_buckets = bucket[order]
+        starts = np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]]
+        # The first row of each bucket, compared with the other rows of the bucket
+        representative = order[starts][np.cumsum(starts) - 1]
+        members = order != representative
+        if not members.any():
+            continue
+        candidates, representatives = order[members], representative[members]
+        similar = (signature_matrix[candidates] == signature_matrix[representatives]).mean(axis=1) >= threshold
+        sources.append(candidates[similar])
+        targets.append(representatives[similar])
+
+    # Connected components of the similar pairs: every row takes the lowest
+    # label among its neighbours until nothing changes
+    labels = np.arange(count)
+    if not sources:
+        return labels
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+    while True:
+        previous = labels.copy()
+        lowest = np.minimum(labels[sources], labels[targets])
+        np.minimum.at(labels, sources, lowest)
+        np.minimum.at(labels, targets, lowest)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def rule_for(values):
+    """A rule replacing all `values` (most frequent first) with one name."""
+    prefix = commonprefix([value.casefold() for value in values])
+    prefix = re.sub(r"[\W_]+$", "", values[0][: len(prefix)])
+    if len(prefix) >= MIN_PREFIX:
+        return ReplacementDefinition(pattern=f"^{re.escape(prefix)}.*$", repl=prefix)
+    alternatives = "|".join(re.escape(value) for value in values)
+    return ReplacementDefinition(pattern=f"^(?:{alternatives})$", repl=values[0])
+
+
+def value_counts(raw_transactions, cleaner, field):
+    """How often each value of `field` occurs after the current rules."""
+    counts = Counter()
+    for data in raw_transactions:
+        if not data:
+            continue
+        if value := prepare_fields(data, cleaner.fields, tokenize_purpose=cleaner.tokenize_purpose).get(field):
+            counts[value] += 1
+    cleaned = Counter()
+    for value, occurrences in counts.items():
+        if (value := cleaner.clean_field(field, value)[0]).strip():
+            cleaned[value] += occurrences
+    return cleaned
+
+
+def suggest_rules(raw_transactions, cleaner, fields, *, threshold=0.6, min_values=2):
+    """Suggested rules for `fields`, the ones changing the most transactions first."""
+    raw_transactions = list(raw_transactions)
+    suggestions = []
+    for field in fields:
+        counts = value_counts(raw_transactions, cleaner, field)
+        values = list(counts)
+        if len(values) < min_values:
+            continue
+        labels = cluster(signatures(values), threshold)
+
+        clusters = {}
+        for value, label in zip(values, labels):
+            clusters.setdefault(label, []).append(value)
+        for members in clusters.values():
+            if len(members) < min_values:
+                continue
+            members.sort(key=lambda value: (-counts[value], value))
+            rule = rule_for(members)
+            clean = rule.get_cleaner()
+            changed = sum(counts[value] for value in members if clean(value)[0] != value)
+            if changed:
+                suggestions.append(Suggestion(field, rule, changed, members))
+
+    suggestions.sort(key=lambda suggestion: -suggestion.transactions)
+    return suggestions
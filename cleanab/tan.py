@@ -0,0 +1,409 @@
+"""Hand TAN challenges to the user without blocking other accounts.
+
+A fetch that needs a TAN (or a choice, like the TAN mechanism) submits a
+challenge to the `TanBroker` and waits for the answer, while other logins
+keep fetching and uploading. The broker passes challenges to a channel:
+
+- `TerminalChannel` prompts on the terminal, one challenge at a time
+- `SocketChannel` serves them on a unix socket: `list`, `show ID`, `tan ID VALUE`
+- `FileChannel` writes `<id>.json` (and `<id>.png` for photoTAN) to a
+  directory and waits for the answer in `<id>.tan`, for headless setups
+
+Challenge ids are random, several processes can share the directory. Any
+unique prefix of an id can be used to answer it.
+
+If no answer arrives on the socket or in the directory within the timeout,
+the waiting fetch fails with `TanTimeout` and the other accounts are not
+affected. Terminal prompts wait for their answer, an expired prompt would
+keep blocking the terminal.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from io import BytesIO
+from pathlib import Path
+from uuid import uuid4
+
+from logzero import logger
+
+from .utils import CACHE_HOME
+
+DEFAULT_SOCKET = CACHE_HOME / "tan.sock"
+DEFAULT_DIRECTORY = CACHE_HOME / "tan"
+FILE_POLL_INTERVAL = 1
+
+# Ends the prompt loop of a TerminalChannel
+_STOP = object()
+
+# Socket servers by path, shared by the brokers of all configs run in this process
+_socket_servers: dict[Path, "_SocketServer"] = {}
+_socket_servers_lock = threading.Lock()
+
+
+class TanTimeout(Exception):
+    """No answer to a TAN challenge arrived in time."""
+
+
+@dataclass(eq=False)
+class TanChallenge:
+    # Who is asking, e.g. the login
+    source: str
+    text: str
+    # Answers to pick from, by index, for choices like the TAN mechanism
+    options: list[str] = field(default_factory=list)
+    hhduc: str | None = None
+    # (mime type, image bytes) of a photoTAN/QR challenge
+    matrix: tuple[str, bytes] | None = None
+    id: str = field(default_factory=lambda: uuid4().hex)
+    created: float = field(default_factory=time.time)
+    answer: str | None = None
+    _answered: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    def describe(self):
+        lines = [f"[{self.id}] {self.source}: {self.text}"]
+        lines += [f"  {i}: {option}" for i, option in enumerate(self.options)]
+        return "\n".join(lines)
+
+
+class TanBroker:
+    def __init__(self, channel, *, timeout=300):
+        self.channel = channel
+        self.timeout = timeout
+        self._pending: dict[str, TanChallenge] = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def pending(self):
+        with self._lock:
+            return sorted(self._pending.values(), key=lambda challenge: challenge.created)
+
+    def get(self, challenge_id):
+        """The pending challenge with this id or unique id prefix."""
+        if not challenge_id:
+            return None
+        with self._lock:
+            if challenge_id in self._pending:
+                return self._pending[challenge_id]
+            matches = [challenge for key, challenge in self._pending.items() if key.startswith(challenge_id)]
+        return matches[0] if len(matches) == 1 else None
+
+    def request(self, challenge: TanChallenge) -> str:
+        """Queue `challenge` and wait for its answer."""
+        with self._lock:
+            if not self._started:
+                # Channels only open sockets or threads once a TAN is needed
+                self.channel.start(self)
+                self._started = True
+            self._pending[challenge.id] = challenge
+        logger.info(f"Waiting for TAN {challenge.id} of {challenge.source} ({self.channel})")
+        self.channel.submit(challenge)
+        try:
+            if not challenge._answered.wait(self.timeout):
+                raise TanTimeout(f"No answer for TAN {challenge.id} of {challenge.source} within {self.timeout}s")
+        finally:
+            with self._lock:
+                self._pending.pop(challenge.id, None)
+            self.channel.withdraw(challenge)
+        return challenge.answer
+
+    def answer(self, challenge_id, value) -> bool:
+        challenge = self.get(challenge_id)
+        if challenge is None:
+            return False
+        challenge.answer = value.strip()
+        challenge._answered.set()
+        return True
+
+    def choose(self, source, text, options) -> int:
+        while True:
+            answer = self.request(TanChallenge(source, text, options=list(options)))
+            if answer.isdigit() and int(answer) < len(options):
+                return int(answer)
+            logger.error(f"Invalid choice {answer!r}")
+
+    def close(self):
+        if self._started:
+            self.channel.stop()
+            self._started = False
+
+
+class TerminalChannel:
+    """Prompt on the terminal, one challenge after another."""
+
+    # Shared by the brokers of all configs run in this process
+    _terminal = threading.Lock()
+
+    def __init__(self):
+        self._queue = deque()
+        self._available = threading.Condition()
+        self._thread = None
+
+    def __str__(self):
+        return "terminal"
+
+    def start(self, broker):
+        self._broker = broker
+        with self._available:
+            if _STOP in self._queue:
+                self._queue.remove(_STOP)
+            # Still waiting for the answer to a prompt, there is one stdin
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._prompt_forever, name="tan-terminal", daemon=True)
+        self._thread.start()
+
+    def submit(self, challenge):
+        with self._available:
+            self._queue.append(challenge)
+            self._available.notify()
+
+    def withdraw(self, challenge):
+        with self._available:
+            if challenge in self._queue:
+                self._queue.remove(challenge)
+
+    def stop(self):
+        with self._available:
+            self._queue.append(_STOP)
+            self._available.notify()
+
+    @staticmethod
+    def flicker(code, stopped, wait=0.05):
+        """Like `fints.hhd.flicker.terminal_flicker_unix`, until `stopped` is set."""
+        from fints.hhd.flicker import code_to_bitstream
+
+        high, low, std = "\033[48;05;15m", "\033[48;05;0m", "\033[0m"
+        stream = code_to_bitstream(code)
+        while not stopped.is_set():
+            for frame in stream:
+                fields = "".join(low + "   " + (high if bit == "1" else low) + "   " for bit in frame)
+                print(fields + low + "   " + std)
+                if stopped.wait(wait):
+                    return
+
+    def show(self, challenge):
+        if challenge.hhduc:
+            logger.info("Please use your TAN generator to generate a TAN, press enter when done.")
+            # Ctrl-C only reaches the main thread, stop the flicker with enter instead
+            stopped = threading.Event()
+            flicker = threading.Thread(target=self.flicker, args=(challenge.hhduc, stopped), daemon=True)
+            flicker.start()
+            input()
+            stopped.set()
+            flicker.join()
+        elif challenge.matrix:
+            from PIL import Image
+
+            logger.info("Please use your bank's app to scan the QR code.")
+            Image.open(BytesIO(challenge.matrix[1])).show()
+            # Sleep a bit to give whatever application PIL uses to display the image time to start
+            time.sleep(5)
+
+    def _prompt_forever(self):
+        while True:
+            with self._available:
+                while not self._queue:
+                    self._available.wait()
+                challenge = self._queue.popleft()
+                if challenge is _STOP:
+                    self._thread = None
+                    return
+            if self._broker.get(challenge.id) is None:
+                continue
+            with self._terminal:
+                print(challenge.describe())
+                self.show(challenge)
+                answer = input("Choice: " if challenge.options else "Please enter the TAN: ")
+            if not self._broker.answer(challenge.id, answer):
+                logger.warning(f"TAN {challenge.id} was withdrawn in the meantime, dropped the answer")
+
+
+class _SocketHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline().decode("utf-8").strip()
+        if not line:
+            return
+        command, _, argument = line.partition(" ")
+        self.wfile.write(f"{self.server.handle_command(command.lower(), argument)}\n".encode("utf-8"))
+
+
+class _SocketServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.brokers: list[TanBroker] = []
+        super().__init__(str(path), _SocketHandler)
+
+    def find(self, challenge_id):
+        for broker in list(self.brokers):
+            if (challenge := broker.get(challenge_id)) is not None:
+                return broker, challenge
+        return None, None
+
+    def handle_command(self, command, argument):
+        if command == "list":
+            pending = sorted(
+                (challenge for broker in list(self.brokers) for challenge in broker.pending()),
+                key=lambda challenge: challenge.created,
+            )
+            return "\n".join(challenge.describe() for challenge in pending) or "no pending TANs"
+        if command == "show":
+            _, challenge = self.find(argument.strip())
+            if challenge is None:
+                return f"unknown challenge {argument!r}"
+            details = challenge.describe()
+            if challenge.hhduc:
+                details += f"\nflicker code: {challenge.hhduc}"
+            if challenge.matrix:
+                details += "\nphotoTAN image: use the file channel to receive it"
+            return details
+        if command == "tan":
+            challenge_id, _, value = argument.strip().partition(" ")
+            broker, challenge = self.find(challenge_id)
+            if challenge is not None and broker.answer(challenge.id, value):
+                return "ok"
+            return f"unknown challenge {challenge_id!r}"
+        return f"unknown command {command!r}"
+
+
+def _socket_in_use(path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(str(path))
+        return True
+    except OSError:
+        return False
+    finally:
+        client.close()
+
+
+class SocketChannel:
+    """Serve challenges on a unix socket, answered with `tan ID VALUE`.
+
+    Configs run in the same process share the socket. If another process
+    serves it already, this one falls back to a socket with its pid in the name.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.path = Path(path)
+        self._server = None
+
+    def __str__(self):
+        return f"socket {self.path}"
+
+    def start(self, broker):
+        self._broker = broker
+        with _socket_servers_lock:
+            if self.path not in _socket_servers:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                if _socket_in_use(self.path):
+                    fallback = self.path.with_name(f"{self.path.stem}-{os.getpid()}{self.path.suffix}")
+                    logger.warning(f"{self.path} is served by another process, using {fallback}")
+                    self.path = fallback
+                if self.path not in _socket_servers:
+                    # Left behind by a process that is gone
+                    self.path.unlink(missing_ok=True)
+                    server = _SocketServer(self.path)
+                    os.chmod(self.path, 0o600)
+                    threading.Thread(target=server.serve_forever, name="tan-socket", daemon=True).start()
+                    _socket_servers[self.path] = server
+            self._server = _socket_servers[self.path]
+            self._server.brokers.append(broker)
+
+    def submit(self, challenge):
+        logger.info(f"TAN needed:\n{challenge.describe()}\nAnswer with 'tan {challenge.id} <TAN>' on {self.path}")
+
+    def withdraw(self, challenge):
+        pass
+
+    def stop(self):
+        if not self._server:
+            return
+        with _socket_servers_lock:
+            self._server.brokers.remove(self._broker)
+            if not self._server.brokers:
+                self._server.shutdown()
+                self._server.server_close()
+                self.path.unlink(missing_ok=True)
+                del _socket_servers[self.path]
+        self._server = None
+
+
+class FileChannel:
+    """Drop challenges into a directory and pick up answers from `<id>.tan` files."""
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = Path(directory)
+        self._stopped = threading.Event()
+
+    def __str__(self):
+        return f"directory {self.directory}"
+
+    def start(self, broker):
+        self._broker = broker
+        self.directory.mkdir(parents=True, exist_ok=True, mode=0o700)
+        self._stopped.clear()
+        threading.Thread(target=self._poll_forever, name="tan-files", daemon=True).start()
+
+    def _files(self, challenge):
+        return [self.directory / f"{challenge.id}{suffix}" for suffix in (".json", ".png", ".tan")]
+
+    def submit(self, challenge):
+        description, image, answer = self._files(challenge)
+        # Never take a stale answer for this challenge's
+        answer.unlink(missing_ok=True)
+        if challenge.matrix:
+            image.write_bytes(challenge.matrix[1])
+        temporary = description.with_suffix(".tmp")
+        with open(temporary, "w") as f:
+            json.dump(
+                {
+                    "id": challenge.id,
+                    "source": challenge.source,
+                    "text": challenge.text,
+                    "options": challenge.options,
+                    "hhduc": challenge.hhduc,
+                    "image": image.name if challenge.matrix else None,
+                    "answer_file": f"{challenge.id}.tan",
+                },
+                f,
+                indent=2,
+            )
+        os.replace(temporary, description)
+        logger.info(f"TAN needed, see {description}, write the answer to {challenge.id}.tan")
+
+    def withdraw(self, challenge):
+        for path in self._files(challenge):
+            path.unlink(missing_ok=True)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _poll_forever(self):
+        while not self._stopped.wait(FILE_POLL_INTERVAL):
+            for challenge in self._broker.pending():
+                answer_file = self._files(challenge)[2]
+                try:
+                    answer = answer_file.read_text()
+                except FileNotFoundError:
+                    continue
+                if answer.strip():
+                    self._broker.answer(challenge.id, answer)
+
+
+def create_broker(config) -> TanBroker:
+    """Build the broker for a `TanConfig`."""
+    if config.channel == "socket":
+        channel = SocketChannel(config.socket or DEFAULT_SOCKET)
+    elif config.channel == "file":
+        channel = FileChannel(config.directory or DEFAULT_DIRECTORY)
+    else:
+        # Never times out, see the module docstring
+        return TanBroker(TerminalChannel(), timeout=None)
+    return TanBroker(channel, timeout=config.timeout)
@@ -1,12 +1,18 @@
 import re
 from datetime import date
 from hashlib import md5
+from sys import intern
 
 from logzero import logger
 
-from .models import FintsTransaction
+from .models import TransactionRecord
 
-re_cc_purpose = re.compile(r"^(.+?)([A-Z]{3})\s{3,}([0-9,]+)(.*)$")
+# Currency and amount of a credit card purpose, "<merchant> EUR   12,50 <rest>"
+re_cc_amount = re.compile(r"([A-Z]{3})\s{3,}([0-9,]+)")
+
+SEPA_TAGS = ("EREF", "KREF", "MREF", "CRED", "DEBT", "SVWZ", "ABWA", "ABWE", "IBAN", "BIC")
+# Purposes are joined from fixed-width lines, a tag can directly follow the previous value
+re_sepa_tag = re.compile("(" + "|".join(SEPA_TAGS) + r")\+")
 
 
 def process_transaction(transaction, cleaner):
@@ -18,28 +24,88 @@ def process_transaction(transaction, cleaner):
         return
 
     amount = round(data["amount"].amount * 1000)
+    import_id = transaction_import_id(data, entry_date, amount)
+
+    local_data = prepare_fields(data, cleaner.fields, tokenize_purpose=cleaner.tokenize_purpose)
+    local_data = cleaner.clean(local_data)
+
+    echo_if_changed(data, local_data, cleaner=cleaner, import_id=import_id)
+
+    applicant_name, purpose = finalize_fields(local_data)
+    return TransactionRecord(
+        entry_date,
+        amount,
+        intern(applicant_name),
+        intern(purpose),
+        import_id,
+    )
+
+
+def transaction_import_id(data, entry_date, amount):
     applicant_name = data.get("applicant_name", None) or ""
     purpose = data.get("purpose", None) or ""
-    import_id = md5(
+    return md5(
         (
             entry_date.strftime("%Y-%m-%d") + applicant_name + purpose + str(amount)
         ).encode("utf-8")
     ).hexdigest()
 
-    local_data = data.copy()
-    if len(applicant_name) == 0 and len(purpose) > 0:
-        result = re_cc_purpose.search(purpose)
-        if result:
-            splits = result.groups()
-            local_data["applicant_name"] = splits[0]
-            local_data["purpose"] = " ".join(splits[1:])
 
-    local_data = cleaner.clean(local_data)
+def split_sepa_purpose(purpose):
+    """Split a SEPA purpose into its tagged segments, e.g. {"EREF": …, "SVWZ": …}.
+
+    Text before the first tag is kept under "". Returns an empty dict if the
+    purpose has no tags.
+    """
+    segments = {}
+    tag, start = "", 0
+    for match in re_sepa_tag.finditer(purpose):
+        _add_segment(segments, tag, purpose[start : match.start()])
+        tag, start = match.group(1), match.end()
+    if tag:
+        _add_segment(segments, tag, purpose[start:])
+    return segments
 
-    echo_if_changed(data, local_data, cleaner=cleaner, import_id=import_id)
 
-    purpose = local_data.get("purpose", "")
-    if purpose and len(purpose) > 200:
+def _add_segment(segments, tag, value):
+    value = value.strip()
+    if not value:
+        return
+    segments[tag] = f"{segments[tag]} {value}" if tag in segments else value
+
+
+def split_cc_purpose(purpose):
+    """Merchant and the rest of a credit card purpose, None if it is not one."""
+    # The merchant takes at least one character, the first amount after it wins
+    match = re_cc_amount.search(purpose, 1)
+    if not match:
+        return None
+    return purpose[: match.start()], " ".join((*match.groups(), purpose[match.end() :]))
+
+
+def prepare_fields(data, fields, *, tokenize_purpose=False):
+    """Extract the fields to clean from a raw transaction.
+
+    Only the fields the cleaner touches are needed, no need to copy the whole
+    transaction dict. Credit card transactions without an applicant name carry
+    it in the purpose, which is split up here. With `tokenize_purpose`, SEPA
+    purposes are reduced to their remittance information (SVWZ) first.
+    """
+    local_data = {field: data.get(field) for field in fields}
+    applicant_name = data.get("applicant_name", None) or ""
+    purpose = data.get("purpose", None) or ""
+    if tokenize_purpose and (segments := split_sepa_purpose(purpose)):
+        purpose = local_data["purpose"] = segments.get("SVWZ") or segments.get("", "")
+    if len(applicant_name) == 0 and len(purpose) > 0:
+        if split := split_cc_purpose(purpose):
+            local_data["applicant_name"], local_data["purpose"] = split
+    return local_data
+
+
+def finalize_fields(local_data):
+    """Applicant name and purpose of cleaned data as they are handed to the apps."""
+    purpose = local_data.get("purpose") or ""
+    if len(purpose) > 200:
         purpose = purpose[:200]
 
     applicant_name = local_data.get("applicant_name")
@@ -47,21 +113,14 @@ def process_transaction(transaction, cleaner):
         logger.warning("No applicant name found")
         applicant_name = "Unknown"
 
-    return FintsTransaction(
-        date=entry_date,
-        amount=amount,
-        # applicant_name=local_data["applicant_name"],
-        applicant_name=applicant_name,
-        purpose=purpose,
-        import_id=import_id,
-    )
+    return applicant_name, purpose
 
 
 def echo_if_changed(original_data, data, *, cleaner, import_id):
     logger.debug("---")
     logger.debug("Transaction %s", import_id)
 
-    logger.debug(f"Original: {original_data}")
+    logger.debug("Original: %s", original_data)
 
     for field in cleaner.fields:
         previous = original_data.get(field, "") or ""
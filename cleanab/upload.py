@@ -0,0 +1,171 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+from logzero import logger
+
+from .apps.base import BaseApp
+from .locks import outbox_lock
+from .outbox import Outbox
+from .profiling import Profiler
+
+
+class RateLimiter:
+    """Allows `burst` calls at once, refilled at `rate` per second."""
+
+    def __init__(self, rate: float | None, burst: int = 1):
+        self.interval = 1 / rate if rate else 0
+        self.burst = burst
+        # Time at which the bucket is full again
+        self._full = 0.0
+        self._lock = Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            window = self.interval * self.burst
+            self._full = max(self._full, now) + self.interval
+            delay = self._full - now - window
+        if delay > 0:
+            time.sleep(delay)
+
+
+class UploadScheduler:
+    """Upload transactions to apps according to their declared capabilities.
+
+    Apps are independent and uploaded at the same time. Per app, transactions
+    are split into batches of `max_batch_size`, queued in the app's outbox,
+    and sent with up to `concurrency` batches in flight, spaced out by
+    `rate_limit`. Batches left over by earlier runs are only sent when the
+    outbox is drained, by one process at a time. Batches that failed are
+    only sent again to `idempotent` apps, `streaming` apps get them lazily.
+    """
+
+    def __init__(self, profiler: Profiler):
+        self.profiler = profiler
+        self._limiters: dict[int, RateLimiter] = {}
+        self._outboxes: dict[int, Outbox] = {}
+
+    def _limiter(self, app: BaseApp):
+        # Kept across runs, a daemon must not exceed the limit either
+        if id(app) not in self._limiters:
+            self._limiters[id(app)] = RateLimiter(app.capabilities.rate_limit, app.capabilities.burst)
+        return self._limiters[id(app)]
+
+    def outbox(self, app: BaseApp):
+        if id(app) not in self._outboxes:
+            self._outboxes[id(app)] = Outbox(app)
+        return self._outboxes[id(app)]
+
+    @staticmethod
+    def batches(app: BaseApp, transactions):
+        size = app.capabilities.max_batch_size
+        if not transactions:
+            return []
+        if not size or len(transactions) <= size:
+            return [transactions]
+        return [transactions[i : i + size] for i in range(0, len(transactions), size)]
+
+    def upload_app(self, app: BaseApp, transactions=()):
+        """Queue and send `transactions`, or without any, drain the batches earlier runs left in the outbox."""
+        outbox = self.outbox(app)
+        if not transactions:
+            lock = outbox_lock(outbox.directory)
+            if not lock.acquire(0):
+                logger.info(f"{app}: Outbox is drained by process {lock.holder()}")
+                return [], []
+            try:
+                return self._send(app, outbox, outbox.entries, claim=True)
+            finally:
+                lock.release()
+
+        entries = [outbox.put(batch) for batch in self.batches(app, transactions)]
+        try:
+            # Only the batches put here, others may be in flight from another process
+            return self._send(app, outbox, lambda: [entry for entry in entries if entry.exists()])
+        finally:
+            # Unsent batches stay queued for the next drain
+            for entry in entries:
+                outbox.release(entry)
+
+    def _send(self, app: BaseApp, outbox: Outbox, candidates, *, claim=False):
+        capabilities = app.capabilities
+        limiter = self._limiter(app)
+
+        def upload_entry(entry):
+            if claim and not outbox.claim(entry):
+                # Sent or being sent by another process
+                return [], []
+            try:
+                if not capabilities.idempotent:
+                    entry = outbox.hold_back(entry)
+                # Streaming apps consume the batch as it is read
+                batch = outbox.iter_load(entry) if capabilities.streaming else outbox.load(entry)
+                limiter.wait()
+                try:
+                    result = app.create_transactions(batch)
+                except Exception:
+                    if not capabilities.idempotent:
+                        logger.error(
+                            f"{app}: {entry} may have been accepted in part and is not sent again. Check the app,"
+                            " then delete the file or rename it to .pickle to send it again"
+                        )
+                    raise
+                outbox.ack(entry)
+                return result
+            finally:
+                if claim:
+                    outbox.release(entry)
+
+        new, duplicates = [], []
+        with self.profiler.stage("upload", app):
+            # Loops once more after a successful probe of an open circuit
+            while entries := outbox.ready(entries=candidates()):
+                try:
+                    if capabilities.concurrency > 1 and len(entries) > 1:
+                        with ThreadPoolExecutor(
+                            max_workers=min(capabilities.concurrency, len(entries)),
+                            thread_name_prefix=f"upload-{app.name}",
+                        ) as executor:
+                            results = list(executor.map(upload_entry, entries))
+                    else:
+                        # Lazily, so a failing batch stops the following ones
+                        results = map(upload_entry, entries)
+
+                    for batch_new, batch_duplicates in results:
+                        new += batch_new
+                        duplicates += batch_duplicates
+                except Exception:
+                    outbox.failed()
+                    raise
+                outbox.succeeded()
+        return new, duplicates
+
+    def pending(self, apps, now=None):
+        """Apps with batches left in their outbox that may be retried now."""
+        now = time.time() if now is None else now
+        return [
+            app for app in apps if self.outbox(app).entries() and self.outbox(app).next_attempt <= now
+        ]
+
+    def upload(self, uploads):
+        """Upload (app, transactions) pairs, yields (app, result, exception) as apps finish."""
+        if len(uploads) <= 1:
+            for app, transactions in uploads:
+                try:
+                    yield app, self.upload_app(app, transactions), None
+                except Exception as exc:
+                    yield app, None, exc
+            return
+
+        with ThreadPoolExecutor(max_workers=len(uploads), thread_name_prefix="upload") as executor:
+            futures = {
+                executor.submit(self.upload_app, app, transactions): app for app, transactions in uploads
+            }
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as exc:
+                    yield futures[future], None, exc
@@ -1,13 +1,18 @@
 import os
 import re
 import sys
+import tempfile
+from contextlib import contextmanager
 from functools import lru_cache
 from pathlib import Path
-
-from cleanab.models.cleaner import ReplacementDefinition
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
 
 from . import constants
 
+if TYPE_CHECKING:
+    from cleanab.models.cleaner import ReplacementDefinition
+
 re_word_splits = re.compile(r"([^\s\-]+(\s|$))")
 
 if sys.platform == "darwin":
@@ -35,7 +40,7 @@ def simple_replace_instance(string, replacement=""):
 
 
 @lru_cache
-def regex_sub_instance(entry: ReplacementDefinition):
+def regex_sub_instance(entry: "ReplacementDefinition"):
     pattern = entry.pattern
     if not entry.regex:
         pattern = re.escape(pattern)
@@ -56,3 +61,45 @@ def regex_sub_instance(entry: ReplacementDefinition):
         return regex.sub(entry.repl, x), transformed
 
     return substitute
+
+
+@lru_cache
+def _http_adapter(scheme, host):
+    from requests.adapters import HTTPAdapter
+
+    return HTTPAdapter()
+
+
+def http_adapter(url):
+    """Transport adapter shared by all sessions for the host of `url`, it holds the connection pool."""
+    parts = urlsplit(str(url))
+    return _http_adapter(parts.scheme, parts.netloc)
+
+
+def http_session(url):
+    """A new `requests.Session` reusing the connection pool of the host of `url`.
+
+    Cookies and other session state stay with the session, every app
+    connection needs its own one. Never close it, that would close the pool.
+    """
+    import requests
+
+    parts = urlsplit(str(url))
+    session = requests.Session()
+    session.mount(f"{parts.scheme}://{parts.netloc}", http_adapter(url))
+    return session
+
+
+@contextmanager
+def atomic_write(filename, mode="w"):
+    """Write `filename` through a temporary file renamed over it, readers never see a partial file."""
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(prefix=f".{filename.name}.", suffix=".tmp", dir=filename.parent)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(temporary, filename)
+    except BaseException:
+        os.unlink(temporary)
+        raise